@@ -4,11 +4,258 @@ The main body of the code that contains all the class definitions
 '''
 
 import inspect
+import tracemalloc
 from pyMuellerMat import common_mm_functions
-import copy
+from pyMuellerMat import profiling
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 
 
+# The keyword arguments and their defaults for each mueller matrix function (see _get_function_properties)
+_function_properties_cache = {}
+
+
+def _get_function_properties(function):
+    '''
+    Find the keyword arguments of a mueller matrix function and their default values.
+    The answer is cached, since inspecting a function is much slower than building a MuellerMatrix.
+
+    Returns:
+    property_list       -   A new list of the names of the keyword arguments
+    property_defaults   -   A new list of their default values
+    '''
+    try:
+        property_list, property_defaults = _function_properties_cache[function]
+    except (KeyError, TypeError):
+        # I found this example of how to do this here: https://stackoverflow.com/questions/11915032/get-keyword-arguments-for-function-python
+        argspec = inspect.getfullargspec(function)
+        if argspec.defaults is not None:
+            property_list = tuple(argspec.args[-len(argspec.defaults):])
+            property_defaults = tuple(argspec.defaults)
+        else:
+            property_list = ()
+            property_defaults = ()
+
+        try:
+            _function_properties_cache[function] = (property_list, property_defaults)
+        except TypeError:
+            # Not hashable, so we can't cache it
+            pass
+
+    return list(property_list), list(property_defaults)
+
+
+class PropertyDict(dict):
+    '''
+    A dictionary of mueller matrix properties that keeps track of when it has been changed.
+
+    Every change to the dictionary increases its 'version' number by one. SystemMuellerMatrix uses
+    this to figure out which of its components need to be re-evaluated.
+
+    If the dictionary belongs to a SystemMuellerMatrix's PropertyVector then changes to its numeric
+    properties are also written through to the vector.
+
+    Note: changing an array property in place (e.g. properties['theta'][0] = 10) doesn't change the version.
+    Assign a new value instead, or call SystemMuellerMatrix.invalidate().
+    '''
+
+    __slots__ = ('version', '_vector', '_offsets')
+
+    def __init__(self, *args, **kwargs):
+        super(PropertyDict, self).__init__(*args, **kwargs)
+        self.version = 0
+
+        # The PropertyVector this dictionary belongs to (if any) and the offset of each of its numeric properties in it
+        self._vector = None
+        self._offsets = None
+
+    def __reduce__(self):
+        # Copy the items in the constructor, so that pickle and copy don't go through __setitem__ before version is set
+        return (self.__class__, (dict(self),), (self.version, self._vector, self._offsets))
+
+    def __setstate__(self, state):
+        self.version, self._vector, self._offsets = state
+
+    def __setitem__(self, key, value):
+        super(PropertyDict, self).__setitem__(key, value)
+        self.version += 1
+        if self._offsets is not None and key in self._offsets:
+            self._vector.write(self._offsets[key], value)
+
+    def __delitem__(self, key):
+        super(PropertyDict, self).__delitem__(key)
+        self.version += 1
+        self._sync_vector()
+
+    def update(self, *args, **kwargs):
+        super(PropertyDict, self).update(*args, **kwargs)
+        self.version += 1
+        self._sync_vector()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        value = super(PropertyDict, self).setdefault(key, default)
+        self._sync_vector()
+        return value
+
+    def pop(self, *args):
+        self.version += 1
+        value = super(PropertyDict, self).pop(*args)
+        self._sync_vector()
+        return value
+
+    def popitem(self):
+        self.version += 1
+        item = super(PropertyDict, self).popitem()
+        self._sync_vector()
+        return item
+
+    def clear(self):
+        super(PropertyDict, self).clear()
+        self.version += 1
+        self._sync_vector()
+
+    def _sync_vector(self):
+        '''
+        Write all the numeric properties through to the PropertyVector, if there is one
+        '''
+        if self._offsets is not None:
+            for key, offset in self._offsets.items():
+                self._vector.write(offset, self.get(key, np.nan))
+
+
+def _is_number(value):
+    '''
+    Is value a real number (and not a bool, a string or an array)?
+    '''
+    return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+
+
+class PropertyVector(object):
+    '''
+    All the numeric properties of the components of a SystemMuellerMatrix, as one contiguous float array.
+    You'll normally use this through SystemMuellerMatrix.get_vector and set_vector.
+
+    Each numeric property has an offset in the array, index['name.property']. The property dictionaries are
+    still where the components read their properties from (looking a number up in a dictionary is faster than
+    reading one element of a numpy array), and the two are kept in sync: changing a PropertyDict writes through
+    to the array, and set_values writes the values that changed back to the dictionaries.
+
+    Properties that aren't numbers (like a wollaston prism's 'beam') aren't in the array. Numeric properties that
+    are currently set to arrays (for a batched evaluation) are NaN.
+    '''
+
+    def __init__(self, names, property_dicts, default_property_dicts):
+        '''
+        Inputs:
+        names                   -   The names of the components
+        property_dicts          -   The property dictionaries of the components
+        default_property_dicts  -   The default properties of the components. The properties with numeric
+                                    defaults are the ones that go in the vector.
+
+        Class properties:
+
+        names   -   A list of the 'name.property' strings of the numeric properties, in the order of the array
+        index   -   A dictionary of the offset of each 'name.property' in the array
+        values  -   The array of values
+        '''
+        self.names = []
+        self.index = {}
+        self._dicts = list(property_dicts)
+
+        # The component position and property name for each offset
+        self._owners = []
+
+        values = []
+        for i, (name, properties, defaults) in enumerate(zip(names, property_dicts, default_property_dicts)):
+            offsets = {}
+            for key, value in properties.items():
+                if not _is_number(defaults.get(key, value)):
+                    continue
+                offsets[key] = len(values)
+                self.index[name + '.' + key] = len(values)
+                self.names.append(name + '.' + key)
+                self._owners.append((i, key))
+                values.append(float(value) if _is_number(value) else np.nan)
+
+            if isinstance(properties, PropertyDict):
+                properties._vector = self
+                properties._offsets = offsets
+
+        self.values = np.array(values, dtype=float)
+
+    def write(self, offset, value):
+        '''
+        Store the value of one property (NaN if it isn't a number)
+        '''
+        self.values[offset] = value if _is_number(value) else np.nan
+
+    def is_current(self, property_dicts):
+        '''
+        Is this vector still attached to these property dictionaries? It isn't if one has been replaced,
+        or if one of them has since been attached to another PropertyVector.
+        '''
+        if len(property_dicts) != len(self._dicts):
+            return False
+        for properties, own_properties in zip(property_dicts, self._dicts):
+            if properties is not own_properties:
+                return False
+            if isinstance(properties, PropertyDict) and properties._vector is not self:
+                return False
+        return True
+
+    def refresh(self):
+        '''
+        Re-read the values from any plain dictionaries, which can't write their changes through
+        '''
+        for offset, (i, key) in enumerate(self._owners):
+            properties = self._dicts[i]
+            if not isinstance(properties, PropertyDict):
+                self.write(offset, properties.get(key, np.nan))
+
+    def offsets(self, params):
+        '''
+        The offsets of a list of 'name.property' strings, as an integer array
+        '''
+        try:
+            return np.array([self.index[param] for param in params], dtype=int)
+        except KeyError as error:
+            raise ValueError("{} is not a numeric property of this system".format(error))
+
+    def set_values(self, vector, offsets=None):
+        '''
+        Set some of the values, and write the ones that changed back to the property dictionaries.
+        Each dictionary with a changed value gets one new version number.
+
+        Inputs:
+        vector  -   The new values
+        offsets -   Their offsets (see offsets). Default is all of them, in order.
+        '''
+        if offsets is None:
+            offsets = np.arange(len(self.values))
+        vector = np.broadcast_to(np.asarray(vector, dtype=float), np.shape(offsets))
+
+        # NaN stands for an array value, so leave those alone unless they're given a number
+        old_values = self.values[offsets]
+        changed = (old_values != vector) & ~(np.isnan(old_values) & np.isnan(vector))
+        if not np.any(changed):
+            return
+        changed_offsets = offsets[changed]
+        self.values[changed_offsets] = vector[changed]
+
+        changed_dicts = set()
+        for offset, value in zip(changed_offsets.tolist(), self.values[changed_offsets].tolist()):
+            i, key = self._owners[offset]
+            # Skip the write through, since we already have the value
+            dict.__setitem__(self._dicts[i], key, value)
+            changed_dicts.add(i)
+
+        for i in changed_dicts:
+            if isinstance(self._dicts[i], PropertyDict):
+                self._dicts[i].version += 1
+
+
 class MuellerMatrix(object):
     '''
     A mueller matrix whose main function is 'evaluate' that returns a 4x4 mueller matrix.
@@ -39,6 +286,11 @@ class MuellerMatrix(object):
         default_mm     -    A 4x4 mueller matrix that is evaluated using the default_propertys
         propertys          -    A dictionary of propertys representing the user's current inputs
         mm             -    A 4x4 mueller matrix that was generated by evaluating the 'function' with the current 'propertys'
+        dtype          -    The type of the stacks of mueller matrices made for array properties (e.g. np.float32).
+                            Single 4x4 matrices are always float64. See SystemMuellerMatrix.set_dtype.
+        workspace      -    An optional precision.Workspace to keep those stacks in between evaluations
+                            (see SystemMuellerMatrix.enable_workspace). The stacks that evaluate returns are then
+                            the workspace's arrays, which the next evaluation of the same shape overwrites.
         '''
 
         # Give this mueller matrix a name.
@@ -49,39 +301,106 @@ class MuellerMatrix(object):
 
         # TODO: Perhaps make a check so the function has no arguments (but can have keyword arguments)
 
-        # Get the function's keyword arguments - I found this example of how to do this here: https://stackoverflow.com/questions/11915032/get-keyword-arguments-for-function-python
-        # TODO: There may be a python 3 compatability problem here.
-        argspec = inspect.getargspec(self.function)
+        # Get the function's keyword arguments and their defaults. Inspecting a function is slow, so this is
+        # only done the first time we see each function (see _get_function_properties).
+        property_list, property_defaults = _get_function_properties(self.function)
 
-        if argspec.defaults is not None:
-            self.property_list = argspec.args[-len(argspec.defaults):]
-            self.property_defaults = [arg for arg in argspec.defaults[-len(
-                argspec.defaults):]]  # The output is a tuple, so we need to do it this way.
-        else:
-            self.property_list = []
-            self.property_defaults = []
+        # Add 'delta_theta' the rotational offset value and 'theta' the rotation value.
+        # All mueller matrices are rotatable and might have an offset.
+        self.property_list = ['delta_theta', 'theta'] + property_list
+        self.property_defaults = [0., 0.] + property_defaults
 
-        # Add 'theta' the rotation value. All mueller matrices are rotatable.
-        self.property_list.insert(0, 'theta')
-        self.property_defaults.insert(0, 0.)
+        self.default_property_dict = dict(zip(self.property_list, self.property_defaults))
 
-        # Add 'delta_theta' the rotational offset value. All mueller matrices might have an offset.
-        self.property_list.insert(0, 'delta_theta')
-        self.property_defaults.insert(0, 0.)
+        # Copy this to the working propertys property. The defaults are numbers and strings, so a shallow copy is enough.
+        self.properties = PropertyDict(self.default_property_dict)
 
-        # TODO: Get the property default values.
-        self.default_property_dict = {}
-        for i, kwarg in enumerate(self.property_list):
-            self.default_property_dict[kwarg] = self.property_defaults[i]
+        # The function's own keyword arguments (i.e. everything but the rotation). We keep this
+        # so that evaluate can pull the keyword arguments straight out of self.properties.
+        self.function_property_list = self.property_list[2:]
 
-        # Copy this to the working propertys property
-        self.properties = copy.deepcopy(self.default_property_dict)
+        # The dispersion laws of the wavelength dependent properties, as {property: (law, law_kwargs)} (see set_dispersion)
+        self.dispersion = {}
+
+        # The trig of the last array of rotation angles, so evaluating the same angles again is cheaper
+        self._rotation_trig = None
+
+        # The type of the batched mueller matrices, and where to keep them (see SystemMuellerMatrix.set_dtype
+        # and enable_workspace)
+        self.dtype = np.dtype(float)
+        self.workspace = None
+
+        # An optional cache of evaluated mueller matrices, keyed on the property values.
+        # It's off by default (cache_size = 0), turn it on with enable_cache().
+        self.cache_size = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
 
         # TODO: Run some test to make sure that the output of the function is a 4x4 array
 
-        # Evaluate the mueller matrix based on the defaults and store it in self.mm
-        self.default_mm = self.evaluate()
-        self.mm = copy.deepcopy(self.default_mm)
+        # The mueller matrix for the defaults and the current mueller matrix, self.mm, are only evaluated
+        # when they're first needed (see default_mm and mm), which makes building components much cheaper.
+        self._default_mm = None
+        self._mm = None
+
+    @property
+    def default_mm(self):
+        '''
+        The (read-only) mueller matrix for the default properties in default_property_dict.
+        It's evaluated the first time it's needed.
+        '''
+        if self._default_mm is None:
+            properties = self.properties
+            try:
+                self.properties = self.default_property_dict
+                default_mm = np.array(self._evaluate_properties(), dtype=float)
+            finally:
+                self.properties = properties
+            default_mm.flags.writeable = False
+            self._default_mm = default_mm
+        return self._default_mm
+
+    @default_mm.setter
+    def default_mm(self, default_mm):
+        self._default_mm = default_mm
+
+    @property
+    def mm(self):
+        '''
+        The last evaluated mueller matrix (a copy of default_mm until the first evaluation)
+        '''
+        if self._mm is None:
+            self._mm = self.default_mm.copy()
+        return self._mm
+
+    @mm.setter
+    def mm(self, mm):
+        self._mm = mm
+
+    def clone(self):
+        '''
+        Make a copy of this mueller matrix that can be changed independently. This is much faster than copy.deepcopy,
+        since everything that never changes (the function, its keyword arguments and default_mm) is shared.
+
+        The properties are copied, but array property values are shared with the original, so assign new arrays
+        rather than changing them in place. The clone's evaluation cache starts out empty.
+        '''
+        new = object.__new__(type(self))
+        new.__dict__.update(self.__dict__)
+
+        new.property_list = list(self.property_list)
+        new.property_defaults = list(self.property_defaults)
+        new.default_property_dict = dict(self.default_property_dict)
+        new.properties = PropertyDict(self.properties)
+        new.dispersion = {key: (law, dict(law_kwargs)) for key, (law, law_kwargs) in self.dispersion.items()}
+
+        new.cache_hits = 0
+        new.cache_misses = 0
+        new._cache = OrderedDict()
+        new._mm = None if self._mm is None else self._mm.copy()
+
+        return new
 
     def evaluate(self):
         '''
@@ -90,20 +409,41 @@ class MuellerMatrix(object):
 
         Inputs:
         theta	-	The rotation angle to apply in degrees
+
+        Any of the properties can also be an array (e.g. an array of theta values). In that case
+        the properties are broadcast against each other and a stack of mueller matrices with shape
+        (..., 4, 4) is returned, where ... is the broadcast shape of the array properties.
+        With a workspace the stack is only valid until the next evaluation (copy it to keep it).
         '''
 
         # TODO: Update self.properties with the new properties that have been passed. Not all properties have to be updated.
 
-        function_properties = copy.deepcopy(self.properties)
-        theta = function_properties.pop('theta') + function_properties.pop('delta_theta')
-        
-        # Evaluate the function with all the properties
-        mm = self.function(**function_properties)
+        # If the cache is turned on then look for these properties in the cache first.
+        # Arrays aren't hashable, so batched evaluations are never cached.
+        cache_key = None
+        if self.cache_size > 0:
+            cache_key = tuple(self.properties[key] for key in self.property_list)
+            try:
+                mm = self._cache.get(cache_key)
+            except TypeError:
+                cache_key = None
+                mm = None
 
-        # if theta != 0: Apply a rotation
-        if theta != 0:
-            mm = np.matmul(np.matmul(common_mm_functions.rotator_function(-theta), mm),
-                           common_mm_functions.rotator_function(theta))
+            if mm is not None:
+                self._cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                self.mm = mm
+                return mm
+
+        mm = self._evaluate_properties()
+
+        # Store the result, throwing away the least recently used matrix if the cache is full
+        if cache_key is not None:
+            self.cache_misses += 1
+            mm.flags.writeable = False
+            self._cache[cache_key] = mm
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
         # Update the object's mm property
         self.mm = mm
@@ -111,10 +451,353 @@ class MuellerMatrix(object):
         # Return the mueller matrix
         return mm
 
-    def invert():
+    def _evaluate_properties(self, function=None):
+        '''
+        Evaluate the function with the current properties (skipping the cache).
+        Returns a 4x4 mueller matrix, or an array of shape (..., 4, 4) if any of the properties are arrays.
+
+        Kwargs:
+        function    -   A different function to evaluate with the same keyword arguments and rotation
+                        (e.g. the inverse of self.function). Default is self.function.
+        '''
+        if function is None:
+            function = self.function
+
+        # Pull the keyword arguments straight out of the properties (without copying the properties)
+        properties = self.properties
+        theta = properties['theta'] + properties['delta_theta']
+        function_properties = self._function_properties()
+
+        # If any of the properties are arrays then evaluate a stack of mueller matrices
+        if np.ndim(theta) > 0 or any(np.ndim(value) > 0 for value in function_properties.values()):
+            return self._evaluate_batch(function_properties, theta, function=function)
+
+        # Evaluate the function with all the properties, using the precomputed angle grid if there is one
+        grid = common_mm_functions.angle_grids.get(function)
+        mm = grid.evaluate(function_properties) if grid is not None else None
+        if mm is None:
+            mm = function(**function_properties)
+
+        # if theta != 0: Apply a rotation. The inverse rotation is just the transpose of the rotation,
+        # and rotate_mueller_matrix works out R.T @ mm @ R without building R.
+        if theta != 0:
+            mm = common_mm_functions.rotate_mueller_matrix(mm, theta)
+
+        return mm
+
+    def _function_properties(self):
+        '''
+        The function's keyword arguments for the current properties, with the dispersion laws applied
+        '''
+        properties = self.properties
+        function_properties = {key: properties[key] for key in self.function_property_list}
+
+        if self.dispersion:
+            wavelength = properties['wavelength']
+            for key, (law, law_kwargs) in self.dispersion.items():
+                function_properties[key] = law(function_properties[key], wavelength, **law_kwargs)
+
+        return function_properties
+
+    def set_dispersion(self, key, law='inverse', wavelength0=1., **law_kwargs):
+        '''
+        Make one of the properties depend on wavelength. The property's value is then its value at the
+        reference wavelength wavelength0, and the mueller matrix is evaluated at self.properties['wavelength'].
+
+        For example, a half-wave plate designed for 700 nm, used at 675 nm (as in Notebooks/vampires_calibration_model.ipynb):
+            hwp = Retarder(name='hwp')
+            hwp.properties['phi'] = np.pi
+            hwp.set_dispersion('phi', 'inverse', wavelength0=700.)
+            hwp.properties['wavelength'] = 675.
+
+        The wavelength can be an array, like any other property, to evaluate a stack of mueller matrices
+        over a band (see SystemMuellerMatrix.evaluate_bandpass).
+
+        Inputs:
+        key         -   The name of the property (one of the function's keyword arguments)
+        law         -   The name of a dispersion law in common_mm_functions.dispersion_laws, or a function
+                        law(value, wavelength, wavelength0=1., **law_kwargs). None removes the dispersion.
+        wavelength0 -   The reference wavelength
+        law_kwargs  -   Any other keyword arguments of the law
+        '''
+        if key not in self.function_property_list:
+            raise ValueError("{} doesn't have a property '{}' that can depend on wavelength".format(self.name, key))
+
+        if law is None:
+            self.dispersion.pop(key, None)
+        else:
+            if not callable(law):
+                if law not in common_mm_functions.dispersion_laws:
+                    raise ValueError("Unknown dispersion law '{}'. The options are {}".format(
+                        law, list(common_mm_functions.dispersion_laws)))
+                law = common_mm_functions.dispersion_laws[law]
+            self.dispersion[key] = (law, dict(law_kwargs, wavelength0=wavelength0))
+
+            # Add the wavelength to the properties, starting at the reference wavelength
+            if 'wavelength' not in self.properties:
+                self.default_property_dict['wavelength'] = wavelength0
+                self.properties['wavelength'] = wavelength0
+                self.property_list.append('wavelength')
+
+        # The cached matrices don't know about the dispersion
+        self.clear_cache()
+        self._default_mm = None
+
+    def _evaluate_batch(self, function_properties, theta, function=None):
+        '''
+        Evaluate a stack of mueller matrices when one or more of the properties are arrays.
+
+        The function is only evaluated over the broadcast shape of its own (non-rotation) properties,
+        so a component where only theta varies is evaluated once and then rotated as a stack.
+
+        Inputs:
+        function_properties -   A dictionary of the function's keyword arguments (no 'theta' or 'delta_theta')
+        theta               -   The total rotation angle in degrees. Can be a scalar or an array.
+        function            -   The function to evaluate (see _evaluate_properties). Default is self.function.
+
+        Returns:
+        mm  -   An array of shape (..., 4, 4). With a workspace this is one of the workspace's arrays, which is
+                overwritten by the next evaluation of the same function and shape.
+        '''
+        if function is None:
+            function = self.function
+
+        # Split the properties into the ones that vary and the ones that don't
+        array_keys = [key for key, value in function_properties.items() if np.ndim(value) > 0]
+
+        # Use the vectorized version of the function if there is one
+        vectorized_function = common_mm_functions.vectorized_functions.get(function)
+
+        # Or the precomputed angle grid, if it's only the grid keyword that varies
+        grid = common_mm_functions.angle_grids.get(function)
+        mm = None
+        if grid is not None and all(key == grid.key for key in array_keys):
+            mm = grid.evaluate(function_properties)
+
+        # Whether mm is a new stack of our own type that we can rotate in place
+        own_stack = False
+
+        if mm is not None:
+            # Everything was on (or filled in by) the grid
+            pass
+        elif len(array_keys) == 0:
+            mm = np.asarray(function(**function_properties), dtype=float)
+        elif vectorized_function is not None:
+            shape = np.broadcast_shapes(*[np.shape(function_properties[key]) for key in array_keys])
+            if self.workspace is None and self.dtype == np.float64:
+                mm = vectorized_function(**function_properties).reshape(shape + (4, 4))
+            else:
+                # Make the stack in our own type, in the workspace if we have one
+                out = self._get_buffer(function, (int(np.prod(shape)), 4, 4))
+                mm = vectorized_function(out=out, **function_properties).reshape(shape + (4, 4))
+                own_stack = True
+        else:
+            array_values = np.broadcast_arrays(*[np.asarray(function_properties[key]) for key in array_keys])
+            shape = array_values[0].shape
+            mm = np.empty(shape + (4, 4))
+            kwargs = dict(function_properties)
+
+            # Step through each element of the broadcast properties and evaluate the function
+            for index in np.ndindex(*shape):
+                for key, value in zip(array_keys, array_values):
+                    kwargs[key] = value[index]
+                mm[index] = function(**kwargs)
+
+        if np.ndim(theta) == 0 and theta == 0:
+            return mm
+
+        # Apply the rotation to the whole stack at once. With a workspace or another type the rotated stack goes
+        # in our own array, which can be the stack itself if the vectorized function just made it.
+        out = None
+        if self.workspace is not None or self.dtype != np.float64:
+            rotated_shape = np.broadcast_shapes(mm.shape[:-2], np.shape(theta)) + (4, 4)
+            if own_stack and mm.shape == rotated_shape:
+                out = mm
+            else:
+                out = self._get_buffer((function, 'rotation'), rotated_shape)
+
+        if np.ndim(theta) > 0:
+            mm = common_mm_functions.rotate_mueller_matrix(mm, theta, trig=self._get_rotation_trig(theta), out=out)
+        else:
+            mm = common_mm_functions.rotate_mueller_matrix(mm, theta, out=out)
+
+        return mm
+
+    def _get_buffer(self, key, shape):
+        '''
+        An array of self.dtype for the result of a batched evaluation: from the workspace if there is one
+        (so it's reused by the next evaluation with the same key), otherwise a new one
+        '''
+        if self.workspace is None:
+            return np.empty(shape, dtype=self.dtype)
+        return self.workspace.get((id(self), key), shape, self.dtype)
+
+    def _get_rotation_trig(self, theta):
+        '''
+        The cosine and sine of twice an array of rotation angles (see common_mm_functions.rotation_trig).
+        The last ones are kept, so evaluating the same angles again (e.g. a fixed grid of HWP angles in a fit)
+        doesn't recompute them.
+        '''
+        if self._rotation_trig is not None:
+            cached_theta, trig = self._rotation_trig
+            if np.shape(cached_theta) == np.shape(theta) and np.array_equal(cached_theta, theta):
+                return trig
+
+        trig = common_mm_functions.rotation_trig(theta)
+        # Keep our own copy of the angles, in case the user changes them in place
+        self._rotation_trig = (np.array(theta), trig)
+        return trig
+
+    def derivative(self, key):
+        '''
+        Evaluate the derivative of the mueller matrix with respect to one of its properties, at the current property values.
+
+        The analytic derivatives in common_mm_functions.derivative_functions are used when they exist, otherwise
+        the function is differentiated with central finite differences. The derivatives with respect to 'theta'
+        and 'delta_theta' are the same (per degree), since only their sum matters.
+
+        Inputs:
+        key -   The name of the property
+
+        Returns:
+        d_mm    -   A 4x4 matrix, or an array of shape (..., 4, 4) if any of the properties are arrays
+        '''
+        if key not in self.properties:
+            raise ValueError("{} doesn't have a property '{}'".format(self.name, key))
+
+        properties = self.properties
+
+        # The wavelength isn't one of the function's keyword arguments, so use finite differences of the whole matrix
+        if key == 'wavelength':
+            wavelength = properties['wavelength']
+            step = 1e-6 * np.maximum(1., np.abs(wavelength))
+            try:
+                properties['wavelength'] = wavelength + step
+                mm_plus = self._evaluate_properties()
+                properties['wavelength'] = wavelength - step
+                mm_minus = self._evaluate_properties()
+            finally:
+                properties['wavelength'] = wavelength
+            return (mm_plus - mm_minus) / (2 * np.asarray(step)[..., None, None])
+
+        theta = properties['theta'] + properties['delta_theta']
+        function_properties = self._function_properties()
+
+        # For a wavelength dependent property, the chain rule needs the derivative of the dispersion law
+        scale = 1.
+        if key in self.dispersion:
+            law, law_kwargs = self.dispersion[key]
+            value = properties[key]
+            step = 1e-6 * np.maximum(1., np.abs(value))
+            scale = (law(value + step, properties['wavelength'], **law_kwargs) -
+                     law(value - step, properties['wavelength'], **law_kwargs)) / (2 * step)
+
+        if np.ndim(theta) == 0 and all(np.ndim(value) == 0 for value in function_properties.values()):
+            return scale * self._derivative_at(key, theta, function_properties)
+
+        # For array properties, step through each element of the broadcast properties
+        array_keys = [prop for prop, value in function_properties.items() if np.ndim(value) > 0]
+        array_values = np.broadcast_arrays(np.asarray(theta), *[np.asarray(function_properties[prop]) for prop in array_keys])
+        shape = array_values[0].shape
+        d_mm = np.empty(shape + (4, 4))
+        kwargs = dict(function_properties)
+        for index in np.ndindex(*shape):
+            for prop, value in zip(array_keys, array_values[1:]):
+                kwargs[prop] = value[index]
+            d_mm[index] = self._derivative_at(key, array_values[0][index], kwargs)
+
+        return np.asarray(scale)[..., None, None] * d_mm
+
+    def _derivative_at(self, key, theta, function_properties):
+        '''
+        The derivative of the mueller matrix with respect to the property 'key', for a scalar rotation theta
+        and a dictionary of scalar function keyword arguments.
+        '''
+        # The derivative of R(theta).T @ M @ R(theta) with respect to theta
+        if key in ('theta', 'delta_theta'):
+            rotator = common_mm_functions.rotator_function(theta)
+            mm = np.asarray(self.function(**function_properties), dtype=float)
+            d_rotator = common_mm_functions.rotator_function_derivative(theta)['pa']
+            return d_rotator.T @ mm @ rotator + rotator.T @ mm @ d_rotator
+
+        derivative_function = common_mm_functions.derivative_functions.get(self.function)
+        if derivative_function is not None:
+            derivatives = derivative_function(**function_properties)
+            if key not in derivatives:
+                raise ValueError("{} can't be differentiated with respect to '{}'".format(self.name, key))
+            d_mm = derivatives[key]
+            if d_mm is None:
+                raise ValueError("The derivative of {} with respect to '{}' is undefined (infinite) at {}".format(
+                    self.name, key, function_properties))
+        else:
+            # Central finite differences
+            value = function_properties[key]
+            step = 1e-6 * max(1., abs(value))
+            kwargs = dict(function_properties)
+            kwargs[key] = value + step
+            mm_plus = np.asarray(self.function(**kwargs), dtype=float)
+            kwargs[key] = value - step
+            mm_minus = np.asarray(self.function(**kwargs), dtype=float)
+            d_mm = (mm_plus - mm_minus) / (2 * step)
+
+        return common_mm_functions.rotate_mueller_matrix(d_mm, theta)
+
+    def enable_cache(self, cache_size=128):
+        '''
+        Turn on the evaluation cache. Evaluated mueller matrices are stored with their property values
+        as the key, so evaluating with properties that have been seen before just returns the stored matrix.
+        Only the cache_size most recently used matrices are kept.
+
+        The cached matrices are read-only, since they are shared between calls.
+
+        Inputs:
+        cache_size  -   The maximum number of mueller matrices to keep. 0 turns the cache off.
+        '''
+        self.cache_size = cache_size
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def disable_cache(self):
+        '''
+        Turn off the evaluation cache and empty it.
         '''
-        A function that returns the inverse of the current mueller matrix, self.mm
+        self.cache_size = 0
+        self.clear_cache()
+
+    def clear_cache(self):
+        '''
+        Empty the evaluation cache and reset the hit and miss counters.
+        Use this if you change self.function.
+        '''
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def invert(self, pseudo=False):
+        '''
+        A function that returns the inverse of the mueller matrix for the current properties.
+
+        If the function has a closed-form inverse in common_mm_functions.inverse_functions then that is used,
+        rotated by the same angle (the rotators are orthogonal, so (R.T @ M @ R)^-1 = R.T @ M^-1 @ R).
+        Otherwise the mueller matrix is inverted numerically. Array properties give a stack of inverses.
+
+        Kwargs:
+        pseudo  -   If True return the pseudo-inverse instead, which also exists for singular mueller matrices
+                    like polarizers and wollaston prisms.
+
+        Returns:
+        mm_inv  -   A 4x4 matrix, or an array of shape (..., 4, 4) if any of the properties are arrays.
+                    Raises np.linalg.LinAlgError if the mueller matrix is singular and pseudo is False.
         '''
+        inverse_function = common_mm_functions.inverse_functions.get(self.function)
+        if inverse_function is not None and not pseudo:
+            mm_inv = np.asarray(self._evaluate_properties(function=inverse_function), dtype=float)
+            # Don't hand out the workspace's arrays, they'll be overwritten by the next evaluation
+            if self.workspace is not None and self.workspace.holds(mm_inv):
+                mm_inv = mm_inv.copy()
+            return mm_inv
+
+        return common_mm_functions.invert_mueller_matrix(self.evaluate(), pseudo=pseudo)
 
 
 class SystemMuellerMatrix(object):
@@ -123,12 +806,16 @@ class SystemMuellerMatrix(object):
     It will typically be made up of one or more other mueller matrices.
     '''
 
-    def __init__(self, mueller_matrix_list=[]):
+    def __init__(self, mueller_matrix_list=[], dtype=float):
         '''
         The initialization accepts a list of MuellerMatrix objects.
         They will eventually be evaluated as:
 
             S_out = M0 * M1 * M2 * .... * M_n * S_in
+
+        Kwargs:
+        dtype   -   The type of the evaluated matrices. np.float32 halves the memory and bandwidth of big batched
+                    evaluations, at the cost of ~1e-7 relative errors (see set_dtype and precision.py).
         '''
 
         # Make a master list of keyword arguments for all the functions. Each keyword will be prefixed by M$_, where $ corresponds to the position of the given matrix in the list.
@@ -149,27 +836,427 @@ class SystemMuellerMatrix(object):
             else:
                 name = "M{}".format(i)
 
+            # Make sure we can keep track of changes to the properties
+            if not isinstance(mm.properties, PropertyDict):
+                mm.properties = PropertyDict(mm.properties)
+
             # Add each properties dictionary to the master dictionary
             self.master_property_dict[name] = mm.properties
 
             # Append this mm's name to the master list.
             self.names.append(name)
 
-        # Make a mueller matrix for all the default parameters
-        self.default_mm = self.evaluate()
+        # The type of the evaluated matrices, and an optional workspace for the batched intermediates
+        # (see set_dtype and enable_workspace)
+        self.dtype = np.dtype(dtype)
+        self.workspace = None
+        if self.dtype != np.float64:
+            for mm in self.mueller_matrix_list:
+                mm.dtype = self.dtype
+
+        # The cached products of the component matrices, which let us skip most of the matrix multiplications
+        # when only a few of the components change (see evaluate).
+        self.invalidate()
+
+        # The mueller matrix for the properties the components have now, which is only evaluated when
+        # it's first needed (see default_mm). Keep a copy of the properties for that.
+        self._default_properties = [dict(self.master_property_dict[name]) for name in self.names]
+        self._default_mm = None
+        self._mm = None
+
+        # All the numeric properties as one array, which is only made when it's first needed (see get_vector)
+        self._property_vector = None
+
+        # The evaluation statistics, when they're turned on (see profile)
+        self.stats = None
+
+    @property
+    def default_mm(self):
+        '''
+        The (read-only) system mueller matrix for the properties that the components had when the system was made.
+        It's evaluated the first time it's needed.
+        '''
+        if self._default_mm is None:
+            default_mm = np.eye(4)
+            for mm, properties in zip(self.mueller_matrix_list, self._default_properties):
+                current_properties = mm.properties
+                try:
+                    mm.properties = properties
+                    default_mm = default_mm @ mm._evaluate_properties()
+                finally:
+                    mm.properties = current_properties
+            default_mm.flags.writeable = False
+            self._default_mm = default_mm
+        return self._default_mm
+
+    @default_mm.setter
+    def default_mm(self, default_mm):
+        self._default_mm = default_mm
+
+    @property
+    def mm(self):
+        '''
+        The last evaluated system mueller matrix (a copy of default_mm until the first evaluation)
+        '''
+        if self._mm is None:
+            self._mm = self.default_mm.copy()
+        return self._mm
+
+    @mm.setter
+    def mm(self, mm):
+        self._mm = mm
+
+    def clone(self):
+        '''
+        Make a copy of this system, with clones of all its components (see MuellerMatrix.clone), that can be
+        changed independently. This is much faster than building the system again or copy.deepcopy.
+
+        The cached component matrices and products are shared with the original (they're never changed in place),
+        so the clone doesn't need to evaluate anything until its properties change.
+        '''
+        new = object.__new__(type(self))
+        new.__dict__.update(self.__dict__)
+
+        new.names = list(self.names)
+        new.mueller_matrix_list = [mm.clone() for mm in self.mueller_matrix_list]
+        new.master_property_dict = {}
+        new._property_dicts = list(self._property_dicts)
+        for i, (name, mm) in enumerate(zip(new.names, new.mueller_matrix_list)):
+            properties = self.master_property_dict[name]
+            if isinstance(properties, PropertyDict):
+                new_properties = PropertyDict(properties)
+                new_properties.version = properties.version
+            else:
+                new_properties = dict(properties)
+            mm.properties = new_properties
+            new.master_property_dict[name] = new_properties
+
+            # The cached matrix of this component is still valid if it was valid for the original
+            if self._property_dicts[i] is properties:
+                new._property_dicts[i] = new_properties
+
+        new._component_mms = list(self._component_mms)
+        new._property_versions = list(self._property_versions)
+        new._prefix = list(self._prefix)
+        new._suffix = list(self._suffix)
+        new._mm = None if self._mm is None else self._mm.copy()
+        new._property_vector = None
+        new.stats = None
+
+        # With a workspace the cached matrices are overwritten in place, so they can't be shared
+        if self.workspace is not None:
+            new.invalidate()
+
+        return new
+
+    def _get_property_vector(self):
+        '''
+        Get the PropertyVector of this system, making a new one if the property dictionaries have been replaced
+        '''
+        property_dicts = [self.master_property_dict[name] for name in self.names]
+        vector = self._property_vector
+        if vector is None or not vector.is_current(property_dicts):
+            vector = PropertyVector(self.names, property_dicts, self._default_properties)
+            self._property_vector = vector
+        else:
+            vector.refresh()
+        return vector
+
+    @property
+    def parameter_names(self):
+        '''
+        The 'name.property' strings of all the numeric properties of the system, in the order of get_vector
+        '''
+        return list(self._get_property_vector().names)
+
+    def get_vector(self, params=None):
+        '''
+        Get the values of the numeric properties of the system as one array.
+        Properties that are currently set to arrays are NaN.
+
+        Inputs:
+        params  -   A list of 'name.property' strings. Default is all of them (see parameter_names).
+
+        Returns:
+        vector  -   An array of the values. Without params this is a read-only view that follows any changes
+                    to the properties; with params it's a copy.
+        '''
+        vector = self._get_property_vector()
+        if params is None:
+            values = vector.values.view()
+            values.flags.writeable = False
+            return values
+        return vector.values[vector.offsets(params)]
+
+    def set_vector(self, vector, params=None):
+        '''
+        Set the numeric properties of the system from one array. This is an alternative to
+        evaluate(new_property_dict) for optimizers and samplers that work with parameter vectors.
+
+        Only the components whose properties actually change are re-evaluated by the next evaluate.
 
-        # Put the default mueller matrix in the 'current' mueller matrix
-        self.mm = copy.deepcopy(self.default_mm)
+        Inputs:
+        vector  -   The new values
+        params  -   A list of 'name.property' strings for the values. Default is all of them (see parameter_names).
+        '''
+        property_vector = self._get_property_vector()
+        offsets = None if params is None else property_vector.offsets(params)
+        if offsets is None and np.shape(vector) != property_vector.values.shape:
+            raise ValueError("Expected {} values, not {}".format(len(property_vector.values), np.shape(vector)))
+        property_vector.set_values(vector, offsets)
 
+    @profiling.profiled
     def evaluate(self, new_property_dict=None):
         '''
         Compute the system mueller matrix by evaluating each individual mueller matrix based on the keyword dictionary, property_dict.
         property_dict will be a nested dictionary of the form {'M0': {'property1': value, 'property2': value}, 'M1': {'property1': value, 'property2': value}, etc},
         where M0 and M1 are the names of the first and second mueller matrices and 'property1' and 'property2' represent the keywords needed for their respective functions
         and may vary in actual name between the two functions.
+
+        Any property can be given as an array (e.g. {'hwp': {'theta': hwp_angles}}). The component matrices are then
+        evaluated as stacks and multiplied together with broadcasting, so the returned mueller matrix has shape (..., 4, 4)
+        where ... is the broadcast shape of all the array properties across all the components. For example, passing
+        hwp angles with shape (n_hwp, 1) and image rotator angles with shape (1, n_imrot) returns an array of shape
+        (n_hwp, n_imrot, 4, 4).
         '''
 
         # Update the property dicts based on the new_property_dict if it exists
+        self._update_properties(new_property_dict)
+
+        # Re-evaluate the mueller matrices whose properties have changed
+        self._update_component_mms()
+
+        # If nothing changed then we already have the answer
+        if self._system_mm is not None:
+            self.mm = self._system_mm.copy()
+            return self.mm
+
+        # The system mueller matrix is prefix[k] @ suffix[k] for any k, where
+        #     prefix[k] = M0 @ M1 @ ... @ M(k-1)   (prefix[0] is the identity)
+        #     suffix[k] = Mk @ ... @ M(n-1)         (suffix[n] is the identity)
+        # We keep these products around between calls. Only the prefixes after the first changed
+        # component and the suffixes up to the last changed component need to be updated (_update_component_mms
+        # keeps track of which ones are still valid), so changing a single component costs two matrix
+        # multiplications rather than n.
+        last = self._last_changed
+        n_products = max(0, self._suffix_valid - 1 - last) + max(0, last + 1 - self._prefix_valid)
+
+        # Bring the suffixes after the last changed component up to date. This only costs anything the first time
+        # a component is changed, after that they stay valid until something further down the chain changes.
+        workspace = self.workspace
+        for k in range(self._suffix_valid - 1, last, -1):
+            if workspace is None:
+                self._suffix[k] = self._component_mms[k] @ self._suffix[k + 1]
+            else:
+                self._suffix[k] = self._product(self._component_mms[k], self._suffix[k + 1], ('suffix', k))
+        self._suffix_valid = min(self._suffix_valid, last + 1)
+
+        # Extend the prefixes through the changed components.
+        # This broadcasts when either matrix is a stack of shape (..., 4, 4)
+        for k in range(self._prefix_valid, last + 1):
+            if workspace is None:
+                self._prefix[k + 1] = self._prefix[k] @ self._component_mms[k]
+            else:
+                self._prefix[k + 1] = self._product(self._prefix[k], self._component_mms[k], ('prefix', k + 1))
+        self._prefix_valid = max(self._prefix_valid, last + 1)
+
+        if last + 1 == len(self.mueller_matrix_list):
+            mm = self._prefix[last + 1]
+        elif workspace is None:
+            mm = self._prefix[last + 1] @ self._suffix[last + 1]
+        else:
+            mm = self._product(self._prefix[last + 1], self._suffix[last + 1], 'system')
+
+        if self.stats is not None:
+            self.stats.products += n_products + (last + 1 < len(self.mueller_matrix_list))
+
+        # Keep our own copy, so that changes the user makes to the output don't affect the next evaluation
+        self._system_mm = mm
+        self._last_changed = -1
+        self.mm = mm.copy()
+
+        return self.mm
+
+    @profiling.profiled
+    def evaluate_row(self, new_property_dict=None, row=None):
+        '''
+        Compute just one row of the system mueller matrix (by default the first row, which is all you need to
+        predict measured intensities). This gives the same answer as evaluate()[..., 0, :], but only propagates
+        a row vector through the chain, which needs about four times less arithmetic than multiplying out the
+        full 4x4 matrices:
+
+            row @ M0 @ M1 @ ... @ M(n-1)
+
+        Inputs:
+        new_property_dict   -   An optional property dictionary to update the system with first (see evaluate)
+        row                 -   The row vector(s) to propagate, with shape (4,) or (..., 4). Default is [1, 0, 0, 0].
+
+        Returns:
+        row     -   The propagated row vector(s), with shape (..., 4)
+        '''
+        self._update_properties(new_property_dict)
+        self._update_component_mms()
+
+        # Start from the longest valid prefix product, if we have one. Picking the first row out of it is cheap
+        # (copy it, since the prefix is cached and may be the system mueller matrix itself)
+        start = self._prefix_valid
+        if row is None:
+            row = self._prefix[start][..., 0, :].copy()
+        else:
+            row = np.einsum('...j,...jk->...k', np.asarray(row, dtype=float), self._prefix[start])
+
+        workspace = self.workspace
+        for k in range(start, len(self.mueller_matrix_list)):
+            component_mm = self._component_mms[k]
+            if workspace is not None:
+                # Alternate between two arrays of the workspace, so the input and output are never the same array
+                shape = np.broadcast_shapes(row.shape[:-1], component_mm.shape[:-2]) + (4,)
+                row_out = workspace.get((id(self), 'row', k % 2), shape, self.dtype)
+                np.matmul(row[..., None, :], component_mm, out=row_out[..., None, :])
+                row = row_out
+            elif np.ndim(component_mm) == 2:
+                # A single matrix: multiply all the rows at once as one (n_rows, 4) @ (4, 4) product
+                row = (row.reshape(-1, 4) @ component_mm).reshape(row.shape)
+            else:
+                # A stack: a broadcast (..., 1, 4) @ (..., 4, 4) product, which is faster than the same einsum
+                row = np.matmul(row[..., None, :], component_mm)[..., 0, :]
+
+        if self.stats is not None:
+            self.stats.products += len(self.mueller_matrix_list) - start
+
+        # Don't hand out the workspace's arrays, they'll be overwritten by the next evaluation
+        if workspace is not None:
+            row = row.copy()
+
+        return row
+
+    def set_wavelength(self, wavelength):
+        '''
+        Set the wavelength of all the wavelength dependent components (see MuellerMatrix.set_dispersion).
+        The wavelength can be an array, like any other property.
+        '''
+        for name, mm in self._named_components():
+            if mm.dispersion:
+                self.master_property_dict[name]['wavelength'] = wavelength
+
+    def evaluate_bandpass(self, wavelengths, weights=None, new_property_dict=None):
+        '''
+        Compute the effective broadband system mueller matrix over a bandpass, i.e. the weighted mean of the system
+        mueller matrix over a set of wavelengths:
+
+            sum_k weights[k] * M(wavelengths[k]) / sum_k weights[k]
+
+        All the wavelengths are evaluated in one batched pass, by setting the wavelength of every wavelength
+        dependent component to the array of wavelengths. The weights are e.g. the filter transmission times the
+        source spectrum times the wavelength spacing. The wavelengths of the components are put back afterwards.
+
+        Other array properties work as usual (the wavelengths get their own axis), so e.g. an array of
+        HWP angles gives an array of broadband mueller matrices.
+
+        Inputs:
+        wavelengths         -   A 1D array of wavelengths (in the same units as the components' wavelength0)
+        weights             -   The weight of each wavelength. Default is equal weights.
+        new_property_dict   -   An optional property dictionary to update the system with first (see evaluate)
+
+        Returns:
+        mm  -   The broadband mueller matrix, with shape (4, 4) or (..., 4, 4)
+        '''
+        self._update_properties(new_property_dict)
+
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if weights is None:
+            weights = np.ones(len(wavelengths))
+        weights = np.asarray(weights, dtype=float)
+        weights = weights / np.sum(weights)
+
+        # Put the wavelengths on a new leading axis, in front of the axes of any other array properties
+        batch_ndim = max([np.ndim(value) for properties in self.master_property_dict.values()
+                          for key, value in properties.items() if key != 'wavelength'] + [0])
+        wavelength_grid = wavelengths.reshape((-1,) + (1,) * batch_ndim)
+
+        old_wavelengths = {name: self.master_property_dict[name]['wavelength']
+                           for name, mm in self._named_components() if mm.dispersion}
+        try:
+            self.set_wavelength(wavelength_grid)
+            mm = self.evaluate()
+        finally:
+            for name, wavelength in old_wavelengths.items():
+                self.master_property_dict[name]['wavelength'] = wavelength
+
+        # Sum over the wavelength axis (which is missing if nothing depends on wavelength)
+        mm = np.broadcast_to(mm, np.broadcast_shapes(wavelength_grid.shape, mm.shape[:-2]) + (4, 4))
+        self.mm = np.tensordot(weights, mm, axes=(0, 0))
+
+        return self.mm
+
+    def propagate(self, stokes, new_property_dict=None, **property_arrays):
+        '''
+        Propagate input Stokes vector(s) through the system: S_out = M0 @ M1 @ ... @ M(n-1) @ S_in
+
+        The Stokes vectors are broadcast against the (possibly batched) system mueller matrix. Properties can be
+        passed either as a new_property_dict or as keyword arguments named after the components, e.g.
+            sys_mm.propagate(stokes_cube, hwp={'theta': hwp_angles}, image_rotator={'theta': imrot_angs})
+
+        There are two ways to do the contraction, and the cheaper one is picked automatically:
+            - matrix chain: multiply out the system mueller matrix (reusing the cached products) and then
+              apply it to the Stokes vectors. Best when there are many Stokes vectors per system matrix.
+            - vector chain: apply each component to the Stokes vectors in turn, from right to left. Best when
+              the properties vary as much as the Stokes vectors do, since it never forms 4x4 products.
+
+        Inputs:
+        stokes              -   The input Stokes vector(s), with shape (4,) or (..., 4)
+        new_property_dict   -   An optional property dictionary to update the system with first (see evaluate)
+        property_arrays     -   Property dictionaries for individual components, keyed by component name
+
+        Returns:
+        stokes_out  -   The output Stokes vector(s), with shape (..., 4)
+        '''
+        if len(property_arrays) > 0:
+            new_property_dict = dict(new_property_dict or {}, **property_arrays)
+        self._update_properties(new_property_dict)
+        self._update_component_mms()
+
+        stokes = np.asarray(stokes, dtype=float)
+        n_mms = len(self.mueller_matrix_list)
+
+        # Compare the number of multiplications for each order
+        system_shape = np.broadcast_shapes(*[np.shape(mm)[:-2] for mm in self._component_mms])
+        n_system = int(np.prod(system_shape))
+        n_total = int(np.prod(np.broadcast_shapes(system_shape, stokes.shape[:-1])))
+        if self._system_mm is not None:
+            matrix_cost = 16 * n_total
+        else:
+            matrix_cost = 64 * n_mms * n_system + 16 * n_total
+        vector_cost = 16 * n_mms * n_total
+
+        if matrix_cost <= vector_cost:
+            return self._propagate_matrix(stokes)
+        else:
+            return self._propagate_vector(stokes)
+
+    def _propagate_matrix(self, stokes):
+        '''
+        Propagate Stokes vectors by multiplying out the system mueller matrix first
+        '''
+        mm = self.evaluate()
+        return np.einsum('...ij,...j->...i', mm, stokes)
+
+    def _propagate_vector(self, stokes):
+        '''
+        Propagate Stokes vectors through the components one at a time, from right to left
+        '''
+        for component_mm in self._component_mms[::-1]:
+            if np.ndim(component_mm) == 2:
+                # A single matrix: multiply all the vectors at once as one (n_vectors, 4) @ (4, 4) product
+                stokes = (stokes.reshape(-1, 4) @ component_mm.T).reshape(stokes.shape)
+            else:
+                stokes = np.einsum('...ij,...j->...i', component_mm, stokes)
+        return stokes
+
+    def _update_properties(self, new_property_dict):
+        '''
+        Update master_property_dict with the values in a nested property dictionary (see evaluate)
+        '''
         if new_property_dict is not None:
 
             # TODO: Put in some sort of check to make sure that the
@@ -189,36 +1276,340 @@ class SystemMuellerMatrix(object):
                             # Update the keyword!
                             self.master_property_dict[mm_name][mm_key] = new_property_dict[mm_name][mm_key]
 
-        # The number of mueller matrices in the list
-        n_mms = len(self.mueller_matrix_list)
+    def _update_component_mms(self):
+        '''
+        Evaluate the mueller matrices of the components whose properties have changed since the last evaluation.
+        A component has changed if its property dictionary has a new version number, or if its entry in
+        master_property_dict has been replaced.
 
-        # Start off with an identity matrix
-        mm = np.eye(4)
+        This also keeps track of which of the cached prefix and suffix products (see evaluate) are still valid.
+        '''
+        stats = self.stats
+        for i, name in enumerate(self.names):
+            properties = self.master_property_dict[name]
+            version = getattr(properties, 'version', None)
 
-        # Cycle through the mueller matrices and multiply them together
-        # for i in range(n_mms):
-        #     properties = self.master_property_dict[self.names[-i]]
-        #     self.mueller_matrix_list[-i].properties = properties
-        #     new_mm = self.mueller_matrix_list[-i].evaluate()
-        #     mm = np.matmul(mm, new_mm)
-        #     # mm = np.matmul(new_mm,mm)
+            # Plain dictionaries can't tell us if they've changed, so they're always re-evaluated
+            if properties is self._property_dicts[i] and version is not None and version == self._property_versions[i]:
+                if stats is not None:
+                    stats.skip_component(name)
+                continue
 
-        for i in range(n_mms):
-            properties = self.master_property_dict[self.names[i]]
             self.mueller_matrix_list[i].properties = properties
-            new_mm = self.mueller_matrix_list[i].evaluate()
-            # mm = np.matmul(mm, new_mm)
-            mm = mm@new_mm
-            # mm = np.matmul(new_mm,mm)
+            if stats is None:
+                component_mm = self.mueller_matrix_list[i].evaluate()
+            else:
+                component_mm = stats.evaluate_component(name, self.mueller_matrix_list[i])
+            if not isinstance(component_mm, np.ndarray) or component_mm.dtype != self.dtype:
+                component_mm = np.asarray(component_mm, dtype=self.dtype)
+            self._component_mms[i] = component_mm
+            self._property_dicts[i] = properties
+            self._property_versions[i] = version
 
-        self.mm = mm
+            # The prefixes after this component and the suffixes up to it are out of date
+            self._prefix_valid = min(self._prefix_valid, i)
+            self._suffix_valid = max(self._suffix_valid, i + 1)
+            self._last_changed = max(self._last_changed, i)
+            self._system_mm = None
 
-        return mm
+    def invalidate(self, names=None):
+        '''
+        Throw away the cached component matrices and products, so that the next evaluate recomputes them.
+        You only need this if you change something that the system can't see, like changing an array
+        property in place or swapping out a component's function.
+
+        Inputs:
+        names   -   A list of the component names to invalidate. Default is all of them.
+        '''
+        n_mms = len(self.mueller_matrix_list)
+
+        if names is None or not hasattr(self, '_component_mms'):
+            self._component_mms = [None] * n_mms
+            self._property_dicts = [None] * n_mms
+            self._property_versions = [None] * n_mms
+            self._prefix = [np.eye(4, dtype=self.dtype)] + [None] * n_mms
+            self._suffix = [None] * n_mms + [np.eye(4, dtype=self.dtype)]
+            self._prefix_valid = 0
+            self._suffix_valid = n_mms
+            self._last_changed = -1
+            self._system_mm = None
+        else:
+            for i, name in enumerate(self.names):
+                if name in names:
+                    self._property_dicts[i] = None
+
+    def _product(self, a, b, key):
+        '''
+        a @ b, in an array of the workspace when the result is a stack
+        '''
+        if a.ndim == 2 and b.ndim == 2:
+            return a @ b
+        shape = np.broadcast_shapes(a.shape[:-2], b.shape[:-2]) + (4, 4)
+        return np.matmul(a, b, out=self.workspace.get((id(self), key), shape, self.dtype))
+
+    def set_dtype(self, dtype):
+        '''
+        Change the type of the evaluated matrices, e.g. to np.float32 for big batched evaluations. The components make
+        their stacks of matrices in this type (see MuellerMatrix.dtype) and all the products are done in it.
+        The single 4x4 component matrices are still computed in float64 and then rounded.
+
+        See precision.py for how big the float32 errors are.
+
+        Inputs:
+        dtype   -   np.float64 (the default) or np.float32
+        '''
+        self.dtype = np.dtype(dtype)
+        for _, mm in self._named_components():
+            mm.dtype = self.dtype
+        self.invalidate()
+
+    def enable_workspace(self, workspace=None):
+        '''
+        Keep the intermediate arrays of batched evaluations (the component stacks and the prefix and suffix products,
+        see evaluate) in a workspace and reuse them from one evaluation to the next, rather than allocating new ones.
+        This saves the allocations (and the page faults of touching new memory) when a big batch with the same shape is
+        evaluated over and over, e.g. in a fit.
+
+        The matrices returned by evaluate and evaluate_row are still copies, so they can be kept.
+
+        Kwargs:
+        workspace   -   A precision.Workspace to use, e.g. one shared by several systems. Default is a new one.
+
+        Returns:
+        The precision.Workspace
+        '''
+        from pyMuellerMat.precision import Workspace
+
+        if workspace is None:
+            workspace = Workspace()
+        self.workspace = workspace
+        for _, mm in self._named_components():
+            mm.workspace = workspace
+        return workspace
+
+    def disable_workspace(self):
+        '''
+        Stop using the workspace (see enable_workspace)
+        '''
+        self.workspace = None
+        for _, mm in self._named_components():
+            mm.workspace = None
+
+    def enable_stats(self, trace_memory=False):
+        '''
+        Start collecting evaluation statistics in self.stats (see profiling.py). If they're already on they're reset.
+
+        Kwargs:
+        trace_memory    -   If True also measure the peak memory of each component evaluation with tracemalloc
+                            (this is slow, so the times won't mean much). It needs Python 3.9 or later.
 
-    def invert():
+        Returns:
+        stats   -   The new profiling.EvaluationStats object
         '''
-        A function that returns the inverse of the current mueller matrix, self.mm
+        self.disable_stats()
+        self.stats = profiling.EvaluationStats(self.names, trace_memory=trace_memory)
+        if self.stats.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.stats._started_tracing = True
+        return self.stats
+
+    def disable_stats(self):
+        '''
+        Stop collecting evaluation statistics.
+
+        Returns:
+        stats   -   The statistics collected so far (or None if they weren't on)
+        '''
+        stats = self.stats
+        self.stats = None
+        if stats is not None and getattr(stats, '_started_tracing', False):
+            tracemalloc.stop()
+        return stats
+
+    @contextmanager
+    def profile(self, trace_memory=False):
+        '''
+        A context manager that collects evaluation statistics for a block of code:
+
+            with sys_mm.profile() as stats:
+                ...
+            print(stats)
+
+        Kwargs:
+        trace_memory    -   See enable_stats
+        '''
+        stats = self.enable_stats(trace_memory=trace_memory)
+        try:
+            yield stats
+        finally:
+            self.disable_stats()
+
+    def enable_cache(self, cache_size=128, names=None):
+        '''
+        Turn on the evaluation cache of the component mueller matrices (see MuellerMatrix.enable_cache).
+        This is most useful for components whose properties rarely change during a fit.
+
+        The cache keys are the property values, so changing an entry of master_property_dict (directly or through
+        new_property_dict) automatically invalidates the cached matrix of that component.
+
+        Inputs:
+        cache_size  -   The maximum number of mueller matrices to keep for each component
+        names       -   A list of the component names to turn the cache on for. Default is all of them.
+        '''
+        for name, mm in self._named_components():
+            if names is None or name in names:
+                mm.enable_cache(cache_size)
+
+    def disable_cache(self, names=None):
+        '''
+        Turn off the evaluation cache for the components in names (default is all of them).
+        '''
+        for name, mm in self._named_components():
+            if names is None or name in names:
+                mm.disable_cache()
+
+    def clear_cache(self, names=None):
+        '''
+        Empty the evaluation cache for the components in names (default is all of them).
+        '''
+        for name, mm in self._named_components():
+            if names is None or name in names:
+                mm.clear_cache()
+
+    def cache_info(self):
+        '''
+        Returns a dictionary with the cache statistics of each component, of the form
+        {name: {'hits': n_hits, 'misses': n_misses, 'size': n_cached, 'cache_size': max_size}}
+        '''
+        info = {}
+        for name, mm in self._named_components():
+            info[name] = {'hits': mm.cache_hits, 'misses': mm.cache_misses,
+                          'size': len(mm._cache), 'cache_size': mm.cache_size}
+        return info
+
+    def jacobian(self, free_params, new_property_dict=None):
+        '''
+        Evaluate the derivatives of the system mueller matrix with respect to a list of properties.
+
+        Each derivative is found with the product rule: if the property belongs to the component Mi then
+            d(M0 @ ... @ M(n-1))/dp = (M0 @ ... @ M(i-1)) @ dMi/dp @ (M(i+1) @ ... @ M(n-1))
+        where the products on either side are the prefix and suffix products that evaluate keeps around,
+        so the whole jacobian costs about as much as one evaluation plus two matrix multiplications per property.
+
+        Inputs:
+        free_params         -   A list of 'name.property' strings (see compile)
+        new_property_dict   -   An optional property dictionary to update the system with first (see evaluate)
+
+        Returns:
+        jac     -   An array of shape (len(free_params),) + mm.shape, where jac[j] is the derivative of the
+                    system mueller matrix with respect to free_params[j]
+        '''
+        mm = self.evaluate(new_property_dict)
+        self._complete_products()
+
+        jac = np.zeros((len(free_params),) + mm.shape)
+        for j, param in enumerate(free_params):
+            i, key = self._split_param_name(param)
+            d_mm = self.mueller_matrix_list[i].derivative(key)
+            jac[j] = self._prefix[i] @ d_mm @ self._suffix[i + 1]
+
+        return jac
+
+    def _complete_products(self):
+        '''
+        Make sure that all the cached prefix and suffix products are up to date (see evaluate)
+        '''
+        n_mms = len(self.mueller_matrix_list)
+        for k in range(self._prefix_valid, n_mms):
+            self._prefix[k + 1] = self._prefix[k] @ self._component_mms[k]
+        self._prefix_valid = n_mms
+
+        for k in range(self._suffix_valid - 1, -1, -1):
+            self._suffix[k] = self._component_mms[k] @ self._suffix[k + 1]
+        self._suffix_valid = 0
+
+    def optimize(self, rules=('rotation', 'retarder')):
+        '''
+        Make a version of this system where runs of adjacent components that have a simple combined mueller matrix
+        are evaluated as one (see fusion.py): consecutive rotators, pairs of UV sign flips, and retarders at
+        the same angle. This saves matrix multiplications on every full or batched evaluation.
+
+        The optimized system shares the components and master_property_dict with this one, so it has the same
+        property names and changing a property of one changes the other.
+
+        Kwargs:
+        rules   -   The kinds of runs to fuse: 'rotation' (rotators and pairs of UV sign flips) and/or 'retarder'
+
+        Returns:
+        A fusion.FusedSystemMuellerMatrix. Its matmuls_saved and fusions properties say what was fused.
+        '''
+        from pyMuellerMat.fusion import FusedSystemMuellerMatrix
+        return FusedSystemMuellerMatrix(self, rules=rules)
+
+    def compile(self, free_params):
+        '''
+        Make a fast callable version of this system where only the properties in free_params can change.
+        All the other properties are frozen at their current values.
+
+        For example:
+            model = sys_mm.compile(['flc.phi', 'hwp.delta_theta', 'Periscope.epsilon'])
+            mm = model([np.pi, 0.5, 0.01])
+
+        Inputs:
+        free_params -   A list of 'name.property' strings, where name is a component name and property one of its properties
+
+        Returns:
+        A CompiledSystemMuellerMatrix
+        '''
+        return CompiledSystemMuellerMatrix(self, free_params)
+
+    def _named_components(self):
+        '''
+        The (name, MuellerMatrix) pairs of the components, in order
+        '''
+        return zip(self.names, self.mueller_matrix_list)
+
+    def _split_param_name(self, param):
+        '''
+        Split a 'name.property' string into the component index and the property name.
+        The component name can contain dots, the property name can't.
         '''
+        name, _, key = param.rpartition('.')
+        if name not in self.names:
+            raise ValueError("'{}' does not name a component of this system (from '{}')".format(name, param))
+        index = self.names.index(name)
+        if key not in self.master_property_dict[name]:
+            raise ValueError("The component '{}' doesn't have a property '{}'".format(name, key))
+        return index, key
+
+    def invert(self, new_property_dict=None, pseudo=False):
+        '''
+        A function that returns the inverse of the system mueller matrix.
+
+        If every component has a closed-form inverse (see MuellerMatrix.invert) then the inverse is multiplied
+        out in the reverse order, (M0 @ M1 @ ... @ M(n-1))^-1 = M(n-1)^-1 @ ... @ M0^-1, which is exact for
+        the orthogonal components and needs no matrix factorizations. Otherwise the system mueller matrix
+        (or stack of them) is inverted numerically in one batched call.
+
+        Inputs:
+        new_property_dict   -   An optional property dictionary to update the system with first (see evaluate)
+        pseudo              -   If True return the pseudo-inverse instead. Systems with a polarizer or a wollaston
+                                prism are always singular, so they need this.
+
+        Returns:
+        mm_inv  -   An array with the same shape as the system mueller matrix.
+                    Raises np.linalg.LinAlgError if the system mueller matrix is singular and pseudo is False.
+        '''
+        mm = self.evaluate(new_property_dict)
+
+        if not pseudo and all(component.function in common_mm_functions.inverse_functions
+                              for component in self.mueller_matrix_list):
+            mm_inv = np.eye(4)
+            for component in self.mueller_matrix_list[::-1]:
+                mm_inv = mm_inv @ component.invert()
+            return mm_inv
+
+        return common_mm_functions.invert_mueller_matrix(mm, pseudo=pseudo)
 
     def print_properties():
         '''
@@ -228,6 +1619,186 @@ class SystemMuellerMatrix(object):
 
         # print(self.master_property_list)
 
+class CompiledSystemMuellerMatrix(object):
+    '''
+    A fast, callable version of a SystemMuellerMatrix where only a few named properties can change.
+    You'll normally make these with SystemMuellerMatrix.compile.
+
+    When compiled, all the properties that aren't free are frozen at their current values, and each run of
+    components without free properties is multiplied out into a single constant matrix. Calling the object
+    then only evaluates the components with free properties, with no dictionaries or name lookups.
+    Recompile if you change any of the frozen properties.
+    '''
+
+    def __init__(self, system, free_params):
+        '''
+        Inputs:
+        system      -   The SystemMuellerMatrix to compile
+        free_params -   A list of 'name.property' strings for the free properties (see SystemMuellerMatrix.compile)
+
+        Class properties:
+
+        free_params -   The list of free parameter names, in the order they're expected in x
+        x0          -   The current values of the free parameters
+        '''
+        self.free_params = list(free_params)
+
+        # Figure out which component each free parameter belongs to
+        free_keys = {}
+        self.x0 = np.zeros(len(self.free_params))
+        for j, param in enumerate(self.free_params):
+            index, key = system._split_param_name(param)
+            free_keys.setdefault(index, []).append((key, j))
+            self.x0[j] = system.master_property_dict[system.names[index]][key]
+
+        # Step through the chain, multiplying the runs of frozen components together. Each free component is stored
+        # with the list of positional arguments of its function and where to put the free parameters in that list.
+        #
+        # After this the chain is: self._leading @ F0 @ C0 @ F1 @ C1 @ ... where Fi is the ith free component and Ci
+        # is the constant matrix after it (or None if there isn't one).
+        self._leading = None
+        self._free_components = []
+        constant = None
+        for i, component in enumerate(system.mueller_matrix_list):
+            properties = system.master_property_dict[system.names[i]]
+
+            if i not in free_keys:
+                component.properties = properties
+                mm = np.asarray(component._evaluate_properties(), dtype=float)
+                constant = mm if constant is None else constant @ mm
+                continue
+
+            if len(self._free_components) == 0:
+                self._leading = constant
+            else:
+                self._free_components[-1]['constant'] = constant
+            constant = None
+
+            # The frozen arguments, with any dispersion laws already applied
+            component.properties = properties
+            function_properties = component._function_properties()
+            args = [function_properties[key] for key in component.function_property_list]
+            arg_indices = []
+            arg_laws = []
+            theta_indices = []
+            for key, j in free_keys[i]:
+                if key in ('theta', 'delta_theta'):
+                    theta_indices.append(j)
+                elif key == 'wavelength':
+                    raise ValueError("The wavelength of '{}' can't be a free parameter".format(system.names[i]))
+                else:
+                    position = component.function_property_list.index(key)
+                    arg_indices.append((position, j))
+
+                    # Free wavelength dependent properties go through their dispersion law at the current wavelength
+                    if key in component.dispersion:
+                        law, law_kwargs = component.dispersion[key]
+                        arg_laws.append((position, law, properties['wavelength'], law_kwargs))
+
+            # The frozen part of the rotation angle
+            theta = 0.
+            for key in ('theta', 'delta_theta'):
+                if key not in [free_key for free_key, _ in free_keys[i]]:
+                    theta = theta + properties[key]
+
+            self._free_components.append({'function': component.function,
+                                          'vectorized_function': common_mm_functions.vectorized_functions.get(component.function),
+                                          'property_list': component.function_property_list,
+                                          'args': args,
+                                          'arg_indices': arg_indices,
+                                          'arg_laws': arg_laws,
+                                          'theta': theta,
+                                          'theta_indices': theta_indices,
+                                          'constant': None})
+
+        if len(self._free_components) == 0:
+            self._leading = constant
+        else:
+            self._free_components[-1]['constant'] = constant
+
+        if self._leading is None:
+            self._leading = np.eye(4)
+
+    def __call__(self, x):
+        '''
+        Evaluate the system mueller matrix for one set of free parameters.
+
+        Inputs:
+        x   -   A sequence of the free parameter values, in the same order as free_params
+
+        Returns:
+        mm  -   The 4x4 system mueller matrix
+        '''
+        mm = self._leading
+        for component in self._free_components:
+            args = component['args']
+            for position, j in component['arg_indices']:
+                args[position] = x[j]
+            for position, law, wavelength, law_kwargs in component['arg_laws']:
+                args[position] = law(args[position], wavelength, **law_kwargs)
+            component_mm = component['function'](*args)
+
+            theta = component['theta']
+            for j in component['theta_indices']:
+                theta = theta + x[j]
+            if theta != 0:
+                component_mm = common_mm_functions.rotate_mueller_matrix(component_mm, theta)
+
+            mm = mm @ component_mm
+            if component['constant'] is not None:
+                mm = mm @ component['constant']
+
+        # Make sure we never hand back one of our own matrices
+        if len(self._free_components) == 0:
+            mm = mm.copy()
+
+        return mm
+
+    def batch(self, x):
+        '''
+        Evaluate the system mueller matrix for many sets of free parameters at once.
+
+        Inputs:
+        x   -   An array of shape (N, n_free) of the free parameter values
+
+        Returns:
+        mm  -   An array of shape (N, 4, 4)
+        '''
+        x = np.asarray(x, dtype=float)
+        n = x.shape[0]
+
+        mm = np.broadcast_to(self._leading, (n, 4, 4))
+        for component in self._free_components:
+            kwargs = dict(zip(component['property_list'], component['args']))
+            for position, j in component['arg_indices']:
+                kwargs[component['property_list'][position]] = x[:, j]
+            for position, law, wavelength, law_kwargs in component['arg_laws']:
+                key = component['property_list'][position]
+                kwargs[key] = law(kwargs[key], wavelength, **law_kwargs)
+
+            if len(component['arg_indices']) == 0:
+                component_mm = np.asarray(component['function'](**kwargs), dtype=float)
+            elif component['vectorized_function'] is not None:
+                component_mm = component['vectorized_function'](**kwargs)
+            else:
+                component_mm = np.empty((n, 4, 4))
+                for i in range(n):
+                    component_mm[i] = component['function'](**{key: value[i] if np.ndim(value) > 0 else value
+                                                                for key, value in kwargs.items()})
+
+            theta = component['theta']
+            for j in component['theta_indices']:
+                theta = theta + x[:, j]
+            if np.ndim(theta) > 0 or theta != 0:
+                component_mm = common_mm_functions.rotate_mueller_matrix(component_mm, theta)
+
+            mm = np.matmul(mm, component_mm)
+            if component['constant'] is not None:
+                mm = np.matmul(mm, component['constant'])
+
+        return np.array(mm)
+
+
 # class MeasurementMatrix:
 # 	'''
 # 	This is a similar structure to how we evaluate GPI data.
@@ -0,0 +1,767 @@
+'''
+Timing and memory benchmarks for pyMuellerMat.
+
+Run this file directly to print the results:
+
+    python -m pyMuellerMat.benchmarks                          # run everything
+    python -m pyMuellerMat.benchmarks --only element system    # only the benchmarks whose names contain these
+    python -m pyMuellerMat.benchmarks --save results.json      # save the results to compare against later
+    python -m pyMuellerMat.benchmarks --compare results.json   # flag anything that got slower (or bigger)
+
+Each benchmark_* function returns a dictionary of {label: value}, where the values are times per call in
+seconds, or peak memory use in bytes for benchmark_memory. Timings are the best of several repeats, but they
+still vary by ~10% from run to run, so only differences bigger than that are worth worrying about.
+'''
+
+import argparse
+import inspect
+import json
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from pyMuellerMat import common_mm_functions
+from pyMuellerMat import common_mms
+from pyMuellerMat import MuellerMat
+
+
+def time_call(function, n_repeat=5, n_calls=1000):
+    '''
+    Time a function that takes no arguments.
+
+    Inputs:
+    function    -   The function to time
+    n_repeat    -   The number of times to repeat the timing
+    n_calls     -   The number of calls per repeat
+
+    Returns:
+    The best time per call in seconds
+    '''
+    return min(timeit.repeat(function, number=n_calls, repeat=n_repeat)) / n_calls
+
+
+def get_common_mm_classes():
+    '''
+    Returns a list of all the MuellerMatrix child classes defined in common_mms
+    '''
+    return [cls for name, cls in inspect.getmembers(common_mms, inspect.isclass)
+            if issubclass(cls, common_mms.MuellerMat.MuellerMatrix) and cls is not common_mms.MuellerMat.MuellerMatrix]
+
+
+def benchmark_element_evaluate(n_repeat=5, n_calls=2000):
+    '''
+    Time MuellerMatrix.evaluate for every class in common_mms, with a non-zero rotation.
+
+    Returns:
+    A dictionary of the time per evaluate (in seconds) for each class name
+    '''
+    results = {}
+    for cls in get_common_mm_classes():
+        mm = cls()
+        mm.properties['theta'] = 10.
+        results[cls.__name__] = time_call(mm.evaluate, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_construction(n_repeat=5, n_calls=2000):
+    '''
+    Time making each class in common_mms, cloning it, and making and cloning the NACO and VAMPIRES systems.
+
+    Returns:
+    A dictionary of the time per construction (in seconds) for each class or system
+    '''
+    from pyMuellerMat import naco
+
+    results = {}
+    for cls in get_common_mm_classes():
+        results[cls.__name__] = time_call(cls, n_repeat=n_repeat, n_calls=n_calls)
+        mm = cls()
+        results[cls.__name__ + '.clone'] = time_call(mm.clone, n_repeat=n_repeat, n_calls=n_calls)
+
+    for name, make_system in [('naco.make_mm_mmb', naco.make_mm_mmb), ('VAMPIRES system', make_vampires_system)]:
+        results[name] = time_call(make_system, n_repeat=n_repeat, n_calls=n_calls // 4)
+        sys_mm = make_system()
+        sys_mm.evaluate()
+        results[name + ' clone'] = time_call(sys_mm.clone, n_repeat=n_repeat, n_calls=n_calls // 4)
+
+    return results
+
+
+def benchmark_system_evaluate(chain_lengths=(2, 3, 5, 10, 15, 20), n_repeat=5, n_calls=200):
+    '''
+    Time SystemMuellerMatrix.evaluate from scratch (every component re-evaluated) and with nothing changed,
+    for chains of retarders of different lengths.
+
+    Returns:
+    A dictionary of the time per evaluate (in seconds) for each chain length
+    '''
+    results = {}
+    for n_components in chain_lengths:
+        sys_mm = make_chain(n_components)
+
+        def evaluate_all():
+            sys_mm.invalidate()
+            sys_mm.evaluate()
+
+        results['{} components'.format(n_components)] = time_call(evaluate_all, n_repeat=n_repeat, n_calls=n_calls)
+        results['{} components, unchanged'.format(n_components)] = time_call(sys_mm.evaluate, n_repeat=n_repeat,
+                                                                             n_calls=n_calls)
+
+    return results
+
+
+def make_chain(n_components):
+    '''
+    Make a SystemMuellerMatrix that is a chain of n_components retarders named 'M0', 'M1', etc.
+    '''
+    mm_list = []
+    for i in range(n_components):
+        mm = common_mms.Retarder(name='M{}'.format(i))
+        mm.properties['phi'] = 0.1 * (i + 1)
+        mm.properties['theta'] = 5. * i
+        mm_list.append(mm)
+    return MuellerMat.SystemMuellerMatrix(mm_list)
+
+
+def make_vampires_system(dtype=float):
+    '''
+    Make a SystemMuellerMatrix like the VAMPIRES calibration model in Notebooks/vampires_calibration_model.ipynb
+    (see SystemMuellerMatrix for dtype)
+    '''
+    wollaston = common_mms.WollastonPrism()
+
+    flc = common_mms.Retarder(name='flc')
+    flc.properties['phi'] = 2 * np.pi * 0.5
+
+    optics = common_mms.DiattenuatorRetarder(name='Periscope')
+    optics.properties['epsilon'] = 0.01
+
+    image_rotator = common_mms.Retarder(name='image_rotator')
+    image_rotator.properties['phi'] = 2 * np.pi * 0.31
+
+    hwp = common_mms.Retarder(name='hwp')
+    hwp.properties['phi'] = 2 * np.pi * 0.43
+
+    return MuellerMat.SystemMuellerMatrix([wollaston, flc, optics, image_rotator, hwp], dtype=dtype)
+
+
+VAMPIRES_FREE_PARAMS = ['flc.phi', 'hwp.delta_theta', 'Periscope.epsilon']
+
+
+def benchmark_naco(n_angles=(1, 100, 10000), n_repeat=5, n_calls=20):
+    '''
+    Time the NACO system from naco.make_mm_mmb over a set of parallactic angles, as in a fit of the NACO
+    instrumental polarization: the first row of the system for new values of the four NACO parameters.
+
+    Returns:
+    A dictionary of the time per evaluation (in seconds) for each number of angles
+    '''
+    from pyMuellerMat import naco
+
+    sys_mm = naco.make_mm_mmb()
+    x = np.array([0.01, -0.01, 0.93, -0.2])
+    step = iter(np.tile(np.linspace(0, 1e-3, 10), n_repeat * n_calls * len(n_angles)))
+
+    results = {}
+    for n in n_angles:
+        angles = np.linspace(0, 180, n) if n > 1 else 30.
+
+        def fit_step():
+            dx = next(step)
+            sys_mm.evaluate_row({'NACO': {'ip_q': x[0] + dx, 'ip_u': x[1], 'u_eff': x[2], 'uq_crosstalk': x[3]},
+                                 'Rotator': {'pa': angles}})
+
+        results['{} angles'.format(n)] = time_call(fit_step, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_fusion(n_batch=10000, n_repeat=5, n_calls=200):
+    '''
+    Time a VAMPIRES-like system with a telescope on an alt-az mount (an 'altitude' and a 'sky_pa' rotator) and
+    a pair of quarter-wave plates next to the HWP, with and without SystemMuellerMatrix.optimize: a full evaluation,
+    a batch of frames with different altitudes and parallactic angles, and changing the HWP angle (which re-evaluates
+    the whole run of retarders, and leaves them at different angles).
+
+    Returns:
+    A dictionary of the time per evaluation (in seconds) for each case
+    '''
+    def make_system():
+        sys_mm = make_vampires_system()
+        components = list(sys_mm.mueller_matrix_list)
+        qwps = [common_mms.QWP(name='qwp1'), common_mms.QWP(name='qwp2')]
+        rotators = [common_mms.Rotator(name='altitude'), common_mms.Rotator(name='sky_pa')]
+        rotators[0].properties['pa'] = 40.
+        return MuellerMat.SystemMuellerMatrix(components[:-1] + qwps + components[-1:] + rotators)
+
+    parallactic_angles = np.linspace(-60, 60, n_batch)
+    altitudes = np.linspace(30, 80, n_batch)
+
+    results = {}
+    for label, sys_mm in [('original', make_system()), ('optimized', make_system().optimize())]:
+        def evaluate_all():
+            sys_mm.invalidate()
+            sys_mm.evaluate()
+
+        results['full evaluate, ' + label] = time_call(evaluate_all, n_repeat=n_repeat, n_calls=n_calls)
+        results['{} frames, {}'.format(n_batch, label)] = time_call(
+            lambda: sys_mm.evaluate({'altitude': {'pa': altitudes}, 'sky_pa': {'pa': parallactic_angles}}),
+            n_repeat=n_repeat, n_calls=n_calls // 20)
+
+        hwp_angles = iter(np.tile(np.linspace(0, 90, 16), n_repeat * n_calls))
+        results['HWP angle change, ' + label] = time_call(
+            lambda: sys_mm.evaluate({'hwp': {'theta': next(hwp_angles)}, 'altitude': {'pa': 40.}, 'sky_pa': {'pa': 0.}}),
+            n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def make_double_difference_data(n_hwp, n_frames):
+    '''
+    Make a DoubleDifferenceModel of the VAMPIRES system and some observing angles: n_hwp HWP angles for each of
+    n_frames image rotator angles, as in a VAMPIRES calibration dataset
+
+    Returns:
+    model, hwp_angles, imrot_angles
+    '''
+    from pyMuellerMat.forward_model import DoubleDifferenceModel
+
+    model = DoubleDifferenceModel(make_vampires_system())
+    hwp_angles = np.linspace(0, 90, n_hwp, endpoint=False)[:, None]
+    imrot_angles = np.linspace(45, 135, n_frames)[None, :]
+    return model, hwp_angles, imrot_angles
+
+
+def benchmark_double_difference(sizes=((16, 8), (16, 256), (4, 4096)), n_repeat=3, n_calls=5):
+    '''
+    Time the VAMPIRES double difference model for different numbers of HWP angles and image rotator angles,
+    including computing a chi squared against some fake data (what a calibration fit does for every step).
+
+    Returns:
+    A dictionary of the time per model evaluation (in seconds) for each (n_hwp, n_frames)
+    '''
+    stokes = np.array([1., 0.1, -0.05, 0.])
+
+    results = {}
+    for n_hwp, n_frames in sizes:
+        model, hwp_angles, imrot_angles = make_double_difference_data(n_hwp, n_frames)
+        data = model.evaluate(stokes, hwp_angles, imrot_angles)['double_diff']
+
+        def chi_squared():
+            result = model.evaluate(stokes, hwp_angles, imrot_angles)
+            return np.sum((result['double_diff'] - data) ** 2)
+
+        results['{} HWP x {} frames'.format(n_hwp, n_frames)] = time_call(chi_squared, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_log_likelihood(sizes=((32, 16, 16), (64, 16, 8)), n_repeat=3, n_calls=5):
+    '''
+    Time one step of an emcee fit of the FLC retardance and the HWP offset of the VAMPIRES system to double
+    difference data: the log-likelihood of every walker, with DoubleDifferenceLogLikelihood evaluating all the
+    walkers at once and with one model evaluation per walker.
+
+    Returns:
+    A dictionary of the time per step (in seconds) for each (n_walkers, n_hwp, n_frames)
+    '''
+    from pyMuellerMat.likelihood import DoubleDifferenceLogLikelihood
+
+    stokes = np.array([1., 0.1, -0.05, 0.])
+    free_params = ['flc.phi', 'hwp.delta_theta']
+    truth = np.array([1.02 * np.pi, 3.])
+
+    results = {}
+    for n_walkers, n_hwp, n_frames in sizes:
+        model, hwp_angles, imrot_angles = make_double_difference_data(n_hwp, n_frames)
+        data = model.evaluate(stokes, hwp_angles, imrot_angles, params=dict(zip(free_params, truth)))
+        log_likelihood = DoubleDifferenceLogLikelihood(model, free_params, data, 0.01, stokes, hwp_angles, imrot_angles)
+        x = truth + np.random.default_rng(0).normal(0, 0.05, (n_walkers, len(free_params)))
+
+        label = '{} walkers, {} x {}'.format(n_walkers, n_hwp, n_frames)
+        results[label + ', vectorized'] = time_call(lambda: log_likelihood(x), n_repeat=n_repeat, n_calls=n_calls)
+        results[label + ', per walker'] = time_call(lambda: log_likelihood.evaluate_loop(x), n_repeat=n_repeat,
+                                                    n_calls=1)
+
+    return results
+
+
+def peak_memory(function):
+    '''
+    Measure the peak memory allocated while calling a function that takes no arguments, with tracemalloc.
+    If tracemalloc is already on before Python 3.9 (without tracemalloc.reset_peak), the peak can be an earlier one.
+
+    Returns:
+    The peak memory in bytes
+    '''
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+
+def benchmark_memory():
+    '''
+    Measure the peak memory use (the high-water mark) of the batched evaluations: a long batch of the VAMPIRES
+    system, the double difference model at a realistic size, a broadband evaluation and demodulating a stack of frames.
+
+    Returns:
+    A dictionary of the peak memory (in bytes) for each case
+    '''
+    from pyMuellerMat.streaming import demodulate_frames
+
+    results = {}
+
+    sys_mm = make_vampires_system()
+    angles = np.linspace(0, 90, 100000)
+    results['VAMPIRES system, 1e5 angles'] = peak_memory(lambda: sys_mm.evaluate({'hwp': {'theta': angles}}))
+
+    # The same in float32 with a workspace, after a first evaluation has made the workspace's arrays
+    sys_mm = make_vampires_system(dtype=np.float32)
+    sys_mm.enable_workspace()
+    sys_mm.evaluate({'hwp': {'theta': angles[::-1]}})
+    results['VAMPIRES system, 1e5 angles, float32 + workspace'] = peak_memory(
+        lambda: sys_mm.evaluate({'hwp': {'theta': angles}}))
+
+    model, hwp_angles, imrot_angles = make_double_difference_data(16, 256)
+    results['double difference, 16 x 256'] = peak_memory(
+        lambda: model.evaluate(np.array([1., 0., 0., 0.]), hwp_angles, imrot_angles))
+
+    sys_mm = make_vampires_system()
+    sys_mm.mueller_matrix_list[sys_mm.names.index('hwp')].set_dispersion('phi', 'inverse', wavelength0=700.)
+    sys_mm.master_property_dict['hwp']['theta'] = np.linspace(0, 90, 64)
+    results['bandpass, 32 x 64'] = peak_memory(lambda: sys_mm.evaluate_bandpass(np.linspace(625, 725, 32)))
+
+    n_frames = 16
+    frames = np.ones((n_frames, 128, 128))
+    frame_properties = {'hwp.theta': np.repeat(np.linspace(0, 90, 4, endpoint=False), 4),
+                        'flc.theta': np.tile([0., 45., 0., 45.], 4),
+                        'WollastonPrism.beam': np.tile(['o', 'o', 'e', 'e'], 4)}
+    pixel_properties = {'hwp.phi': np.full((128, 128), np.pi)}
+    results['demodulate_frames, 16x128x128'] = peak_memory(
+        lambda: demodulate_frames(make_vampires_system(), frames, frame_properties, pixel_properties, tile_size=4096))
+
+    return results
+
+
+def benchmark_compiled(n_repeat=5, n_calls=500, n_batch=10000):
+    '''
+    Time evaluating the VAMPIRES system as a function of three free parameters, using evaluate(new_property_dict),
+    the compiled system, and the batched compiled system.
+
+    Returns:
+    A dictionary of the time per evaluation (in seconds) for each method
+    '''
+    sys_mm = make_vampires_system()
+    model = sys_mm.compile(VAMPIRES_FREE_PARAMS)
+    x = np.array([np.pi, 0.5, 0.01])
+    xs = np.tile(x, (n_batch, 1))
+
+    def evaluate_dict():
+        sys_mm.evaluate({'flc': {'phi': x[0]}, 'hwp': {'delta_theta': x[1]}, 'Periscope': {'epsilon': x[2]}})
+
+    results = {}
+    results['evaluate(new_property_dict)'] = time_call(evaluate_dict, n_repeat=n_repeat, n_calls=n_calls)
+    results['compiled'] = time_call(lambda: model(x), n_repeat=n_repeat, n_calls=n_calls)
+    results['compiled batch'] = time_call(lambda: model.batch(xs), n_repeat=n_repeat, n_calls=1) / n_batch
+
+    return results
+
+
+def benchmark_surrogate(n_points=(1, 64, 10000), n_repeat=5, n_calls=20):
+    '''
+    Time a GridSurrogate of the VAMPIRES system over the FLC retardance, the image rotator retardance and the
+    periscope diattenuation (33 x 33 x 9 grid) against the compiled system, for different numbers of points.
+
+    Returns:
+    A dictionary of the time per call (in seconds) for each method and number of points
+    '''
+    from pyMuellerMat.surrogate import GridSurrogate
+
+    sys_mm = make_vampires_system()
+    sys_mm.master_property_dict['hwp']['theta'] = 22.5
+    sys_mm.master_property_dict['image_rotator']['theta'] = 30.
+    grid = {'flc.phi': np.linspace(2.8, 3.4, 33), 'image_rotator.phi': np.linspace(1.6, 2.3, 33),
+            'Periscope.epsilon': np.linspace(0, 0.05, 9)}
+
+    results = {}
+    results['building the table'] = time_call(lambda: GridSurrogate(sys_mm, grid, n_check=0), n_repeat=n_repeat, n_calls=1)
+    surrogate = GridSurrogate(sys_mm, grid)
+    model = sys_mm.compile(surrogate.free_params)
+    for n in n_points:
+        x = np.random.default_rng(0).uniform(surrogate.lower, surrogate.upper, (n, len(grid)))
+        results['{} points, surrogate'.format(n)] = time_call(lambda: surrogate(x), n_repeat=n_repeat, n_calls=n_calls)
+        results['{} points, compiled batch'.format(n)] = time_call(lambda: model.batch(x), n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_precision(n_samples=200000, n_repeat=3):
+    '''
+    Time a big batch of the VAMPIRES system (new HWP and image rotator angles for each evaluation) in float64 and
+    float32, with and without a workspace (see precision.py).
+
+    Returns:
+    A dictionary of the time per sample (in seconds) for each configuration
+    '''
+    rng = np.random.default_rng(0)
+    hwp_angles = rng.uniform(0, 90, n_samples)
+    imrot_angles = rng.uniform(0, 90, n_samples)
+
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        for use_workspace in [False, True]:
+            sys_mm = make_vampires_system(dtype=dtype)
+            if use_workspace:
+                sys_mm.enable_workspace()
+
+            def evaluate():
+                sys_mm.master_property_dict['hwp']['theta'] = hwp_angles
+                sys_mm.master_property_dict['image_rotator']['theta'] = imrot_angles
+                sys_mm.evaluate()
+
+            label = '{}{}'.format(np.dtype(dtype).name, ', workspace' if use_workspace else '')
+            results[label] = time_call(evaluate, n_repeat=n_repeat, n_calls=1) / n_samples
+
+    return results
+
+
+def benchmark_storage(n_angles=100000, n_repeat=3):
+    '''
+    Time starting up a worker with the VAMPIRES system, a 0.01 degree rotator angle grid and a table of the first row
+    of the system over n_angles HWP angles: computing everything from scratch, against loading it with
+    storage.cached_system.
+
+    Returns:
+    A dictionary of the time per start up (in seconds) for each method
+    '''
+    import shutil
+    import tempfile
+
+    from pyMuellerMat import storage
+
+    hwp_angles = np.linspace(0, 90, n_angles)
+    grids = [(common_mm_functions.rotator_function, 'pa', np.arange(0, 360, 0.01))]
+
+    def start_from_scratch():
+        common_mm_functions.register_angle_grid(*grids[0])
+        sys_mm = make_vampires_system()
+        sys_mm.default_mm
+        sys_mm.evaluate_row({'hwp': {'theta': hwp_angles}})
+
+    def load_grid_and_system():
+        common_mm_functions.unregister_angle_grid(common_mm_functions.rotator_function)
+        storage.load_system(path)
+
+    tables = {'hwp': lambda sys_mm: sys_mm.evaluate_row({'hwp': {'theta': hwp_angles}})}
+    path = tempfile.mkdtemp()
+    results = {}
+    try:
+        results['from scratch'] = time_call(start_from_scratch, n_repeat=n_repeat, n_calls=1)
+        storage.cached_system(path, make_vampires_system, tables=tables, grids=grids)
+        results['cached_system'] = time_call(
+            lambda: storage.cached_system(path, make_vampires_system, tables=tables, grids=grids),
+            n_repeat=n_repeat, n_calls=1)
+        results['load_system'] = time_call(load_grid_and_system, n_repeat=n_repeat, n_calls=1)
+    finally:
+        common_mm_functions.unregister_angle_grid(common_mm_functions.rotator_function)
+        shutil.rmtree(path)
+
+    return results
+
+
+def benchmark_jacobian(n_repeat=5, n_calls=200):
+    '''
+    Time the jacobian of the VAMPIRES system with respect to its free parameters, analytically and with
+    central finite differences of evaluate.
+
+    Returns:
+    A dictionary of the time per jacobian (in seconds) for each method
+    '''
+    sys_mm = make_vampires_system()
+    sys_mm.master_property_dict['hwp']['theta'] = 22.5
+    step = 1e-6
+
+    def finite_differences():
+        for param in VAMPIRES_FREE_PARAMS:
+            name, key = param.split('.')
+            value = sys_mm.master_property_dict[name][key]
+            sys_mm.evaluate({name: {key: value + step}})
+            sys_mm.evaluate({name: {key: value - step}})
+            sys_mm.master_property_dict[name][key] = value
+
+    results = {}
+    results['analytic'] = time_call(lambda: sys_mm.jacobian(VAMPIRES_FREE_PARAMS), n_repeat=n_repeat, n_calls=n_calls)
+    results['finite differences'] = time_call(finite_differences, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_system_single_change(chain_lengths=(2, 5, 10, 20), n_repeat=5, n_calls=500):
+    '''
+    Time SystemMuellerMatrix.evaluate when only the theta of the middle component changes between calls.
+
+    Returns:
+    A dictionary of the time per evaluate (in seconds) for each chain length
+    '''
+    results = {}
+    for n_components in chain_lengths:
+        sys_mm = make_chain(n_components)
+        middle = sys_mm.master_property_dict['M{}'.format(n_components // 2)]
+        angles = iter(np.tile(np.linspace(0, 180, 100), n_repeat * n_calls // 100 + 1))
+
+        def change_and_evaluate():
+            middle['theta'] = next(angles)
+            sys_mm.evaluate()
+
+        results['{} components'.format(n_components)] = time_call(change_and_evaluate, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def benchmark_parallel_scaling(n_workers_list=(1, 2, 4), n_samples=200000, backend='process', n_repeat=3):
+    '''
+    Time parallel_evaluate of the VAMPIRES system over n_samples random HWP and image rotator angles
+    with different numbers of workers.
+
+    Returns:
+    A dictionary of the time per sample (in seconds) for each number of workers
+    '''
+    from pyMuellerMat.parallel import parallel_evaluate
+
+    sys_mm = make_vampires_system()
+    rng = np.random.default_rng(0)
+    values = {'hwp.theta': rng.uniform(0, 90, n_samples), 'image_rotator.theta': rng.uniform(45, 135, n_samples),
+              'flc.theta': rng.choice([0., 45.], n_samples), 'WollastonPrism.beam': rng.choice(['o', 'e'], n_samples)}
+
+    results = {}
+    for n_workers in n_workers_list:
+        results['{} {} workers'.format(n_workers, backend)] = time_call(
+            lambda: parallel_evaluate(sys_mm, values, n_workers=n_workers, backend=backend),
+            n_repeat=n_repeat, n_calls=1) / n_samples
+
+    return results
+
+
+def benchmark_rotation(n_repeat=5, n_calls=2000, n_batch=10000):
+    '''
+    Time rotating a mueller matrix with common_mm_functions.rotate_mueller_matrix against building the
+    rotators and doing two matrix multiplications, for a single angle and for a stack of angles
+    (with and without precomputed trig).
+
+    Returns:
+    A dictionary of the time per rotation (in seconds) for each method
+    '''
+    mm = common_mms.DiattenuatorRetarder().evaluate()
+    pa = 22.5
+    angles = np.random.default_rng(0).uniform(0, 180, n_batch)
+    trig = common_mm_functions.rotation_trig(angles)
+
+    def matmul_single():
+        rotator = common_mm_functions.rotator_function(pa)
+        return rotator.T @ mm @ rotator
+
+    def matmul_batch():
+        rotator = common_mm_functions.rotator_function_vectorized(angles)
+        return np.swapaxes(rotator, -1, -2) @ mm @ rotator
+
+    results = {}
+    results['matmul, single'] = time_call(matmul_single, n_repeat=n_repeat, n_calls=n_calls)
+    results['closed form, single'] = time_call(lambda: common_mm_functions.rotate_mueller_matrix(mm, pa),
+                                               n_repeat=n_repeat, n_calls=n_calls)
+    results['matmul, batch'] = time_call(matmul_batch, n_repeat=n_repeat, n_calls=10) / n_batch
+    results['closed form, batch'] = time_call(lambda: common_mm_functions.rotate_mueller_matrix(mm, angles),
+                                              n_repeat=n_repeat, n_calls=10) / n_batch
+    results['closed form, batch, cached trig'] = time_call(
+        lambda: common_mm_functions.rotate_mueller_matrix(mm, trig=trig), n_repeat=n_repeat, n_calls=10) / n_batch
+
+    return results
+
+
+def benchmark_angle_grid(n_repeat=5, n_calls=2000, n_batch=10000):
+    '''
+    Time evaluating a half-wave plate that steps through the standard HWP angles, with and without
+    registered angle grids for the retardance and the rotation (see common_mm_functions.register_angle_grid).
+
+    Returns:
+    A dictionary of the time per evaluation (in seconds) for each method
+    '''
+    hwp_angles = [0., 22.5, 45., 67.5]
+    hwp = common_mms.Retarder(name='hwp')
+    hwp.properties['phi'] = np.pi
+    angles = iter(np.tile(hwp_angles, n_repeat * n_calls))
+    phis = np.tile([np.pi, np.pi / 2], n_batch // 2)
+
+    def evaluate_single():
+        hwp.properties['theta'] = next(angles)
+        hwp.evaluate()
+
+    def evaluate_function_batch():
+        common_mm_functions.general_retarder_function_vectorized(phis)
+
+    results = {}
+    for use_grid in [False, True]:
+        label = 'grid' if use_grid else 'no grid'
+        if use_grid:
+            common_mm_functions.register_angle_grid(common_mm_functions.rotator_function, 'pa', hwp_angles)
+            grid = common_mm_functions.register_angle_grid(common_mm_functions.general_retarder_function, 'phi',
+                                                           [np.pi / 2, np.pi])
+            evaluate_function_batch = lambda: grid.evaluate({'phi': phis})
+        try:
+            results['evaluate, ' + label] = time_call(evaluate_single, n_repeat=n_repeat, n_calls=n_calls)
+            results['retarder batch, ' + label] = time_call(evaluate_function_batch, n_repeat=n_repeat, n_calls=10) / n_batch
+        finally:
+            common_mm_functions.unregister_angle_grid(common_mm_functions.rotator_function)
+            common_mm_functions.unregister_angle_grid(common_mm_functions.general_retarder_function)
+
+    return results
+
+
+def benchmark_bandpass(n_wavelengths=32, n_hwp=64, n_repeat=5, n_calls=20):
+    '''
+    Time the broadband mueller matrix of a VAMPIRES-like system with a chromatic HWP and FLC, for a set of HWP angles,
+    using SystemMuellerMatrix.evaluate_bandpass and with a loop over the wavelengths.
+
+    Returns:
+    A dictionary of the time per broadband evaluation (in seconds) for each method
+    '''
+    sys_mm = make_vampires_system()
+    for name in ['hwp', 'flc']:
+        sys_mm.mueller_matrix_list[sys_mm.names.index(name)].set_dispersion('phi', 'inverse', wavelength0=700.)
+    sys_mm.master_property_dict['hwp']['theta'] = np.linspace(0, 90, n_hwp)
+
+    wavelengths = np.linspace(625, 725, n_wavelengths)
+    weights = np.exp(-0.5 * ((wavelengths - 675) / 30) ** 2)
+
+    def loop():
+        mm = 0
+        for wavelength, weight in zip(wavelengths, weights):
+            sys_mm.set_wavelength(wavelength)
+            mm = mm + weight * sys_mm.evaluate()
+        return mm / np.sum(weights)
+
+    results = {}
+    results['evaluate_bandpass'] = time_call(lambda: sys_mm.evaluate_bandpass(wavelengths, weights),
+                                             n_repeat=n_repeat, n_calls=n_calls)
+    results['loop over wavelengths'] = time_call(loop, n_repeat=n_repeat, n_calls=n_calls)
+
+    return results
+
+
+def print_results(title, results, unit=1e-6, unit_name='us'):
+    '''
+    Print a dictionary of timing results
+    '''
+    print(title)
+    for name, value in results.items():
+        print("    {:<30s} {:10.2f} {}".format(name, value / unit, unit_name))
+
+
+# The benchmarks that the command line runs, as (name, title, function, unit, unit name)
+BENCHMARKS = [
+    ('construction', "Construction (per object)", benchmark_construction, 1e-6, 'us'),
+    ('element', "MuellerMatrix.evaluate (per call)", benchmark_element_evaluate, 1e-6, 'us'),
+    ('system', "SystemMuellerMatrix.evaluate, all components (per call)", benchmark_system_evaluate, 1e-6, 'us'),
+    ('system_single_change', "SystemMuellerMatrix.evaluate, one component changed (per call)",
+     benchmark_system_single_change, 1e-6, 'us'),
+    ('fusion', "Fusing adjacent rotators and retarders with optimize (per evaluation)", benchmark_fusion, 1e-6, 'us'),
+    ('naco', "NACO system, first row for new parameters (per evaluation)", benchmark_naco, 1e-6, 'us'),
+    ('compiled', "VAMPIRES system with 3 free parameters (per evaluation)", benchmark_compiled, 1e-6, 'us'),
+    ('surrogate', "VAMPIRES system interpolated on a 33 x 33 x 9 grid (per call)", benchmark_surrogate, 1e-6, 'us'),
+    ('storage', "Starting up a worker with the VAMPIRES system and its tables (per start up)", benchmark_storage,
+     1e-3, 'ms'),
+    ('jacobian', "VAMPIRES system jacobian, 3 free parameters (per jacobian)", benchmark_jacobian, 1e-6, 'us'),
+    ('double_difference', "VAMPIRES double difference model and chi squared (per evaluation)",
+     benchmark_double_difference, 1e-3, 'ms'),
+    ('log_likelihood', "emcee log-likelihood of a walker ensemble (per step)", benchmark_log_likelihood, 1e-3, 'ms'),
+    ('rotation', "Rotating a mueller matrix (per matrix)", benchmark_rotation, 1e-9, 'ns'),
+    ('angle_grid', "HWP at the standard angles, with and without angle grids (per matrix)", benchmark_angle_grid,
+     1e-9, 'ns'),
+    ('precision', "VAMPIRES system, 2e5 samples in float64 and float32 (per sample)", benchmark_precision, 1e-9, 'ns'),
+    ('bandpass', "VAMPIRES system, 32 wavelengths x 64 HWP angles (per bandpass)", benchmark_bandpass, 1e-3, 'ms'),
+    ('memory', "Peak memory use", benchmark_memory, 2 ** 20, 'MiB'),
+    ('parallel_process', "VAMPIRES system, parallel_evaluate (per sample)", benchmark_parallel_scaling, 1e-9, 'ns'),
+    ('parallel_thread', "VAMPIRES system, parallel_evaluate (per sample)",
+     lambda: benchmark_parallel_scaling(backend='thread'), 1e-9, 'ns'),
+]
+
+
+def run_benchmarks(only=None, verbose=True):
+    '''
+    Run the benchmarks in BENCHMARKS.
+
+    Inputs:
+    only    -   A list of strings. Only the benchmarks whose names contain one of them are run. Default is all of them.
+    verbose -   If True print the results as they come in
+
+    Returns:
+    A nested dictionary of {benchmark name: {label: value}}
+    '''
+    all_results = {}
+    for name, title, function, unit, unit_name in BENCHMARKS:
+        if only is not None and not any(pattern in name for pattern in only):
+            continue
+        all_results[name] = function()
+        if verbose:
+            print_results(title, all_results[name], unit=unit, unit_name=unit_name)
+
+    return all_results
+
+
+def compare_results(old_results, new_results, tolerance=1.2):
+    '''
+    Compare two sets of results from run_benchmarks (e.g. one loaded from a file saved before a change).
+
+    Inputs:
+    old_results -   The reference results
+    new_results -   The new results
+    tolerance   -   The ratio of new to old above which a result counts as a regression
+
+    Returns:
+    A list of (benchmark name, label, old value, new value) for the regressions
+    '''
+    regressions = []
+    for name, results in new_results.items():
+        for label, value in results.items():
+            old_value = old_results.get(name, {}).get(label)
+            if old_value is not None and old_value > 0 and value / old_value > tolerance:
+                regressions.append((name, label, old_value, value))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the pyMuellerMat benchmarks")
+    parser.add_argument('--only', nargs='+', help="Only run the benchmarks whose names contain these strings: "
+                                                  + ", ".join(benchmark[0] for benchmark in BENCHMARKS))
+    parser.add_argument('--save', help="Save the results to this JSON file")
+    parser.add_argument('--compare', help="Compare the results to the ones saved in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help="The slowdown that counts as a regression when comparing (default 1.2)")
+    args = parser.parse_args()
+
+    all_results = run_benchmarks(only=args.only)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(all_results, f, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        regressions = compare_results(old_results, all_results, tolerance=args.tolerance)
+        print("{} regressions (more than {:.0%} slower or bigger)".format(len(regressions), args.tolerance - 1))
+        for name, label, old_value, value in regressions:
+            print("    {}: {:<30s} {:.3g} -> {:.3g} ({:.2f}x)".format(name, label, old_value, value, value / old_value))
+        if len(regressions) > 0:
+            raise SystemExit(1)
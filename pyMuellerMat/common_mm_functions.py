@@ -5,6 +5,9 @@ common_mms.py will use these functions to create child classes to the MuellerMat
 All sign conventions and coordinate definitions follow Golstein's book on Polarization. 
 '''
 
+import inspect
+import math
+
 import numpy as np
 
 
@@ -205,4 +208,880 @@ def UV_sign_flip_function():
                     [0,1,0,0],
                     [0,0,-1,0],
                     [0,0,0,-1]])
-    return mm
\ No newline at end of file
+    return mm
+
+#############################################
+############# Rotations #####################
+#############################################
+
+# Rotating a mueller matrix M by an angle pa gives R(pa).T @ M @ R(pa), where R is rotator_function(pa).
+# R only mixes Q and U, so rather than building R and doing two 4x4 matrix multiplications we can just
+# mix the second and third rows and columns of M with cos(2 pa) and sin(2 pa).
+
+def rotation_trig(pa):
+    '''
+    The cosine and sine of twice the rotation angle, which is all a rotation needs.
+    Compute these once and pass them to rotate_mueller_matrix to reuse them for the same angles.
+
+    Inputs:
+    pa  -   The rotation angle in degrees (a scalar or an array)
+
+    Returns:
+    (cos2, sin2)    -   cos(2 pa) and sin(2 pa), with the same shape as pa
+    '''
+    # Look the angles up in the rotator grid, if there is one (see register_angle_grid)
+    grid = angle_grids.get(rotator_function)
+    if grid is not None:
+        trig = grid.trig(pa)
+        if trig is not None:
+            return trig
+
+    # (np.ndim is slow for python floats, so check for those first)
+    if isinstance(pa, (float, int)) or np.ndim(pa) == 0:
+        pa_rad = math.radians(2 * pa)
+        return math.cos(pa_rad), math.sin(pa_rad)
+    pa_rad = np.radians(2 * np.asarray(pa, dtype=float))
+    return np.cos(pa_rad), np.sin(pa_rad)
+
+
+def rotate_mueller_matrix(mm, pa=0., trig=None, out=None):
+    '''
+    Rotate a mueller matrix (or a stack of them): returns R(pa).T @ mm @ R(pa), where R is rotator_function(pa).
+
+    Inputs:
+    mm      -   A 4x4 mueller matrix, or an array of shape (..., 4, 4)
+    pa      -   The rotation angle in degrees. Can be an array that broadcasts against mm.shape[:-2].
+    trig    -   Optionally, the output of rotation_trig(pa), so that it doesn't have to be computed again
+    out     -   Optionally, an array of the broadcast shape (..., 4, 4) to put a rotated stack in. It can be mm
+                itself, to rotate it in place.
+
+    Returns:
+    A new array of shape (..., 4, 4) (or out). A stack of float32 matrices stays float32.
+    '''
+    if trig is None:
+        trig = rotation_trig(pa)
+    cos2, sin2 = trig
+
+    # A single matrix: it's quickest to do the arithmetic on python floats
+    if isinstance(cos2, float) and isinstance(mm, np.ndarray) and mm.ndim == 2 and out is None:
+        (m00, m01, m02, m03), (m10, m11, m12, m13), (m20, m21, m22, m23), (m30, m31, m32, m33) = mm.tolist()
+
+        # mm @ R mixes the second and third columns
+        a01, a02 = cos2 * m01 - sin2 * m02, sin2 * m01 + cos2 * m02
+        a11, a12 = cos2 * m11 - sin2 * m12, sin2 * m11 + cos2 * m12
+        a21, a22 = cos2 * m21 - sin2 * m22, sin2 * m21 + cos2 * m22
+        a31, a32 = cos2 * m31 - sin2 * m32, sin2 * m31 + cos2 * m32
+
+        # and R.T @ (mm @ R) mixes the second and third rows
+        return np.array([[m00, a01, a02, m03],
+                         [cos2 * m10 - sin2 * m20, cos2 * a11 - sin2 * a21, cos2 * a12 - sin2 * a22, cos2 * m13 - sin2 * m23],
+                         [sin2 * m10 + cos2 * m20, sin2 * a11 + cos2 * a21, sin2 * a12 + cos2 * a22, sin2 * m13 + cos2 * m23],
+                         [m30, a31, a32, m33]])
+
+    # A stack: the same thing with whole rows and columns at a time, in the type of out (or in float32 if the
+    # stack is float32)
+    if out is not None:
+        dtype = out.dtype
+    elif isinstance(mm, np.ndarray) and mm.dtype == np.float32:
+        dtype = mm.dtype
+    else:
+        dtype = float
+    cos2 = np.asarray(cos2, dtype=dtype)[..., None]
+    sin2 = np.asarray(sin2, dtype=dtype)[..., None]
+    shape = np.broadcast_shapes(np.shape(mm)[:-2], cos2.shape[:-1])
+    if out is None:
+        out = np.empty(shape + (4, 4), dtype=dtype)
+    if out is not mm:
+        out[...] = mm
+
+    column1 = out[..., :, 1].copy()
+    column2 = out[..., :, 2].copy()
+    out[..., :, 1] = cos2 * column1 - sin2 * column2
+    out[..., :, 2] = sin2 * column1 + cos2 * column2
+
+    row1 = out[..., 1, :].copy()
+    row2 = out[..., 2, :].copy()
+    out[..., 1, :] = cos2 * row1 - sin2 * row2
+    out[..., 2, :] = sin2 * row1 + cos2 * row2
+
+    return out
+
+
+#############################################
+############# Vectorized versions ###########
+#############################################
+
+# Each of the functions above has a vectorized counterpart below. They take the same keyword
+# arguments, but each argument can be a scalar or an array. The arguments are broadcast against
+# each other and flattened, and the output is always an array of shape (N,4,4), where N is the
+# size of the broadcast arguments (N=1 if all the arguments are scalars).
+#
+# A preallocated output array of shape (N,4,4) can be passed in with the 'out' keyword. Otherwise a new one is made
+# with the type given by the 'dtype' keyword (np.float32 halves the memory of big stacks, see precision.py).
+# The arguments are always converted to float64, so the only extra error in float32 comes from rounding the output.
+
+def _prepare_output(out, *params, dtype=float):
+    '''
+    Broadcast the parameters against each other, flatten them and get an (N,4,4) output array.
+
+    Inputs:
+    out     -   None or a preallocated array of shape (N,4,4)
+    params  -   The (scalar or array) parameters
+
+    Kwargs:
+    dtype   -   The type of the new output array, if out is None
+
+    Returns:
+    out     -   A zeroed array of shape (N,4,4)
+    params  -   A list of the flattened parameters, each with shape (N,)
+    '''
+    params = np.broadcast_arrays(*[np.asarray(param, dtype=float) for param in params])
+    n = params[0].size if len(params) > 0 else 1
+
+    if out is None:
+        out = np.zeros((n, 4, 4), dtype=dtype)
+    else:
+        if out.shape != (n, 4, 4):
+            raise ValueError("out has shape {} but the parameters need shape {}".format(out.shape, (n, 4, 4)))
+        out[...] = 0
+
+    return out, [param.reshape(n) for param in params]
+
+
+def general_polarizer_function_vectorized(px=1., py=1., out=None, dtype=float):
+    '''
+    The vectorized version of general_polarizer_function. Returns an array of shape (N,4,4).
+    '''
+    out, (px, py) = _prepare_output(out, px, py, dtype=dtype)
+
+    out[:, 0, 0] = 0.5 * (px ** 2 + py ** 2)
+    out[:, 0, 1] = 0.5 * (px ** 2 - py ** 2)
+    out[:, 1, 0] = out[:, 0, 1]
+    out[:, 1, 1] = out[:, 0, 0]
+    out[:, 2, 2] = px * py
+    out[:, 3, 3] = out[:, 2, 2]
+
+    return out
+
+
+def horizontal_polarizer_function_vectorized(out=None, dtype=float):
+    '''
+    The vectorized version of horizontal_polarizer_function. Returns an array of shape (1,4,4).
+    '''
+    return general_polarizer_function_vectorized(px=1., py=0., out=out, dtype=dtype)
+
+
+def vertical_polarizer_function_vectorized(out=None, dtype=float):
+    '''
+    The vectorized version of vertical_polarizer_function. Returns an array of shape (1,4,4).
+    '''
+    return general_polarizer_function_vectorized(px=0., py=1., out=out, dtype=dtype)
+
+
+def wollaston_prism_function_vectorized(beam='o', eta=1., out=None, dtype=float):
+    '''
+    The vectorized version of wollaston_prism_function. Returns an array of shape (N,4,4).
+
+    beam can be a string or an array of 'o' and 'e' strings.
+    '''
+    beam = np.asarray(beam)
+    if not np.all((beam == 'o') | (beam == 'e')):
+        print("For a wollaston prism you must specify a beam of either 'o' or 'e'.")
+        print("Assuming you want 'o' for any other values for now.")
+
+    # If the extraordinary beam then the sign is flipped
+    sign = np.where(beam == 'e', -1., 1.)
+    out, (sign, eta) = _prepare_output(out, sign, eta, dtype=dtype)
+
+    out[:, 0, 0] = 0.5
+    out[:, 0, 1] = 0.5 * sign * eta
+    out[:, 1, 0] = out[:, 0, 1]
+    out[:, 1, 1] = 0.5
+
+    return out
+
+
+def general_retarder_function_vectorized(phi=0., out=None, dtype=float):
+    '''
+    The vectorized version of general_retarder_function. Returns an array of shape (N,4,4).
+    '''
+    out, (phi,) = _prepare_output(out, phi, dtype=dtype)
+
+    out[:, 0, 0] = 1
+    out[:, 1, 1] = 1
+    out[:, 2, 2] = np.cos(phi)
+    out[:, 2, 3] = np.sin(phi)
+    out[:, 3, 2] = -out[:, 2, 3]
+    out[:, 3, 3] = out[:, 2, 2]
+
+    return out
+
+
+def halfwave_retarder_function_vectorized(out=None, dtype=float):
+    '''
+    The vectorized version of halfwave_retarder_function. Returns an array of shape (1,4,4).
+    '''
+    return general_retarder_function_vectorized(phi=np.pi, out=out, dtype=dtype)
+
+
+def quarterwave_retarder_function_vectorized(out=None, dtype=float):
+    '''
+    The vectorized version of quarterwave_retarder_function. Returns an array of shape (1,4,4).
+    '''
+    return general_retarder_function_vectorized(phi=np.pi / 2., out=out, dtype=dtype)
+
+
+def rotator_function_vectorized(pa=0., out=None, dtype=float):
+    '''
+    The vectorized version of rotator_function. Returns an array of shape (N,4,4).
+
+    Kwargs:
+    pa	-	The physical position angle(s) of rotation in degrees.
+    '''
+    out, (pa,) = _prepare_output(out, pa, dtype=dtype)
+
+    pa_rad = np.radians(pa)
+
+    out[:, 0, 0] = 1
+    out[:, 1, 1] = np.cos(2 * pa_rad)
+    out[:, 1, 2] = np.sin(2 * pa_rad)
+    out[:, 2, 1] = -out[:, 1, 2]
+    out[:, 2, 2] = out[:, 1, 1]
+    out[:, 3, 3] = 1
+
+    return out
+
+
+def diattenuator_retarder_function_vectorized(epsilon=1, phi=0., out=None, dtype=float):
+    '''
+    The vectorized version of diattenuator_retarder_function. Returns an array of shape (N,4,4).
+    '''
+    out, (epsilon, phi) = _prepare_output(out, epsilon, phi, dtype=dtype)
+
+    root = np.sqrt(1 - epsilon ** 2)
+
+    out[:, 0, 0] = 1
+    out[:, 0, 1] = epsilon
+    out[:, 1, 0] = epsilon
+    out[:, 1, 1] = 1
+    out[:, 2, 2] = root * np.cos(phi)
+    out[:, 2, 3] = root * np.sin(phi)
+    out[:, 3, 2] = -out[:, 2, 3]
+    out[:, 3, 3] = out[:, 2, 2]
+
+    return out
+
+
+def diattenuator_retarder_function2_vectorized(r1=1., r2=0., delta=0., out=None, dtype=float):
+    '''
+    The vectorized version of diattenuator_retarder_function2. Returns an array of shape (N,4,4).
+    '''
+    out, (r1, r2, delta) = _prepare_output(out, r1, r2, delta, dtype=dtype)
+
+    root = np.sqrt(r1 * r2)
+
+    out[:, 0, 0] = 0.5 * (r1 + r2)
+    out[:, 0, 1] = 0.5 * (r1 - r2)
+    out[:, 1, 0] = out[:, 0, 1]
+    out[:, 1, 1] = out[:, 0, 0]
+    out[:, 2, 2] = root * np.cos(delta)
+    out[:, 2, 3] = -root * np.sin(delta)
+    out[:, 3, 2] = -out[:, 2, 3]
+    out[:, 3, 3] = out[:, 2, 2]
+
+    return out
+
+
+def instrumental_polarization_function_vectorized(IPQ=0, IPU=0, IPV=0, out=None, dtype=float):
+    '''
+    The vectorized version of instrumental_polarization_function. Returns an array of shape (N,4,4).
+    '''
+    out, (IPQ, IPU, IPV) = _prepare_output(out, IPQ, IPU, IPV, dtype=dtype)
+
+    out[:, 0, 0] = 1
+    out[:, 0, 1] = IPQ
+    out[:, 1, 0] = IPQ
+    out[:, 1, 1] = 1
+    out[:, 2, 0] = IPU
+    out[:, 2, 2] = 1
+    out[:, 3, 0] = IPV
+    out[:, 3, 3] = 1
+
+    return out
+
+
+def UV_sign_flip_function_vectorized(out=None, dtype=float):
+    '''
+    The vectorized version of UV_sign_flip_function. Returns an array of shape (1,4,4).
+    '''
+    out, _ = _prepare_output(out, dtype=dtype)
+
+    out[:, 0, 0] = 1
+    out[:, 1, 1] = 1
+    out[:, 2, 2] = -1
+    out[:, 3, 3] = -1
+
+    return out
+
+
+# A lookup table from each function to its vectorized counterpart. MuellerMatrix objects use this
+# to evaluate stacks of mueller matrices in one call. Vectorized versions of your own functions can
+# be added here.
+vectorized_functions = {
+    general_polarizer_function: general_polarizer_function_vectorized,
+    horizontal_polarizer_function: horizontal_polarizer_function_vectorized,
+    vertical_polarizer_function: vertical_polarizer_function_vectorized,
+    wollaston_prism_function: wollaston_prism_function_vectorized,
+    general_retarder_function: general_retarder_function_vectorized,
+    halfwave_retarder_function: halfwave_retarder_function_vectorized,
+    quarterwave_retarder_function: quarterwave_retarder_function_vectorized,
+    rotator_function: rotator_function_vectorized,
+    diattenuator_retarder_function: diattenuator_retarder_function_vectorized,
+    diattenuator_retarder_function2: diattenuator_retarder_function2_vectorized,
+    instrumental_polarization_function: instrumental_polarization_function_vectorized,
+    UV_sign_flip_function: UV_sign_flip_function_vectorized,
+}
+
+
+#############################################
+############# Derivatives ###################
+#############################################
+
+# The analytic derivatives of the functions above with respect to each of their keyword arguments.
+# Each derivative function takes the same keyword arguments as the original function and returns a
+# dictionary of {keyword: 4x4 derivative matrix}. Keywords that can't be differentiated (like the
+# wollaston prism's 'beam') are left out.
+
+def general_polarizer_function_derivative(px=1., py=1.):
+    '''
+    The derivatives of general_polarizer_function with respect to px and py
+    '''
+    d_px = np.array([[px, px, 0, 0],
+                     [px, px, 0, 0],
+                     [0, 0, py, 0],
+                     [0, 0, 0, py]])
+    d_py = np.array([[py, -py, 0, 0],
+                     [-py, py, 0, 0],
+                     [0, 0, px, 0],
+                     [0, 0, 0, px]])
+    return {'px': d_px, 'py': d_py}
+
+
+def wollaston_prism_function_derivative(beam='o', eta=1.):
+    '''
+    The derivative of wollaston_prism_function with respect to eta
+    '''
+    sign = -1. if beam == 'e' else 1.
+    d_eta = 0.5 * np.array([[0, sign, 0, 0],
+                            [sign, 0, 0, 0],
+                            [0, 0, 0, 0],
+                            [0, 0, 0, 0]])
+    return {'eta': d_eta}
+
+
+def general_retarder_function_derivative(phi=0.):
+    '''
+    The derivative of general_retarder_function with respect to phi
+    '''
+    d_phi = np.array([[0, 0, 0, 0],
+                      [0, 0, 0, 0],
+                      [0, 0, -np.sin(phi), np.cos(phi)],
+                      [0, 0, -np.cos(phi), -np.sin(phi)]])
+    return {'phi': d_phi}
+
+
+def rotator_function_derivative(pa=0.):
+    '''
+    The derivative of rotator_function with respect to pa (per degree)
+    '''
+    pa_rad = np.radians(pa)
+    scale = 2 * np.pi / 180.
+    d_pa = scale * np.array([[0, 0, 0, 0],
+                             [0, -np.sin(2 * pa_rad), np.cos(2 * pa_rad), 0],
+                             [0, -np.cos(2 * pa_rad), -np.sin(2 * pa_rad), 0],
+                             [0, 0, 0, 0]])
+    return {'pa': d_pa}
+
+
+def diattenuator_retarder_function_derivative(epsilon=1, phi=0.):
+    '''
+    The derivatives of diattenuator_retarder_function with respect to epsilon and phi.
+    The derivative with respect to epsilon is infinite at epsilon = +-1 (e.g. the default), so it's None there.
+    '''
+    root = np.sqrt(1 - epsilon ** 2)
+
+    if root == 0:
+        d_epsilon = None
+    else:
+        d_root = -epsilon / root
+        d_epsilon = np.array([[0, 1, 0, 0],
+                              [1, 0, 0, 0],
+                              [0, 0, d_root * np.cos(phi), d_root * np.sin(phi)],
+                              [0, 0, -d_root * np.sin(phi), d_root * np.cos(phi)]])
+    d_phi = np.array([[0, 0, 0, 0],
+                      [0, 0, 0, 0],
+                      [0, 0, -root * np.sin(phi), root * np.cos(phi)],
+                      [0, 0, -root * np.cos(phi), -root * np.sin(phi)]])
+    return {'epsilon': d_epsilon, 'phi': d_phi}
+
+
+def _sqrt_product_derivative(a, b):
+    '''
+    The derivative of sqrt(a * b) with respect to a, or None where it's infinite (a = 0 and b != 0)
+    '''
+    if a != 0:
+        return 0.5 * np.sqrt(b / a)
+    return 0. if b == 0 else None
+
+
+def diattenuator_retarder_function2_derivative(r1=1., r2=0., delta=0.):
+    '''
+    The derivatives of diattenuator_retarder_function2 with respect to r1, r2 and delta.
+    The derivative of sqrt(r1 * r2) with respect to r1 is infinite at r1 = 0 (unless r2 = 0 too, when it's 0),
+    and the same for r2 (e.g. at the default r2 = 0), so those derivatives are None there.
+    '''
+    root = np.sqrt(r1 * r2)
+
+    def d_r(d_root, diagonal):
+        if d_root is None:
+            return None
+        return np.array([[0.5, diagonal, 0, 0],
+                         [diagonal, 0.5, 0, 0],
+                         [0, 0, d_root * np.cos(delta), -d_root * np.sin(delta)],
+                         [0, 0, d_root * np.sin(delta), d_root * np.cos(delta)]])
+
+    d_r1 = d_r(_sqrt_product_derivative(r1, r2), 0.5)
+    d_r2 = d_r(_sqrt_product_derivative(r2, r1), -0.5)
+    d_delta = np.array([[0, 0, 0, 0],
+                        [0, 0, 0, 0],
+                        [0, 0, -root * np.sin(delta), -root * np.cos(delta)],
+                        [0, 0, root * np.cos(delta), -root * np.sin(delta)]])
+    return {'r1': d_r1, 'r2': d_r2, 'delta': d_delta}
+
+
+def instrumental_polarization_function_derivative(IPQ=0, IPU=0, IPV=0):
+    '''
+    The derivatives of instrumental_polarization_function with respect to IPQ, IPU and IPV
+    '''
+    d_ipq = np.zeros([4, 4])
+    d_ipq[0, 1] = d_ipq[1, 0] = 1
+    d_ipu = np.zeros([4, 4])
+    d_ipu[2, 0] = 1
+    d_ipv = np.zeros([4, 4])
+    d_ipv[3, 0] = 1
+    return {'IPQ': d_ipq, 'IPU': d_ipu, 'IPV': d_ipv}
+
+
+def _no_derivatives(**kwargs):
+    '''
+    The derivatives of a function with no keyword arguments
+    '''
+    return {}
+
+
+# A lookup table from each function to its derivative function. MuellerMatrix.derivative uses this, and
+# falls back to finite differences for functions that aren't in here. Your own functions can be added here.
+# A derivative that doesn't exist at the given values (e.g. an infinite one) is None.
+derivative_functions = {
+    general_polarizer_function: general_polarizer_function_derivative,
+    horizontal_polarizer_function: _no_derivatives,
+    vertical_polarizer_function: _no_derivatives,
+    wollaston_prism_function: wollaston_prism_function_derivative,
+    general_retarder_function: general_retarder_function_derivative,
+    halfwave_retarder_function: _no_derivatives,
+    quarterwave_retarder_function: _no_derivatives,
+    rotator_function: rotator_function_derivative,
+    diattenuator_retarder_function: diattenuator_retarder_function_derivative,
+    diattenuator_retarder_function2: diattenuator_retarder_function2_derivative,
+    instrumental_polarization_function: instrumental_polarization_function_derivative,
+    UV_sign_flip_function: _no_derivatives,
+}
+
+
+#############################################
+############# Inverses ######################
+#############################################
+
+# The closed-form inverses of the functions above. Each inverse function takes the same keyword arguments
+# as the original function and returns the 4x4 inverse of its mueller matrix. Rotators and retarders are
+# orthogonal, so their inverse is just their transpose, and the diattenuators are block diagonal, so they
+# only need a 2x2 inverse. Functions whose mueller matrices are always singular (the ideal polarizers and the
+# wollaston prism) aren't in here, since they don't have an inverse (use a pseudo-inverse instead).
+#
+# They raise np.linalg.LinAlgError if the matrix is singular for the given keyword arguments, like np.linalg.inv.
+
+def general_polarizer_function_inverse(px=1., py=1.):
+    '''
+    The inverse of general_polarizer_function. It only exists if px and py are both non-zero.
+    '''
+    if px * py == 0:
+        raise np.linalg.LinAlgError("A general polarizer with px={} and py={} is singular".format(px, py))
+
+    # The top left block is [[a, b], [b, a]] with a^2 - b^2 = px^2 py^2
+    mm = 0.5 / (px * py) ** 2 * np.array([[px ** 2 + py ** 2, py ** 2 - px ** 2, 0, 0],
+                                          [py ** 2 - px ** 2, px ** 2 + py ** 2, 0, 0],
+                                          [0, 0, 2 * px * py, 0],
+                                          [0, 0, 0, 2 * px * py]])
+    return mm
+
+
+def general_retarder_function_inverse(phi=0.):
+    '''
+    The inverse of general_retarder_function, which is a retarder with the opposite retardance
+    '''
+    return general_retarder_function(phi=-phi)
+
+
+def halfwave_retarder_function_inverse():
+    '''
+    The inverse of halfwave_retarder_function (a half-wave retarder is its own inverse)
+    '''
+    return general_retarder_function(phi=-np.pi)
+
+
+def quarterwave_retarder_function_inverse():
+    '''
+    The inverse of quarterwave_retarder_function
+    '''
+    return general_retarder_function(phi=-np.pi / 2.)
+
+
+def rotator_function_inverse(pa=0.):
+    '''
+    The inverse of rotator_function, which is a rotation by the opposite angle
+    '''
+    return rotator_function(pa=-pa)
+
+
+def diattenuator_retarder_function_inverse(epsilon=1, phi=0.):
+    '''
+    The inverse of diattenuator_retarder_function. It only exists if |epsilon| < 1.
+    '''
+    if abs(epsilon) >= 1:
+        raise np.linalg.LinAlgError("A diattenuator retarder with epsilon={} is singular".format(epsilon))
+
+    root = np.sqrt(1 - epsilon ** 2)
+    mm = np.array([[1 / root ** 2, -epsilon / root ** 2, 0, 0],
+                   [-epsilon / root ** 2, 1 / root ** 2, 0, 0],
+                   [0, 0, np.cos(phi) / root, -np.sin(phi) / root],
+                   [0, 0, np.sin(phi) / root, np.cos(phi) / root]])
+    return mm
+
+
+def diattenuator_retarder_function2_inverse(r1=1., r2=0., delta=0.):
+    '''
+    The inverse of diattenuator_retarder_function2. It only exists if r1 and r2 are both non-zero.
+    '''
+    if r1 * r2 == 0:
+        raise np.linalg.LinAlgError("A diattenuator retarder with r1={} and r2={} is singular".format(r1, r2))
+
+    # The determinant of the top left block is r1 * r2
+    root = np.sqrt(r1 * r2)
+    mm = np.array([[0.5 * (r1 + r2) / (r1 * r2), -0.5 * (r1 - r2) / (r1 * r2), 0, 0],
+                   [-0.5 * (r1 - r2) / (r1 * r2), 0.5 * (r1 + r2) / (r1 * r2), 0, 0],
+                   [0, 0, np.cos(delta) / root, np.sin(delta) / root],
+                   [0, 0, -np.sin(delta) / root, np.cos(delta) / root]])
+    return mm
+
+
+def instrumental_polarization_function_inverse(IPQ=0, IPU=0, IPV=0):
+    '''
+    The inverse of instrumental_polarization_function. It only exists if |IPQ| != 1.
+
+    The matrix is [[A, 0], [C, I]] in 2x2 blocks, so its inverse is [[A^-1, 0], [-C A^-1, I]].
+    '''
+    det = 1 - IPQ ** 2
+    if det == 0:
+        raise np.linalg.LinAlgError("Instrumental polarization with IPQ={} is singular".format(IPQ))
+
+    mm = np.array([[1 / det, -IPQ / det, 0, 0],
+                   [-IPQ / det, 1 / det, 0, 0],
+                   [-IPU / det, IPU * IPQ / det, 1, 0],
+                   [-IPV / det, IPV * IPQ / det, 0, 1]])
+    return mm
+
+
+def UV_sign_flip_function_inverse():
+    '''
+    The inverse of UV_sign_flip_function (it's its own inverse)
+    '''
+    return UV_sign_flip_function()
+
+
+# A lookup table from each function to its closed-form inverse. MuellerMatrix.invert uses this, and falls back
+# to a numerical inverse for functions that aren't in here. Your own functions can be added here.
+inverse_functions = {
+    general_polarizer_function: general_polarizer_function_inverse,
+    general_retarder_function: general_retarder_function_inverse,
+    halfwave_retarder_function: halfwave_retarder_function_inverse,
+    quarterwave_retarder_function: quarterwave_retarder_function_inverse,
+    rotator_function: rotator_function_inverse,
+    diattenuator_retarder_function: diattenuator_retarder_function_inverse,
+    diattenuator_retarder_function2: diattenuator_retarder_function2_inverse,
+    instrumental_polarization_function: instrumental_polarization_function_inverse,
+    UV_sign_flip_function: UV_sign_flip_function_inverse,
+}
+
+
+def invert_mueller_matrix(mm, pseudo=False):
+    '''
+    Numerically invert a mueller matrix, or a stack of them, in one batched call.
+
+    Inputs:
+    mm      -   A 4x4 mueller matrix, or an array of shape (..., 4, 4)
+    pseudo  -   If True return the Moore-Penrose pseudo-inverse, which also exists for singular matrices
+                (like polarizers). Otherwise use the regular inverse, which raises np.linalg.LinAlgError
+                if any of the matrices are singular.
+
+    Returns:
+    mm_inv  -   An array with the same shape as mm
+    '''
+    mm = np.asarray(mm, dtype=float)
+    if pseudo:
+        return np.linalg.pinv(mm)
+    return np.linalg.inv(mm)
+
+
+#############################################
+############# Angle grids ###################
+#############################################
+
+# Observing sequences usually step through a few discrete angles (e.g. HWP angles of 0, 22.5, 45 and 67.5 degrees)
+# thousands of times. An AngleGrid precomputes the mueller matrices of a function over a grid of values of one of
+# its keyword arguments, so evaluating it at a grid value is just a lookup. Values that aren't on the grid are
+# computed directly, as usual.
+#
+# Register a grid with register_angle_grid, e.g.
+#     register_angle_grid(general_retarder_function, 'phi', [np.pi / 2, np.pi])
+#     register_angle_grid(rotator_function, 'pa', [0., 22.5, 45., 67.5])
+# MuellerMatrix objects look up their function in angle_grids whenever they're evaluated. The grid for
+# rotator_function is also used for the rotation (theta) of every mueller matrix (see rotation_trig).
+#
+# The lookups are by exact value, so 22.5 is on the grid but 22.5 + 1e-12 isn't.
+
+def grid_fixed_kwargs(function, key, fixed_kwargs):
+    '''
+    The values of all the keyword arguments of a function except key: their defaults, unless they're in fixed_kwargs
+    '''
+    all_fixed_kwargs = {name: parameter.default for name, parameter in inspect.signature(function).parameters.items()
+                        if name != key and parameter.default is not inspect.Parameter.empty}
+    for name, value in fixed_kwargs.items():
+        if name not in all_fixed_kwargs:
+            raise ValueError("{} doesn't have a keyword argument '{}'".format(function.__name__, name))
+        all_fixed_kwargs[name] = value
+    return all_fixed_kwargs
+
+
+class AngleGrid(object):
+    '''
+    A table of the mueller matrices of a function over a grid of values of one of its keyword arguments.
+    All the other keyword arguments are fixed (at their defaults, unless given).
+    '''
+
+    def __init__(self, function, key, values, **fixed_kwargs):
+        '''
+        Inputs:
+        function        -   A mueller matrix function (like general_retarder_function)
+        key             -   The name of the keyword argument that the grid is over (like 'phi')
+        values          -   The grid values of that keyword argument
+        fixed_kwargs    -   Values of the other keyword arguments. The grid is only used when they match.
+        '''
+        self.function = function
+        self.key = key
+
+        # The fixed values of all the other keyword arguments
+        self.fixed_kwargs = grid_fixed_kwargs(function, key, fixed_kwargs)
+
+        # Sort the grid, so we can find values with a binary search
+        self.values = np.unique(np.asarray(values, dtype=float))
+        self._index = {value: i for i, value in enumerate(self.values.tolist())}
+
+        self.matrices = np.array([function(**dict(self.fixed_kwargs, **{key: value})) for value in self.values], dtype=float)
+        self.matrices.flags.writeable = False
+
+        # For rotator grids: cos(2 pa) and sin(2 pa) as python floats, for quick scalar lookups (see trig)
+        self._trig = list(zip(self.matrices[:, 1, 1].tolist(), self.matrices[:, 1, 2].tolist()))
+
+    @classmethod
+    def from_matrices(cls, function, key, values, matrices, fixed_kwargs):
+        '''
+        Make a grid from matrices that have already been computed (e.g. loaded from disk, see storage.py),
+        without evaluating the function.
+
+        Inputs:
+        function        -   The mueller matrix function
+        key             -   The name of the keyword argument that the grid is over
+        values          -   The sorted, unique grid values
+        matrices        -   The mueller matrices at those values, with shape (len(values), 4, 4). They can be
+                            a read-only memory-mapped array, which is used as it is.
+        fixed_kwargs    -   The values of all the other keyword arguments (as in the fixed_kwargs property)
+        '''
+        grid = object.__new__(cls)
+        grid.function = function
+        grid.key = key
+        grid.fixed_kwargs = dict(fixed_kwargs)
+        grid.values = np.asarray(values, dtype=float)
+        grid._index = {value: i for i, value in enumerate(grid.values.tolist())}
+        grid.matrices = matrices
+        grid.matrices.flags.writeable = False
+        grid._trig = list(zip(matrices[:, 1, 1].tolist(), matrices[:, 1, 2].tolist()))
+        return grid
+
+    def find(self, values):
+        '''
+        Find where some values are on the grid.
+
+        Returns:
+        indices     -   The index of each value in self.values (0 if it's not on the grid)
+        on_grid     -   A boolean array of whether each value is on the grid
+        '''
+        values = np.asarray(values, dtype=float)
+        indices = np.minimum(np.searchsorted(self.values, values), len(self.values) - 1)
+        on_grid = self.values[indices] == values
+        return np.where(on_grid, indices, 0), on_grid
+
+    def _scalar_index(self, value):
+        '''
+        The index of a scalar value (a number or a 0-d array) in the grid, or None if it isn't on the grid
+        '''
+        try:
+            return self._index.get(float(value))
+        except (TypeError, ValueError):
+            return None
+
+    def evaluate(self, kwargs):
+        '''
+        Evaluate the function using the grid.
+
+        Inputs:
+        kwargs  -   The keyword arguments for the function. The grid keyword can be a scalar or an array,
+                    the other keyword arguments must match the fixed ones.
+
+        Returns:
+        mm  -   A 4x4 matrix or an array of shape (..., 4, 4), or None if the grid can't be used for these
+                keyword arguments (i.e. a scalar that isn't on the grid, or different fixed keyword arguments)
+        '''
+        for name, value in self.fixed_kwargs.items():
+            other = kwargs.get(name, value)
+            if other is not value and (isinstance(other, np.ndarray) or other != value):
+                return None
+
+        value = kwargs[self.key]
+        if isinstance(value, (float, int)) or np.ndim(value) == 0:
+            index = self._scalar_index(value)
+            return None if index is None else self.matrices[index].copy()
+
+        indices, on_grid = self.find(value)
+        mm = self.matrices[indices]
+
+        # Compute the values that aren't on the grid directly
+        if not np.all(on_grid):
+            off_grid_kwargs = dict(self.fixed_kwargs, **{self.key: np.asarray(value, dtype=float)[~on_grid]})
+            vectorized_function = vectorized_functions.get(self.function)
+            if vectorized_function is not None:
+                mm[~on_grid] = vectorized_function(**off_grid_kwargs)
+            else:
+                mm[~on_grid] = [self.function(**dict(self.fixed_kwargs, **{self.key: off_grid_value}))
+                                for off_grid_value in off_grid_kwargs[self.key]]
+
+        return mm
+
+    def trig(self, pa):
+        '''
+        The output of rotation_trig(pa) for a rotator_function grid, looked up from the grid where possible.
+        Returns None for a scalar that isn't on the grid.
+        '''
+        if isinstance(pa, (float, int)) or np.ndim(pa) == 0:
+            index = self._scalar_index(pa)
+            return None if index is None else self._trig[index]
+
+        indices, on_grid = self.find(pa)
+        cos2 = self.matrices[indices, 1, 1]
+        sin2 = self.matrices[indices, 1, 2]
+        if not np.all(on_grid):
+            pa_rad = np.radians(2 * np.asarray(pa, dtype=float)[~on_grid])
+            cos2[~on_grid] = np.cos(pa_rad)
+            sin2[~on_grid] = np.sin(pa_rad)
+        return cos2, sin2
+
+
+# The registered angle grids, keyed by function (see register_angle_grid)
+angle_grids = {}
+
+
+def register_angle_grid(function, key, values, **fixed_kwargs):
+    '''
+    Precompute the mueller matrices of a function over a grid of values of one of its keyword arguments,
+    and use them whenever a MuellerMatrix with that function is evaluated (see AngleGrid).
+    Each function can have one grid, registering a new one replaces the old one.
+
+    Returns:
+    The AngleGrid
+    '''
+    angle_grids[function] = AngleGrid(function, key, values, **fixed_kwargs)
+    return angle_grids[function]
+
+
+def unregister_angle_grid(function):
+    '''
+    Stop using the angle grid for a function
+    '''
+    angle_grids.pop(function, None)
+
+
+#############################################
+############# Dispersion laws ###############
+#############################################
+
+# How a property (like a retardance or a diattenuation) changes with wavelength. Each law takes the value of the
+# property at the reference wavelength wavelength0 and returns its value at another wavelength. The wavelength can
+# be a numpy array, which gives an array of values. Use the same units for wavelength and wavelength0.
+#
+# MuellerMatrix.set_dispersion uses these to make a property wavelength dependent. Your own laws can be added
+# to dispersion_laws, or passed to set_dispersion directly.
+
+def constant_dispersion(value, wavelength, wavelength0=1.):
+    '''
+    No dispersion: the property is the same at every wavelength
+    '''
+    return value
+
+
+def inverse_dispersion(value, wavelength, wavelength0=1.):
+    '''
+    A retardance that comes from a fixed optical path difference (i.e. a birefringence that doesn't change
+    with wavelength), so it scales as 1/wavelength:
+        value * wavelength0 / wavelength
+    '''
+    return value * wavelength0 / wavelength
+
+
+def cauchy_dispersion(value, wavelength, wavelength0=1., b=0.):
+    '''
+    A retardance whose birefringence follows a two term Cauchy law, delta_n = A + B / wavelength^2:
+        value * (wavelength0 / wavelength) * (1 + b / wavelength^2) / (1 + b / wavelength0^2)
+
+    Kwargs:
+    b   -   The ratio of the two Cauchy coefficients, B / A, in units of wavelength^2. b=0 is the same as inverse_dispersion.
+    '''
+    return value * (wavelength0 / wavelength) * (1 + b / wavelength ** 2) / (1 + b / wavelength0 ** 2)
+
+
+def linear_dispersion(value, wavelength, wavelength0=1., slope=0.):
+    '''
+    A property that changes linearly with wavelength (e.g. a diattenuation over a narrow band):
+        value + slope * (wavelength - wavelength0)
+
+    Kwargs:
+    slope   -   The change in the property per unit wavelength
+    '''
+    return value + slope * (wavelength - wavelength0)
+
+
+# The dispersion laws by name, for MuellerMatrix.set_dispersion
+dispersion_laws = {
+    'constant': constant_dispersion,
+    'inverse': inverse_dispersion,
+    'cauchy': cauchy_dispersion,
+    'linear': linear_dispersion,
+}
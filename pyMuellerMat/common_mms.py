@@ -58,28 +58,57 @@ class WollastonPrism(MuellerMat.MuellerMatrix):
 class Retarder(MuellerMat.MuellerMatrix):
     '''
     A MuellerMat.MuellerMatrix child class for a general polarizer
+
+    If wavelength0 is given then the retardance phi is wavelength dependent, following the dispersion law
+    'dispersion' (see MuellerMatrix.set_dispersion), and phi is its value at wavelength0.
     '''
 
-    def __init__(self, name='Retarder', phi=0):
+    def __init__(self, name='Retarder', phi=0, wavelength0=None, dispersion='inverse'):
         super(Retarder, self).__init__(general_retarder_function, name=name)
+        if wavelength0 is not None:
+            self.set_dispersion('phi', dispersion, wavelength0=wavelength0)
 
 
 class HWP(MuellerMat.MuellerMatrix):
     '''
     A MuellerMat.MuellerMatrix child class for a half-wave polarizer
+
+    If wavelength0 is given then it's a general retarder that is half-wave at wavelength0, with a retardance phi
+    that follows the dispersion law 'dispersion' (see MuellerMatrix.set_dispersion).
     '''
 
-    def __init__(self, name='HalfwaveRetarder'):
-        super(HWP, self).__init__(halfwave_retarder_function, name=name)
+    def __init__(self, name='HalfwaveRetarder', wavelength0=None, dispersion='inverse'):
+        if wavelength0 is None:
+            super(HWP, self).__init__(halfwave_retarder_function, name=name)
+        else:
+            super(HWP, self).__init__(general_retarder_function, name=name)
+            _make_chromatic_retarder(self, np.pi, wavelength0, dispersion)
 
 
 class QWP(MuellerMat.MuellerMatrix):
     '''
     A MuellerMat.MuellerMatrix child class for a quarter-wave polarizer
+
+    If wavelength0 is given then it's a general retarder that is quarter-wave at wavelength0, with a retardance phi
+    that follows the dispersion law 'dispersion' (see MuellerMatrix.set_dispersion).
     '''
 
-    def __init__(self, name='QuarterwaveRetarder'):
-        super(QWP, self).__init__(quarterwave_retarder_function, name=name)
+    def __init__(self, name='QuarterwaveRetarder', wavelength0=None, dispersion='inverse'):
+        if wavelength0 is None:
+            super(QWP, self).__init__(quarterwave_retarder_function, name=name)
+        else:
+            super(QWP, self).__init__(general_retarder_function, name=name)
+            _make_chromatic_retarder(self, np.pi / 2., wavelength0, dispersion)
+
+
+def _make_chromatic_retarder(mm, phi, wavelength0, dispersion):
+    '''
+    Turn a MuellerMatrix with general_retarder_function into a wavelength dependent retarder with
+    retardance phi at wavelength0, and make that the default.
+    '''
+    mm.default_property_dict['phi'] = phi
+    mm.properties['phi'] = phi
+    mm.set_dispersion('phi', dispersion, wavelength0=wavelength0)
 
 
 #################################
@@ -99,10 +128,16 @@ class Rotator(MuellerMat.MuellerMatrix):
 class DiattenuatorRetarder(MuellerMat.MuellerMatrix):
     '''
     A MuellerMat.MuellerMatrix child class for a diattenuator retarder (Goldstein)
+
+    If wavelength0 is given then the retardance phi and the diattenuation epsilon are wavelength dependent,
+    following the dispersion laws 'dispersion' and 'diattenuation_dispersion' (see MuellerMatrix.set_dispersion).
     '''
 
-    def __init__(self, name='DiattenuatorRetarder'):
+    def __init__(self, name='DiattenuatorRetarder', wavelength0=None, dispersion='inverse', diattenuation_dispersion='constant'):
         super(DiattenuatorRetarder, self).__init__(diattenuator_retarder_function, name=name)
+        if wavelength0 is not None:
+            self.set_dispersion('phi', dispersion, wavelength0=wavelength0)
+            self.set_dispersion('epsilon', diattenuation_dispersion, wavelength0=wavelength0)
 
 
 class DiattenuatorRetarder2(MuellerMat.MuellerMatrix):
@@ -0,0 +1,102 @@
+'''
+Least-squares demodulation of measured intensities back into Stokes vectors.
+
+Each measurement (e.g. one HWP angle, FLC state and wollaston beam) sees the intensity
+
+    intensity = measurement_matrix[m] @ stokes
+
+where measurement_matrix[m] is the first row of the system mueller matrix for that measurement. Stacking all
+the measurements gives a (n_measurements, 4) measurement matrix, and the Stokes vector is the least-squares
+solution of measurement_matrix @ stokes = intensities.
+
+When the measurement matrix is the same for every pixel it is pseudo-inverted once. When it changes from pixel
+to pixel (shape (..., n_measurements, 4)) the normal equations
+
+    (A.T @ W @ A) @ stokes = A.T @ W @ intensities
+
+are formed for all the pixels at once and solved with a single batched 4x4 solve, which is much faster than
+a batched pseudo-inverse. The normal equations square the condition number of the measurement matrix, which
+is fine for any sensible polarimeter (a condition number of ~1e3 still leaves ~10 digits).
+'''
+
+import numpy as np
+
+from pyMuellerMat.forward_model import evaluate_with_params
+
+
+def build_measurement_matrix(system, values):
+    '''
+    Build the measurement matrix of a system for a set of measurements.
+
+    Inputs:
+    system  -   The SystemMuellerMatrix of the instrument
+    values  -   A dictionary of {'name.property': values} for the properties that change between measurements,
+                e.g. {'hwp.theta': hwp_angles, 'WollastonPrism.beam': beams}. The measurements go along the
+                last axis, so use shape (n_measurements,) for a single measurement matrix, or
+                (..., n_measurements) for a different one per pixel.
+
+    Returns:
+    An array of shape (..., n_measurements, 4)
+    '''
+    values = {param: np.asarray(value) for param, value in values.items()}
+    rows = evaluate_with_params(system, values, row=True)
+    shape = np.broadcast_shapes(*[value.shape for value in values.values()])
+    return np.broadcast_to(rows, shape + (4,))
+
+
+def demodulation_matrix(measurement_matrix, weights=None):
+    '''
+    The matrix that turns intensities into Stokes vectors, i.e. the (weighted) pseudo-inverse of the measurement matrix.
+
+    Inputs:
+    measurement_matrix  -   An array of shape (n_measurements, 4), or (..., n_measurements, 4) for a different
+                            measurement matrix per pixel
+    weights             -   Optional weights for each measurement (e.g. the inverse variances), with a shape that
+                            broadcasts against (..., n_measurements)
+
+    Returns:
+    An array of shape (..., 4, n_measurements)
+    '''
+    measurement_matrix = np.asarray(measurement_matrix, dtype=float)
+    weighted = measurement_matrix if weights is None else measurement_matrix * np.asarray(weights)[..., None]
+
+    # A single measurement matrix: the SVD is cheap and the most accurate
+    if measurement_matrix.ndim == 2 and weights is None:
+        return np.linalg.pinv(measurement_matrix)
+
+    normal_matrix = np.einsum('...mi,...mj->...ij', weighted, measurement_matrix)
+    return np.linalg.solve(normal_matrix, np.swapaxes(weighted, -1, -2))
+
+
+def demodulate(measurement_matrix, intensities, weights=None):
+    '''
+    Find the least-squares Stokes vectors for some measured intensities.
+
+    Inputs:
+    measurement_matrix  -   An array of shape (n_measurements, 4), or (..., n_measurements, 4) for a different
+                            measurement matrix per pixel (see build_measurement_matrix)
+    intensities         -   The measured intensities, with the measurements along the last axis: (..., n_measurements)
+    weights             -   Optional weights for each measurement (e.g. the inverse variances), with a shape that
+                            broadcasts against the intensities
+
+    Returns:
+    stokes  -   The Stokes vectors, with shape (..., 4)
+    '''
+    measurement_matrix = np.asarray(measurement_matrix, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+    n_measurements = intensities.shape[-1]
+
+    # The same measurement matrix for every pixel: one pseudo-inverse, then one big matrix multiplication
+    if measurement_matrix.ndim == 2 and (weights is None or np.ndim(weights) == 1):
+        demod = demodulation_matrix(measurement_matrix, weights=weights)
+        return (intensities.reshape(-1, n_measurements) @ demod.T).reshape(intensities.shape[:-1] + (4,))
+
+    # A different measurement matrix (or weights) for each pixel: solve all the normal equations at once
+    if weights is None:
+        weighted = measurement_matrix
+    else:
+        weighted = measurement_matrix * np.asarray(weights, dtype=float)[..., None]
+    normal_matrix = np.einsum('...mi,...mj->...ij', weighted, measurement_matrix)
+    projected = np.einsum('...mi,...m->...i', weighted, intensities)
+
+    return np.linalg.solve(normal_matrix, projected[..., None])[..., 0]
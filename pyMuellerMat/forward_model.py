@@ -0,0 +1,167 @@
+'''
+A vectorized forward model for dual-beam polarimeters with a modulator, like VAMPIRES.
+
+These instruments measure the two beams of a wollaston prism (the 'o' and 'e' cameras) for two states
+of a modulator (e.g. an FLC at 0 and 45 degrees), over a sequence of HWP, image rotator and parallactic
+angles. The observables are the single and double differences and sums of the measured intensities,
+as in Notebooks/vampires_calibration_model.ipynb.
+
+Rather than looping over every combination, the model sets all the angles, beams and modulator states
+as broadcast arrays on a SystemMuellerMatrix and evaluates everything in one batched call.
+'''
+
+import numpy as np
+
+
+class DoubleDifferenceModel(object):
+    '''
+    A forward model for the intensities, double differences and double sums of a dual-beam polarimeter.
+
+    Each of the things that changes during an observation is a property of a component in the system,
+    given as a 'name.property' string (like in SystemMuellerMatrix.compile).
+    '''
+
+    def __init__(self, system, hwp_param='hwp.theta', imrot_param='image_rotator.theta', parang_param=None,
+                 modulator_param='flc.theta', modulator_states=(0., 45.), beam_param='WollastonPrism.beam',
+                 beams=('o', 'e')):
+        '''
+        Inputs:
+        system              -   The SystemMuellerMatrix of the instrument
+        hwp_param           -   The property that holds the HWP angle
+        imrot_param         -   The property that holds the image rotator angle (or None if there isn't one)
+        parang_param        -   The property that holds the parallactic angle (or None if there isn't one)
+        modulator_param     -   The property that switches between the two modulator states
+        modulator_states    -   The values of modulator_param for the two modulator states
+        beam_param          -   The property that picks the beam of the wollaston prism
+        beams               -   The values of beam_param for the two beams
+        '''
+        self.system = system
+        self.hwp_param = hwp_param
+        self.imrot_param = imrot_param
+        self.parang_param = parang_param
+        self.modulator_param = modulator_param
+        self.modulator_states = np.asarray(modulator_states, dtype=float)
+        self.beam_param = beam_param
+        self.beams = np.asarray(beams)
+
+        # Check that all the properties exist
+        for param in [hwp_param, imrot_param, parang_param, modulator_param, beam_param]:
+            if param is not None:
+                system._split_param_name(param)
+
+    def intensities(self, stokes, hwp_angles, imrot_angles=None, parallactic_angles=None, em_gain_ratio=1.,
+                    params=None):
+        '''
+        Compute the intensities in each beam and modulator state.
+
+        The angle arrays are broadcast against each other (e.g. pass hwp_angles[:, None] and imrot_angles[None, :]
+        for a grid) to give the shape of the observations, obs_shape.
+
+        Inputs:
+        stokes              -   The input Stokes vector(s), with shape (4,) or obs_shape + (4,)
+        hwp_angles          -   The HWP angles in degrees
+        imrot_angles        -   The image rotator angles in degrees (if there's an image rotator)
+        parallactic_angles  -   The parallactic angles in degrees (if there's a parallactic angle component)
+        em_gain_ratio       -   The relative gain of the first beam with respect to the second beam
+        params              -   An optional dictionary of {'name.property': values} for other properties of the
+                                system, e.g. the parameters of a fit. The values are broadcast against each other
+                                to give batch_shape (e.g. (n_walkers,)), and every set of values is evaluated
+                                for all the observations.
+
+        Returns:
+        intensities -   An array of shape (2, 2) + batch_shape + obs_shape, indexed by [beam, modulator state, ...]
+        '''
+        angles = {self.hwp_param: hwp_angles}
+        if imrot_angles is not None:
+            angles[self.imrot_param] = imrot_angles
+        if parallactic_angles is not None:
+            angles[self.parang_param] = parallactic_angles
+        obs_shape = np.broadcast_shapes(*[np.shape(value) for value in angles.values()])
+
+        params = {} if params is None else params
+        batch_shape = np.broadcast_shapes(*[np.shape(value) for value in params.values()])
+
+        # The beams go on the first axis and the modulator states on the second, then the batch and the observations
+        n_obs_dims = len(obs_shape)
+        n_batch_dims = len(batch_shape)
+        values = {self.beam_param: self.beams.reshape((2, 1) + (1,) * (n_batch_dims + n_obs_dims)),
+                  self.modulator_param: self.modulator_states.reshape((1, 2) + (1,) * (n_batch_dims + n_obs_dims))}
+        for param, value in angles.items():
+            values[param] = np.reshape(value, (1, 1) + (1,) * n_batch_dims + np.shape(value))
+        for param, value in params.items():
+            if param in values:
+                raise ValueError("'{}' is already set by the model, so it can't also be in params".format(param))
+            value = np.broadcast_to(value, batch_shape)
+            values[param] = value.reshape((1, 1) + batch_shape + (1,) * n_obs_dims) if n_batch_dims > 0 else value[()]
+
+        # Only the first row of the mueller matrix matters for intensities
+        row = evaluate_with_params(self.system, values, row=True)
+        intensities = np.einsum('...j,...j->...', row, np.asarray(stokes, dtype=float))
+
+        # Broadcast in case some of the angles didn't actually vary
+        intensities = np.broadcast_to(intensities, (2, 2) + batch_shape + obs_shape).copy()
+        intensities[0] *= em_gain_ratio
+
+        return intensities
+
+    def evaluate(self, stokes, hwp_angles, imrot_angles=None, parallactic_angles=None, em_gain_ratio=1., params=None):
+        '''
+        Compute the intensities and the single and double differences and sums.
+
+        The double difference and double sum are normalized by the total intensity:
+            single_diffs = I_o - I_e,  single_sums = I_o + I_e    (for each modulator state)
+            double_diff = (single_diffs[0] - single_diffs[1]) / (single_sums[0] + single_sums[1])
+            double_sum  = (single_diffs[0] + single_diffs[1]) / (single_sums[0] + single_sums[1])
+
+        Inputs:
+        The same as for intensities
+
+        Returns:
+        A dictionary with the keys 'intensities', 'single_diffs', 'single_sums', 'double_diff' and 'double_sum'
+        '''
+        intensities = self.intensities(stokes, hwp_angles, imrot_angles=imrot_angles,
+                                       parallactic_angles=parallactic_angles, em_gain_ratio=em_gain_ratio,
+                                       params=params)
+
+        single_diffs = intensities[0] - intensities[1]
+        single_sums = intensities[0] + intensities[1]
+        total = single_sums[0] + single_sums[1]
+
+        return {'intensities': intensities,
+                'single_diffs': single_diffs,
+                'single_sums': single_sums,
+                'double_diff': (single_diffs[0] - single_diffs[1]) / total,
+                'double_sum': (single_diffs[0] + single_diffs[1]) / total}
+
+
+def evaluate_with_params(system, values, row=False):
+    '''
+    Evaluate a system mueller matrix (or just its first row) with some of its properties temporarily set to
+    new values, then put the properties back the way they were.
+
+    Inputs:
+    system  -   A SystemMuellerMatrix
+    values  -   A dictionary of {'name.property': value}, where the values can be arrays (see SystemMuellerMatrix.evaluate)
+    row     -   If True only evaluate the first row (see SystemMuellerMatrix.evaluate_row)
+
+    Returns:
+    mm      -   The system mueller matrix, with shape (..., 4, 4), or its first row, with shape (..., 4)
+    '''
+    old_values = {}
+    new_property_dict = {}
+    for param, value in values.items():
+        index, key = system._split_param_name(param)
+        name = system.names[index]
+        old_values[(name, key)] = system.master_property_dict[name][key]
+        new_property_dict.setdefault(name, {})[key] = value
+
+    try:
+        if row:
+            mm = system.evaluate_row(new_property_dict)
+        else:
+            mm = system.evaluate(new_property_dict)
+    finally:
+        for (name, key), value in old_values.items():
+            system.master_property_dict[name][key] = value
+
+    return mm
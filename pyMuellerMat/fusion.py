@@ -0,0 +1,351 @@
+'''
+Fusing runs of adjacent components whose combined mueller matrix has a simple closed form.
+
+Systems built from common_mms often contain runs of components that collapse into fewer equivalent elements:
+
+    rotators            -   Rotations commute, so a run of Rotators (e.g. 'altitude' and 'sky_pa' in a K-mirror
+                            model) is a single rotation by the sum of their angles. A rotator's own theta
+                            doesn't change it.
+    UV sign flips       -   A pair of UV_Sign_Flips rotated by theta1 and theta2 is a rotation by 2 (theta2 - theta1),
+                            so they cancel when they have the same angle, and join a neighbouring run of rotators.
+    ideal retarders     -   Retarders (Retarder, HWP, QWP) at the same angle add up to a single retarder with the
+                            sum of their retardances. If their angles turn out to be different, their matrices
+                            are multiplied out as usual.
+
+FusedSystemMuellerMatrix (made by SystemMuellerMatrix.optimize) evaluates each of these runs as one element, so its
+chain of products is shorter. It shares the components and the property dictionaries with the original system,
+so all the property names stay the same.
+
+A fused run is re-evaluated as a whole whenever any of its components changes. Fusing pays off for components that
+change together or are batched together (e.g. the altitude and parallactic angle of every frame), and costs a
+little when only one component of a run changes between evaluations (e.g. stepping a HWP next to a fixed QWP).
+'''
+
+import numpy as np
+
+from pyMuellerMat import common_mm_functions
+from pyMuellerMat import MuellerMat
+
+
+# The functions of the ideal retarders, with a function that returns their retardance
+_retarder_functions = {common_mm_functions.general_retarder_function: lambda function_properties: function_properties['phi'],
+                       common_mm_functions.halfwave_retarder_function: lambda function_properties: np.pi,
+                       common_mm_functions.quarterwave_retarder_function: lambda function_properties: np.pi / 2.}
+
+
+def _evaluate_function(function, vectorized_function, value, key):
+    '''
+    Evaluate a mueller matrix function with one argument that may be an array, as an array of shape (..., 4, 4)
+    '''
+    if np.ndim(value) == 0:
+        return function(**{key: value})
+    return vectorized_function(**{key: value}).reshape(np.shape(value) + (4, 4))
+
+
+def _all_equal(values):
+    '''
+    Are all the values (numbers or arrays) equal?
+    '''
+    first = values[0]
+    for value in values[1:]:
+        try:
+            if not np.all(value == first):
+                return False
+        except ValueError:
+            # Arrays that don't broadcast
+            return False
+    return True
+
+
+class FusedMuellerMatrix(object):
+    '''
+    A run of adjacent components of a system that is evaluated as one element.
+    It has the evaluate method and the name of a MuellerMatrix, so a FusedSystemMuellerMatrix can use it in their place.
+    '''
+
+    def __init__(self, rule, components):
+        '''
+        Inputs:
+        rule        -   'rotation' for a run of rotators and pairs of UV sign flips, or 'retarder' for a run of
+                        ideal retarders
+        components  -   The MuellerMatrix objects in the run, in order
+        '''
+        self.rule = rule
+        self.components = list(components)
+        self.name = '+'.join(str(component.name) for component in self.components)
+        self.mm = None
+
+        # The last matrix of each component, and the properties it was evaluated for, for when the
+        # components have to be multiplied out (see _component_mm)
+        self._component_mms = [None] * len(self.components)
+        self._component_properties = [None] * len(self.components)
+        self._component_versions = [None] * len(self.components)
+
+        # There's no cache or workspace, but the evaluation statistics look for these (see profiling.py)
+        self.cache_hits = 0
+        self.cache_size = 0
+        self.workspace = None
+
+    def evaluate(self):
+        '''
+        Evaluate the combined mueller matrix of the components with their current properties.
+        Returns a 4x4 mueller matrix, or an array of shape (..., 4, 4) if any of the properties are arrays.
+        '''
+        if self.rule == 'rotation':
+            self.mm = self._evaluate_rotation()
+        else:
+            self.mm = self._evaluate_retarders()
+        return self.mm
+
+    def _evaluate_rotation(self):
+        '''
+        The total rotation of a run of rotators and pairs of UV sign flips
+        '''
+        pa = 0.
+        i = 0
+        while i < len(self.components):
+            component = self.components[i]
+            if component.function is common_mm_functions.rotator_function:
+                pa = pa + component._function_properties()['pa']
+                i += 1
+            else:
+                # A pair of UV sign flips
+                first, second = component.properties, self.components[i + 1].properties
+                pa = pa + 2 * ((second['theta'] + second['delta_theta']) - (first['theta'] + first['delta_theta']))
+                i += 2
+
+        return _evaluate_function(common_mm_functions.rotator_function, common_mm_functions.rotator_function_vectorized,
+                                  pa, 'pa')
+
+    def _evaluate_retarders(self):
+        '''
+        A run of ideal retarders: one retarder if they're all at the same angle, otherwise the product of their matrices
+        '''
+        thetas = [component.properties['theta'] + component.properties['delta_theta'] for component in self.components]
+
+        if not _all_equal(thetas):
+            mm = self._component_mm(0)
+            for j in range(1, len(self.components)):
+                mm = mm @ self._component_mm(j)
+            return mm
+
+        phi = 0.
+        for component in self.components:
+            phi = phi + _retarder_functions[component.function](component._function_properties())
+
+        mm = _evaluate_function(common_mm_functions.general_retarder_function,
+                                common_mm_functions.general_retarder_function_vectorized, phi, 'phi')
+        theta = thetas[0]
+        if np.ndim(theta) > 0 or theta != 0:
+            mm = common_mm_functions.rotate_mueller_matrix(mm, theta)
+        return mm
+
+
+    def _component_mm(self, j):
+        '''
+        The mueller matrix of one of the components, only re-evaluated if its properties have changed
+        '''
+        properties = self.components[j].properties
+        version = getattr(properties, 'version', None)
+        if version is None or properties is not self._component_properties[j] or version != self._component_versions[j]:
+            self._component_mms[j] = self.components[j].evaluate()
+            self._component_properties[j] = properties
+            self._component_versions[j] = version
+        return self._component_mms[j]
+
+
+def find_fusions(components, rules=('rotation', 'retarder')):
+    '''
+    Find the runs of components that can be fused.
+
+    Inputs:
+    components  -   A list of MuellerMatrix objects, in the order of the system
+    rules       -   The kinds of runs to look for: 'rotation' (rotators and pairs of UV sign flips) and/or 'retarder'
+
+    Returns:
+    A list of (rule, start, stop) for each run of components[start:stop] that can be fused (see FusedMuellerMatrix)
+    '''
+    def is_rotator(i):
+        return i < len(components) and components[i].function is common_mm_functions.rotator_function
+
+    def is_flip(i):
+        return i < len(components) and components[i].function is common_mm_functions.UV_sign_flip_function
+
+    def is_retarder(i):
+        return i < len(components) and components[i].function in _retarder_functions
+
+    fusions = []
+    i = 0
+    while i < len(components):
+        # A run of rotators and pairs of UV sign flips
+        stop = i
+        while True:
+            if is_rotator(stop):
+                stop += 1
+            elif is_flip(stop) and is_flip(stop + 1):
+                stop += 2
+            else:
+                break
+        if stop - i > 1 and 'rotation' in rules:
+            fusions.append(('rotation', i, stop))
+            i = stop
+            continue
+
+        # A run of ideal retarders
+        stop = i
+        while is_retarder(stop):
+            stop += 1
+        if stop - i > 1 and 'retarder' in rules:
+            fusions.append(('retarder', i, stop))
+            i = stop
+            continue
+
+        i += 1
+
+    return fusions
+
+
+class FusedSystemMuellerMatrix(MuellerMat.SystemMuellerMatrix):
+    '''
+    A SystemMuellerMatrix where the runs of components found by find_fusions are evaluated as single elements.
+    You'll normally make these with SystemMuellerMatrix.optimize.
+
+    names and master_property_dict are the same as the original system's, but mueller_matrix_list is the
+    (shorter) list of elements that are actually multiplied together: the original components and the
+    FusedMuellerMatrix objects. The original components are in self.components.
+
+    The methods that need the components one at a time (jacobian, compile, invert) are passed on to the original
+    system, which shares the same properties.
+
+    Class properties:
+    system          -   The original SystemMuellerMatrix
+    fusions         -   A list of (rule, names) for each fused run of components
+    matmuls_saved   -   The number of matrix multiplications saved on each full evaluation. The retarder runs
+                        only save them while their retarders are at the same angle.
+    '''
+
+    def __init__(self, system, rules=('rotation', 'retarder')):
+        '''
+        Inputs:
+        system  -   The SystemMuellerMatrix to optimize
+        rules   -   The kinds of runs to fuse (see find_fusions)
+        '''
+        self.system = system
+        self.rules = tuple(rules)
+        self.names = system.names
+        self.master_property_dict = system.master_property_dict
+        self.components = system.mueller_matrix_list
+        self.dtype = system.dtype
+        self.workspace = system.workspace
+
+        # Replace each run with one element, and keep track of which components each element is made of
+        self.mueller_matrix_list = []
+        self._members = []
+        self.fusions = []
+        self.matmuls_saved = 0
+        start = 0
+        for rule, fusion_start, fusion_stop in find_fusions(self.components, self.rules) + [(None, len(self.components), None)]:
+            for i in range(start, fusion_start):
+                self.mueller_matrix_list.append(self.components[i])
+                self._members.append([i])
+            if rule is None:
+                break
+            self.mueller_matrix_list.append(FusedMuellerMatrix(rule, self.components[fusion_start:fusion_stop]))
+            self._members.append(list(range(fusion_start, fusion_stop)))
+            self.fusions.append((rule, self.names[fusion_start:fusion_stop]))
+            self.matmuls_saved += fusion_stop - fusion_start - 1
+            start = fusion_stop
+
+        self.invalidate()
+
+        self._default_properties = system._default_properties
+        self._mm = None
+        self._property_vector = None
+        self.stats = None
+
+    @property
+    def default_mm(self):
+        '''
+        The default mueller matrix of the original system (see SystemMuellerMatrix.default_mm)
+        '''
+        return self.system.default_mm
+
+    @default_mm.setter
+    def default_mm(self, default_mm):
+        self.system.default_mm = default_mm
+
+    def clone(self):
+        '''
+        Make an optimized copy of a clone of the original system (see SystemMuellerMatrix.clone)
+        '''
+        return self.system.clone().optimize(rules=self.rules)
+
+    def _named_components(self):
+        return zip(self.names, self.components)
+
+    def _update_component_mms(self):
+        '''
+        Evaluate the elements with a component whose properties have changed since the last evaluation
+        (see SystemMuellerMatrix._update_component_mms).
+        '''
+        stats = self.stats
+        for k, members in enumerate(self._members):
+            property_dicts = [self.master_property_dict[self.names[i]] for i in members]
+            versions = [getattr(properties, 'version', None) for properties in property_dicts]
+
+            # Plain dictionaries can't tell us if they've changed, so they're always re-evaluated
+            old_property_dicts = self._property_dicts[k]
+            if old_property_dicts is not None and all(properties is old_properties for properties, old_properties
+                                                      in zip(property_dicts, old_property_dicts)) \
+                    and None not in versions and versions == self._property_versions[k]:
+                if stats is not None:
+                    stats.skip_component(self.mueller_matrix_list[k].name)
+                continue
+
+            for i, properties in zip(members, property_dicts):
+                self.components[i].properties = properties
+            element = self.mueller_matrix_list[k]
+            if stats is None:
+                element_mm = element.evaluate()
+            else:
+                element_mm = stats.evaluate_component(element.name, element)
+            if not isinstance(element_mm, np.ndarray) or element_mm.dtype != self.dtype:
+                element_mm = np.asarray(element_mm, dtype=self.dtype)
+            self._component_mms[k] = element_mm
+            self._property_dicts[k] = property_dicts
+            self._property_versions[k] = versions
+
+            # The prefixes after this element and the suffixes up to it are out of date
+            self._prefix_valid = min(self._prefix_valid, k)
+            self._suffix_valid = max(self._suffix_valid, k + 1)
+            self._last_changed = max(self._last_changed, k)
+            self._system_mm = None
+
+    def invalidate(self, names=None):
+        '''
+        Throw away the cached element matrices and products (see SystemMuellerMatrix.invalidate)
+        '''
+        if names is None or not hasattr(self, '_component_mms'):
+            super(FusedSystemMuellerMatrix, self).invalidate()
+        else:
+            for k, members in enumerate(self._members):
+                if any(self.names[i] in names for i in members):
+                    self._property_dicts[k] = None
+
+    def jacobian(self, free_params, new_property_dict=None):
+        '''
+        The jacobian of the original system (see SystemMuellerMatrix.jacobian)
+        '''
+        return self.system.jacobian(free_params, new_property_dict=new_property_dict)
+
+    def compile(self, free_params):
+        '''
+        Compile the original system (see SystemMuellerMatrix.compile)
+        '''
+        return self.system.compile(free_params)
+
+    def invert(self, new_property_dict=None, pseudo=False):
+        '''
+        The inverse of the original system (see SystemMuellerMatrix.invert)
+        '''
+        return self.system.invert(new_property_dict=new_property_dict, pseudo=pseudo)
@@ -0,0 +1,151 @@
+'''
+A log-likelihood for fitting a polarimeter model to double difference data with an ensemble sampler like emcee.
+
+The fitting workflow in Notebooks/tmp.py (model -> residuals -> logl -> emcee) evaluates the model once per
+walker per step, setting the free properties on the components each time. DoubleDifferenceLogLikelihood instead
+takes the parameters of all the walkers at once, as an (n_walkers, n_params) array, and evaluates every walker's
+system for every observation in one batched pass of DoubleDifferenceModel. It can be given straight to emcee:
+
+    log_likelihood = DoubleDifferenceLogLikelihood(model, ['flc.phi', 'flc.theta'], data, sigma, stokes,
+                                                   hwp_angles, imrot_angles, bounds={'flc.phi': (0, 2 * np.pi)})
+    sampler = emcee.EnsembleSampler(n_walkers, 2, log_likelihood, vectorize=True)
+
+The components that don't depend on the free parameters are only evaluated once per step, not once per walker,
+and the ones that do are evaluated once per walker rather than once per walker and observation.
+'''
+
+import numpy as np
+
+
+# The number of axes in front of the batch axis of each observable of DoubleDifferenceModel.evaluate: the beam
+# and modulator state of the intensities, and the modulator state of the single differences and sums
+_leading_axes = {'intensities': 2, 'single_diffs': 1, 'single_sums': 1, 'double_diff': 0, 'double_sum': 0}
+
+
+class DoubleDifferenceLogLikelihood(object):
+    '''
+    The Gaussian log-likelihood of some observables of a DoubleDifferenceModel (by default the double differences
+    and double sums), as a function of some free properties of the system.
+    '''
+
+    def __init__(self, model, free_params, data, sigma, stokes, hwp_angles, imrot_angles=None, parallactic_angles=None,
+                 em_gain_ratio=1., observables=('double_diff', 'double_sum'), bounds=None):
+        '''
+        Inputs:
+        model               -   The DoubleDifferenceModel of the instrument
+        free_params         -   A list of 'name.property' strings for the free parameters, in the order of the columns
+                                of x (see SystemMuellerMatrix.compile)
+        data                -   A dictionary of the measured value of each observable, or a single array if there's only
+                                one observable. Each has the shape of the observable for one set of parameters:
+                                (2, 2) + obs_shape for 'intensities', (2,) + obs_shape for 'single_diffs' and
+                                'single_sums', and the shape of the observations, obs_shape, for 'double_diff' and
+                                'double_sum' (see DoubleDifferenceModel.intensities).
+        sigma               -   The uncertainties of the data, in the same form (or a number for all of them)
+        stokes              -   The Stokes vector(s) of the source (see DoubleDifferenceModel.intensities)
+        hwp_angles, imrot_angles, parallactic_angles, em_gain_ratio
+                            -   The observations (see DoubleDifferenceModel.intensities)
+        observables         -   The names of the observables to fit (the keys of DoubleDifferenceModel.evaluate)
+        bounds              -   An optional dictionary of {'name.property': (lower, upper)}. The log-likelihood is
+                                -inf outside the bounds (i.e. a uniform prior).
+        '''
+        self.model = model
+        self.free_params = list(free_params)
+        self.stokes = np.asarray(stokes, dtype=float)
+        self.hwp_angles = hwp_angles
+        self.imrot_angles = imrot_angles
+        self.parallactic_angles = parallactic_angles
+        self.em_gain_ratio = em_gain_ratio
+
+        if isinstance(observables, str):
+            observables = [observables]
+        self.observables = list(observables)
+        for observable in self.observables:
+            if observable not in _leading_axes:
+                raise ValueError("'{}' isn't an observable of DoubleDifferenceModel.evaluate".format(observable))
+        if not isinstance(data, dict):
+            if len(self.observables) != 1:
+                raise ValueError("data must be a dictionary when there's more than one observable")
+            data = {self.observables[0]: data}
+        if not isinstance(sigma, dict):
+            sigma = {observable: sigma for observable in self.observables}
+        self.data = {observable: np.asarray(data[observable], dtype=float) for observable in self.observables}
+
+        # Keep the inverse variances, which is all we need
+        self._inverse_variances = {observable: 1. / np.asarray(sigma[observable], dtype=float) ** 2
+                                   for observable in self.observables}
+
+        # Check that all the free parameters exist
+        for param in self.free_params:
+            model.system._split_param_name(param)
+
+        bounds = {} if bounds is None else bounds
+        self._lower = np.array([bounds.get(param, (-np.inf, np.inf))[0] for param in self.free_params], dtype=float)
+        self._upper = np.array([bounds.get(param, (-np.inf, np.inf))[1] for param in self.free_params], dtype=float)
+
+    def __call__(self, x):
+        '''
+        The log-likelihood for one set of parameters or a whole ensemble of walkers.
+
+        Inputs:
+        x   -   An array of shape (n_params,), or (n_walkers, n_params) (as emcee passes with vectorize=True)
+
+        Returns:
+        logl    -   A number, or an array of shape (n_walkers,)
+        '''
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            return self.evaluate(x[None, :])[0]
+        return self.evaluate(x)
+
+    def evaluate(self, x):
+        '''
+        The log-likelihood of each walker, all evaluated in one batched call of the model.
+
+        Inputs:
+        x   -   An array of shape (n_walkers, n_params)
+
+        Returns:
+        logl    -   An array of shape (n_walkers,)
+        '''
+        x = np.asarray(x, dtype=float)
+        n_walkers = x.shape[0]
+        logl = np.full(n_walkers, -np.inf)
+
+        # Only evaluate the walkers that are inside the bounds
+        inside = np.all((x >= self._lower) & (x <= self._upper), axis=1)
+        if not np.any(inside):
+            return logl
+        x_inside = x[inside]
+
+        params = {param: x_inside[:, j] for j, param in enumerate(self.free_params)}
+        result = self.model.evaluate(self.stokes, self.hwp_angles, imrot_angles=self.imrot_angles,
+                                     parallactic_angles=self.parallactic_angles, em_gain_ratio=self.em_gain_ratio,
+                                     params=params)
+
+        chi_squared = np.zeros(len(x_inside))
+        for observable in self.observables:
+            # Put the walkers first, in front of the beam and modulator state axes
+            residuals = np.moveaxis(result[observable], _leading_axes[observable], 0) - self.data[observable]
+            chi_squared += np.sum((residuals ** 2 * self._inverse_variances[observable]).reshape(len(x_inside), -1),
+                                  axis=1)
+
+        logl[inside] = -0.5 * chi_squared
+        return logl
+
+    def evaluate_loop(self, x):
+        '''
+        The same as evaluate, but evaluating the model once for each walker, as the per-walker workflow does.
+        This is much slower; it's here to check evaluate against and to benchmark it.
+        '''
+        x = np.asarray(x, dtype=float)
+        logl = np.full(x.shape[0], -np.inf)
+        for i, walker_x in enumerate(x):
+            if np.any(walker_x < self._lower) or np.any(walker_x > self._upper):
+                continue
+            params = dict(zip(self.free_params, walker_x))
+            result = self.model.evaluate(self.stokes, self.hwp_angles, imrot_angles=self.imrot_angles,
+                                         parallactic_angles=self.parallactic_angles, em_gain_ratio=self.em_gain_ratio,
+                                         params=params)
+            logl[i] = -0.5 * sum(np.sum((result[observable] - self.data[observable]) ** 2
+                                        * self._inverse_variances[observable]) for observable in self.observables)
+        return logl
@@ -26,6 +26,23 @@ def naco_function_mmb(ip_q = 0, ip_u=0, u_eff=0.93,uq_crosstalk = -0.2 ):
 	return mm_naco
 
 
+def naco_function_mmb_derivative(ip_q = 0, ip_u=0, u_eff=0.93,uq_crosstalk = -0.2 ):
+	'''
+	The derivatives of naco_function_mmb with respect to each of its keyword arguments.
+	'''
+
+	derivatives = {}
+	for key, (row, column) in [('ip_q', (1, 0)), ('ip_u', (2, 0)), ('u_eff', (2, 2)), ('uq_crosstalk', (1, 2))]:
+		derivatives[key] = np.zeros([4,4])
+		derivatives[key][row, column] = 1
+
+	return derivatives
+
+
+# Let MuellerMatrix.derivative know about the analytic derivatives
+cmf.derivative_functions[naco_function_mmb] = naco_function_mmb_derivative
+
+
 class NACO_mmb(MuellerMat.MuellerMatrix):
 	'''
 	A MuellerMat.MuellerMatrix child class for NACO in front of the HWP.
@@ -0,0 +1,174 @@
+'''
+Evaluate a SystemMuellerMatrix over a large number of property values on several cores.
+
+The property arrays are split into chunks along their first axis, and each chunk is evaluated with a
+batched SystemMuellerMatrix.evaluate (or evaluate_row). The results are written into their slice of the
+output array, so the output is always in the same order as the inputs, no matter which worker finishes first.
+
+There are two backends:
+    'process'   -   A pool of processes. The inputs and the output live in shared memory, so only the chunk
+                    boundaries are sent to the workers.
+    'thread'    -   A pool of threads, each with its own copy of the system. This relies on the NumPy kernels
+                    releasing the GIL, so it works best with big chunks.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pyMuellerMat.forward_model import evaluate_with_params
+
+
+def _evaluate_chunk(system, values, start, stop, row):
+    '''
+    Evaluate the system for the elements start:stop of each of the property arrays.
+    Scalar properties are used as they are.
+    '''
+    chunk_values = {param: value[start:stop] if np.ndim(value) > 0 else value for param, value in values.items()}
+    return evaluate_with_params(system, chunk_values, row=row)
+
+
+def _get_chunks(n, n_workers, chunk_size):
+    '''
+    Split range(n) into a list of (start, stop) chunks
+    '''
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(n / (4 * n_workers))))
+    return [(start, min(n, start + chunk_size)) for start in range(0, n, chunk_size)]
+
+
+#### The process pool workers ####
+# Each worker process attaches to the shared memory once, when it starts up, and keeps it here.
+_worker_state = {}
+
+
+def _attach_shared_array(spec):
+    '''
+    Attach to a shared memory block made by _make_shared_array and wrap it in a numpy array
+    '''
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _make_shared_array(shape, dtype):
+    '''
+    Make a numpy array in a new shared memory block
+
+    Returns:
+    shm     -   The SharedMemory object (close and unlink it when you're done)
+    array   -   The numpy array
+    spec    -   What a worker needs to attach to it
+    '''
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, array, (shm.name, shape, dtype.str)
+
+
+def _process_worker_init(system, value_specs, scalar_values, output_spec, row):
+    '''
+    Set up a worker process: keep the system and attach to the shared inputs and output
+    '''
+    shms = []
+    values = dict(scalar_values)
+    for param, spec in value_specs.items():
+        shm, values[param] = _attach_shared_array(spec)
+        shms.append(shm)
+    shm, output = _attach_shared_array(output_spec)
+    shms.append(shm)
+
+    _worker_state.update(system=system, values=values, output=output, row=row, shms=shms)
+
+
+def _process_worker_run(start, stop):
+    '''
+    Evaluate one chunk in a worker process and write it into the shared output
+    '''
+    state = _worker_state
+    result = _evaluate_chunk(state['system'], state['values'], start, stop, state['row'])
+    state['output'][start:stop] = np.broadcast_to(result, state['output'][start:stop].shape)
+
+
+def parallel_evaluate(system, values, n_workers=None, backend='process', chunk_size=None, row=False):
+    '''
+    Evaluate a system over arrays of property values, split across several workers.
+
+    Inputs:
+    system      -   The SystemMuellerMatrix to evaluate
+    values      -   A dictionary of {'name.property': value}. Array values must all have the same length N along
+                    their first axis (e.g. one value per observation). Scalar values are the same for every chunk.
+    n_workers   -   The number of worker processes or threads. Default is os.cpu_count().
+    backend     -   'process' or 'thread' (see the top of this file)
+    chunk_size  -   The number of elements in each chunk. Default splits the work into about 4 chunks per worker.
+    row         -   If True only evaluate the first row of the system mueller matrix (see SystemMuellerMatrix.evaluate_row)
+
+    Returns:
+    output      -   An array of shape (N, 4, 4), or (N, 4) if row is True
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    values = {param: np.asarray(value) for param, value in values.items()}
+    lengths = set(value.shape[0] for value in values.values() if value.ndim > 0)
+    if len(lengths) != 1:
+        raise ValueError("The array values must all have the same length along the first axis, not {}".format(sorted(lengths)))
+    n = lengths.pop()
+    output_shape = (n, 4) if row else (n, 4, 4)
+    chunks = _get_chunks(n, n_workers, chunk_size)
+
+    if backend == 'thread':
+        output = np.empty(output_shape)
+
+        # Each thread gets its own copy of the system, since evaluating changes the system's state
+        systems = [system.clone() for i in range(min(n_workers, len(chunks)))]
+
+        def run(worker):
+            for start, stop in chunks[worker::len(systems)]:
+                result = _evaluate_chunk(systems[worker], values, start, stop, row)
+                output[start:stop] = np.broadcast_to(result, output[start:stop].shape)
+
+        with ThreadPoolExecutor(max_workers=len(systems)) as executor:
+            list(executor.map(run, range(len(systems))))
+
+        return output
+
+    if backend != 'process':
+        raise ValueError("backend must be 'process' or 'thread', not '{}'".format(backend))
+
+    # Put the arrays into shared memory
+    shms = []
+    try:
+        value_specs = {}
+        scalar_values = {}
+        for param, value in values.items():
+            if value.ndim == 0:
+                scalar_values[param] = value
+                continue
+            if value.dtype.hasobject:
+                raise ValueError("'{}' can't be put in shared memory because it's an object array".format(param))
+            shm, shared_value, value_specs[param] = _make_shared_array(value.shape, value.dtype)
+            shared_value[...] = value
+            shms.append(shm)
+            del shared_value
+        shm, shared_output, output_spec = _make_shared_array(output_shape, float)
+        shms.append(shm)
+
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(chunks)), initializer=_process_worker_init,
+                                 initargs=(system, value_specs, scalar_values, output_spec, row)) as executor:
+            futures = [executor.submit(_process_worker_run, start, stop) for start, stop in chunks]
+            for future in futures:
+                future.result()
+
+        output = shared_output.copy()
+
+        # The shared memory can't be closed while there are arrays that point to it
+        del shared_output
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return output
@@ -0,0 +1,195 @@
+'''
+Opt-in instrumentation of SystemMuellerMatrix evaluations, to find out which component makes a fit slow.
+
+Turn it on for a block of code with the SystemMuellerMatrix.profile context manager:
+
+    with sys_mm.profile() as stats:
+        run_the_fit(sys_mm)
+    print(stats)
+
+or with sys_mm.enable_stats() / sys_mm.disable_stats(). While it's on, sys_mm.stats is an EvaluationStats object
+that counts, for each component, how many times it was evaluated, how many times it was skipped because its
+properties hadn't changed, its cache hits (see MuellerMatrix.enable_cache), the time spent evaluating it and the
+number and size of the arrays it allocated (with a workspace, only the arrays the workspace had to make, not the
+ones it reused). It also counts the calls to evaluate and evaluate_row, their total time and the number of matrix
+products they did.
+
+When it's off, sys_mm.stats is None and all that costs is a check of that attribute on each call.
+'''
+
+import functools
+import time
+import tracemalloc
+
+
+def profiled(method):
+    '''
+    A decorator for the SystemMuellerMatrix methods whose calls and time are counted when stats are on
+    '''
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return method(self, *args, **kwargs)
+
+        # Don't count calls made from inside another profiled call twice
+        if stats._depth > 0:
+            return method(self, *args, **kwargs)
+        stats._depth += 1
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.time[name] = stats.time.get(name, 0.) + time.perf_counter() - start
+            stats.calls[name] = stats.calls.get(name, 0) + 1
+            stats._depth -= 1
+
+    return wrapper
+
+
+class ComponentStats(object):
+    '''
+    The statistics for one component of a system.
+
+    Class properties:
+    evaluations -   The number of times the component's mueller matrix was evaluated
+    skipped     -   The number of times it wasn't, because its properties hadn't changed
+    cache_hits  -   The number of evaluations that were answered by the component's cache
+    time        -   The total time spent evaluating it, in seconds
+    arrays      -   The number of new arrays it made for its mueller matrices (or stacks of them). Arrays of a
+                    workspace (see SystemMuellerMatrix.enable_workspace) are only counted when they're made, not
+                    each time they're reused.
+    bytes       -   The total size of those arrays, in bytes
+    peak_memory -   The most memory allocated during any one evaluation, in bytes
+                    (only if the stats were made with trace_memory=True, on Python 3.9 or later)
+    '''
+
+    def __init__(self):
+        self.evaluations = 0
+        self.skipped = 0
+        self.cache_hits = 0
+        self.time = 0.
+        self.arrays = 0
+        self.bytes = 0
+        self.peak_memory = 0
+
+    @property
+    def hit_rate(self):
+        '''
+        The fraction of the times the component was needed that it didn't have to be computed,
+        either because it hadn't changed or because it was in its cache
+        '''
+        requests = self.evaluations + self.skipped
+        if requests == 0:
+            return 0.
+        return (self.skipped + self.cache_hits) / requests
+
+
+class EvaluationStats(object):
+    '''
+    The statistics of a SystemMuellerMatrix (see the top of this file).
+
+    Class properties:
+    components      -   A dictionary of the ComponentStats for each component name
+    calls           -   A dictionary of the number of calls to each profiled method ('evaluate', 'evaluate_row')
+    time            -   A dictionary of the total time spent in each profiled method, in seconds
+    products        -   The number of matrix (or row vector times matrix) products
+    trace_memory    -   Whether the peak memory of each component evaluation is measured with tracemalloc
+    '''
+
+    def __init__(self, names=(), trace_memory=False):
+        '''
+        Inputs:
+        names           -   The names of the components
+        trace_memory    -   If True measure the peak memory of each component evaluation with tracemalloc.
+                            This makes the evaluations a lot slower, so the times aren't meaningful.
+                            It needs tracemalloc.reset_peak (Python 3.9 or later), and is ignored without it.
+        '''
+        self.trace_memory = trace_memory and hasattr(tracemalloc, 'reset_peak')
+        self.components = {name: ComponentStats() for name in names}
+        self.calls = {}
+        self.time = {}
+        self.products = 0
+
+        # How deep we are in nested profiled calls (see profiled)
+        self._depth = 0
+
+    def reset(self):
+        '''
+        Set all the counts back to zero
+        '''
+        self.components = {name: ComponentStats() for name in self.components}
+        self.calls = {}
+        self.time = {}
+        self.products = 0
+
+    def evaluate_component(self, name, component):
+        '''
+        Evaluate a component's mueller matrix (see MuellerMatrix.evaluate) and record the statistics
+        '''
+        component_stats = self.components.get(name)
+        if component_stats is None:
+            component_stats = self.components[name] = ComponentStats()
+
+        cache_hits = component.cache_hits
+        workspace = component.workspace
+        if workspace is not None:
+            allocations = workspace.allocations
+            allocated_bytes = workspace.allocated_bytes
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        mm = component.evaluate()
+        component_stats.time += time.perf_counter() - start
+
+        if self.trace_memory:
+            component_stats.peak_memory = max(component_stats.peak_memory, tracemalloc.get_traced_memory()[1] - memory)
+
+        component_stats.evaluations += 1
+        if component.cache_hits > cache_hits:
+            component_stats.cache_hits += 1
+        elif workspace is None or not workspace.holds(mm):
+            component_stats.arrays += 1
+            component_stats.bytes += mm.nbytes
+
+        # The arrays the workspace had to make (rather than reuse)
+        if workspace is not None:
+            component_stats.arrays += workspace.allocations - allocations
+            component_stats.bytes += workspace.allocated_bytes - allocated_bytes
+
+        return mm
+
+    def skip_component(self, name):
+        '''
+        Record that a component didn't need to be evaluated
+        '''
+        component_stats = self.components.get(name)
+        if component_stats is None:
+            component_stats = self.components[name] = ComponentStats()
+        component_stats.skipped += 1
+
+    def summary(self):
+        '''
+        A table of the statistics, with the slowest components first
+        '''
+        lines = []
+        for name in sorted(self.calls):
+            lines.append("{:<14s} {:8d} calls {:12.1f} us total {:10.2f} us per call".format(
+                name, self.calls[name], self.time[name] * 1e6, self.time[name] * 1e6 / self.calls[name]))
+        lines.append("{} matrix products".format(self.products))
+
+        lines.append("{:<20s} {:>8s} {:>8s} {:>9s} {:>12s} {:>10s} {:>12s}".format(
+            'component', 'evals', 'skipped', 'hit rate', 'time (us)', 'arrays', 'bytes'))
+        for name, component_stats in sorted(self.components.items(), key=lambda item: -item[1].time):
+            lines.append("{:<20s} {:8d} {:8d} {:9.1%} {:12.1f} {:10d} {:12d}".format(
+                name, component_stats.evaluations, component_stats.skipped, component_stats.hit_rate,
+                component_stats.time * 1e6, component_stats.arrays, component_stats.bytes))
+
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.summary()
@@ -0,0 +1,538 @@
+'''
+Saving SystemMuellerMatrix models and their precomputed matrices to disk, so that they can be loaded quickly.
+
+Reduction workers usually start by building the same instrument model (e.g. naco.make_mm_mmb()), registering the
+same angle grids (see common_mm_functions.register_angle_grid) and computing the same tables of mueller matrices.
+save_system writes all of that to a directory:
+
+    model.json                  -   The definition of the system: the class, function, name, properties and dispersion
+                                    laws of each component, and the registered angle grids. Functions and classes are
+                                    stored by name ('module:qualname'), so they must be importable.
+    arrays.npz                  -   Array property values and the values of the angle grids
+    default_mm.npy              -   The default mueller matrix of the system
+    component_default_mms.npy   -   The default mueller matrix of each component
+    component_mms.npy           -   The mueller matrix of each component for its current properties
+    grid_<i>.npy                -   The matrices of each angle grid
+    table_<name>.npy            -   Any other tables of matrices you want to keep with the model
+
+load_system rebuilds the system from the directory without evaluating anything. The angle grids and the tables
+are memory-mapped, so they're only read from disk when they're used and they're shared between all the workers
+on a machine (the 4x4 matrices of the system and its components are just read in).
+
+model.json also has a hash of the definition (see model_hash). cached_system uses it to only recompute the
+tables when the model has changed:
+
+    system, tables = cached_system('naco_cache', naco.make_mm_mmb,
+                                   tables={'pa': lambda system: system.evaluate({'Rotator': {'pa': pa_grid}})},
+                                   grids=[(cmf.rotator_function, 'pa', np.arange(0, 360, 0.01))])
+
+The first call builds and saves everything, later calls (in any process) load the saved matrices, as long as
+the model's functions, properties and angle grids are the same, and the tables are too (see table_hash), so e.g.
+a different pa_grid recomputes the 'pa' table.
+'''
+
+import hashlib
+import importlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+from pyMuellerMat import common_mm_functions
+from pyMuellerMat import MuellerMat
+
+
+# The version of the directory layout, for when it changes
+FORMAT_VERSION = 1
+
+# The fingerprint of each function (see _function_fingerprint)
+_fingerprint_cache = {}
+
+
+def _reference(obj):
+    '''
+    The 'module:qualname' name of a function or class, which _resolve turns back into the object
+    '''
+    module = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', None)
+    if module is None or qualname is None or '<' in qualname:
+        raise ValueError("{!r} can't be saved, since it can't be imported by name (e.g. a lambda or a function "
+                         "defined inside another function)".format(obj))
+    return "{}:{}".format(module, qualname)
+
+
+def _resolve(reference):
+    '''
+    Import the function or class named by _reference
+    '''
+    module_name, _, qualname = reference.partition(':')
+    obj = importlib.import_module(module_name)
+    for attribute in qualname.split('.'):
+        obj = getattr(obj, attribute)
+    return obj
+
+
+def _function_fingerprint(function):
+    '''
+    A string that changes when a function's code changes: its name and source code (or its bytecode, if the source
+    isn't available)
+    '''
+    try:
+        return _fingerprint_cache[function]
+    except (KeyError, TypeError):
+        pass
+
+    name = "{}:{}".format(getattr(function, '__module__', None), getattr(function, '__qualname__', repr(function)))
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        code = getattr(function, '__code__', None)
+        source = repr(function) if code is None else repr((code.co_code, code.co_consts))
+    fingerprint = name + "\n" + source
+
+    try:
+        _fingerprint_cache[function] = fingerprint
+    except TypeError:
+        pass
+    return fingerprint
+
+
+def _update_hash(hash_object, value):
+    '''
+    Add a property value (a number, string, array or a dictionary of them) to a hash
+    '''
+    if isinstance(value, dict):
+        hash_object.update(b'{')
+        for key in sorted(value):
+            hash_object.update(repr(key).encode())
+            _update_hash(hash_object, value[key])
+        hash_object.update(b'}')
+    elif isinstance(value, (np.ndarray, list, tuple)):
+        try:
+            array = np.ascontiguousarray(value)
+        except ValueError:
+            # A list of arrays with different shapes
+            hash_object.update("list {}".format(len(value)).encode())
+            for item in value:
+                _update_hash(hash_object, item)
+            return
+        hash_object.update("array {} {}".format(array.dtype.str, array.shape).encode())
+        hash_object.update(array.tobytes())
+    elif isinstance(value, (bool, str)) or value is None:
+        hash_object.update(repr(value).encode())
+    else:
+        # Numbers, so that 0, 0. and np.float64(0) are all the same
+        try:
+            hash_object.update(repr(float(value)).encode())
+        except (TypeError, ValueError):
+            hash_object.update(repr(value).encode())
+
+
+def model_hash(system, grids=None):
+    '''
+    A hash of everything that the matrices of a system depend on: the class, function (including its source code),
+    name, properties, default properties and dispersion laws of each component, and the angle grids.
+
+    Inputs:
+    system  -   A SystemMuellerMatrix
+    grids   -   An optional list of angle grids that will be registered, as (function, key, values) or
+                (function, key, values, fixed_kwargs) (see common_mm_functions.register_angle_grid). They replace
+                the registered grids for the same functions in the hash.
+
+    Returns:
+    A hexadecimal string
+    '''
+    hash_object = hashlib.sha256("pyMuellerMat format {}".format(FORMAT_VERSION).encode())
+
+    for (name, component), default_properties in zip(system._named_components(), system._default_properties):
+        hash_object.update("component {!r} {}.{}".format(name, type(component).__module__,
+                                                          type(component).__qualname__).encode())
+        hash_object.update(_function_fingerprint(component.function).encode())
+        _update_hash(hash_object, dict(system.master_property_dict[name]))
+        _update_hash(hash_object, component.default_property_dict)
+        _update_hash(hash_object, default_properties)
+        for key in sorted(component.dispersion):
+            law, law_kwargs = component.dispersion[key]
+            hash_object.update("dispersion {!r}".format(key).encode())
+            hash_object.update(_function_fingerprint(law).encode())
+            _update_hash(hash_object, law_kwargs)
+
+    for function, key, values, fixed_kwargs in _grid_definitions(grids):
+        hash_object.update("grid {!r}".format(key).encode())
+        hash_object.update(_function_fingerprint(function).encode())
+        _update_hash(hash_object, values)
+        _update_hash(hash_object, fixed_kwargs)
+
+    return hash_object.hexdigest()
+
+
+def _global_names(code):
+    '''
+    The names of the global variables (and attributes) used by some code and the functions defined in it
+    '''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _global_names(const)
+    return names
+
+
+def table_hash(name, table):
+    '''
+    A hash of everything a table (see cached_system) depends on, other than the model.
+
+    Inputs:
+    name    -   The name of the table
+    table   -   Either a function(system), or a tuple of (function(system), key). A key is any value (a number, string,
+                array or a dictionary of them) that the table depends on, like the array of angles it's computed for.
+                With a key the hash is of the function's code and the key. Without one it's of the function's code,
+                default arguments, the variables it uses from the functions it's defined in (its closure) and the
+                global variables it uses, so changing any of them recomputes the table. Values that can't be
+                hashed by value (e.g. a list that the function appends to) change the hash on every call, so give
+                a key for functions that use them.
+
+    Returns:
+    A hexadecimal string
+    '''
+    function, key = table if isinstance(table, tuple) else (table, None)
+    hash_object = hashlib.sha256("table {!r}".format(name).encode())
+    hash_object.update(_function_fingerprint(function).encode())
+
+    if isinstance(table, tuple):
+        hash_object.update(b'key')
+        _update_hash(hash_object, key)
+        return hash_object.hexdigest()
+
+    defaults = getattr(function, '__defaults__', None) or ()
+    _update_hash(hash_object, dict(enumerate(defaults)))
+    _update_hash(hash_object, getattr(function, '__kwdefaults__', None) or {})
+
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return hash_object.hexdigest()
+
+    closure = {}
+    for variable, cell in zip(code.co_freevars, function.__closure__ or ()):
+        try:
+            closure[variable] = cell.cell_contents
+        except ValueError:
+            # Not assigned yet
+            closure[variable] = None
+    global_variables = {variable: function.__globals__[variable] for variable in _global_names(code)
+                        if variable in function.__globals__}
+    for variables in [closure, global_variables]:
+        for variable in sorted(variables):
+            value = variables[variable]
+            if inspect.ismodule(value) or inspect.isclass(value):
+                continue
+            hash_object.update("variable {!r}".format(variable).encode())
+            if callable(value) and not isinstance(value, np.ndarray):
+                hash_object.update(_function_fingerprint(value).encode())
+            else:
+                _update_hash(hash_object, value)
+
+    return hash_object.hexdigest()
+
+
+def _save_array(path, array):
+    '''
+    Save an array to a .npy file. The old file is replaced rather than overwritten, so arrays that are
+    memory-mapped from it (e.g. by an earlier load_system) keep their values.
+    '''
+    temporary_path = path + '.tmp.npy'
+    np.save(temporary_path, array)
+    os.replace(temporary_path, path)
+
+
+def _grid_definitions(grids=None):
+    '''
+    The (function, key, values, fixed_kwargs) of the registered angle grids, with the ones in grids (see model_hash)
+    in place of the registered ones for the same functions, in a repeatable order. The values are sorted and the
+    fixed_kwargs filled in the same way as in AngleGrid, so they match the grids once they're registered.
+    '''
+    definitions = {function: (function, grid.key, grid.values, grid.fixed_kwargs)
+                   for function, grid in common_mm_functions.angle_grids.items()}
+    for grid in [] if grids is None else grids:
+        function, key, values = grid[:3]
+        fixed_kwargs = grid[3] if len(grid) > 3 else {}
+        definitions[function] = (function, key, np.unique(np.asarray(values, dtype=float)),
+                                 common_mm_functions.grid_fixed_kwargs(function, key, fixed_kwargs))
+    return sorted(definitions.values(), key=lambda definition: _function_fingerprint(definition[0]))
+
+
+def _sorted_grids():
+    '''
+    The registered angle grids, in the same order as _grid_definitions
+    '''
+    return sorted(common_mm_functions.angle_grids.values(), key=lambda grid: _function_fingerprint(grid.function))
+
+
+def _encode_properties(properties, arrays, prefix):
+    '''
+    Make a JSON-able copy of a property dictionary. Array values are put in arrays (to go in arrays.npz)
+    and replaced by {'array': their key}.
+    '''
+    encoded = {}
+    for key, value in properties.items():
+        if isinstance(value, (np.ndarray, list, tuple)):
+            array_key = "{}.{}".format(prefix, key)
+            arrays[array_key] = np.asarray(value)
+            encoded[key] = {'array': array_key}
+        elif isinstance(value, np.generic):
+            encoded[key] = value.item()
+        else:
+            encoded[key] = value
+    return encoded
+
+
+def _decode_properties(encoded, arrays):
+    '''
+    The reverse of _encode_properties
+    '''
+    return {key: arrays[value['array']] if isinstance(value, dict) else value for key, value in encoded.items()}
+
+
+def _read_manifest(path):
+    '''
+    Read model.json from a saved model, or return None if there isn't one
+    '''
+    try:
+        with open(os.path.join(path, 'model.json')) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if manifest.get('format') != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def save_system(system, path, tables=None, table_hashes=None):
+    '''
+    Save a system, its default and current component matrices, the registered angle grids and some
+    tables of matrices to a directory (see the top of this file).
+
+    The directory is made if it doesn't exist, and the files of an older model in it are replaced. model.json
+    is written last, so a directory that is only half written (e.g. if the process is killed) is never loaded.
+
+    Inputs:
+    system          -   The SystemMuellerMatrix to save. Its components' functions and classes (and any dispersion
+                        laws) must be importable by name.
+    path            -   The directory to save it in
+    tables          -   An optional dictionary of {name: array} of other precomputed arrays to save with it
+    table_hashes    -   An optional dictionary of {name: hash} of the tables (see table_hash), which cached_system
+                        checks to tell if they've changed
+
+    Returns:
+    The model hash (see model_hash)
+    '''
+    tables = {} if tables is None else tables
+    os.makedirs(path, exist_ok=True)
+
+    # Don't leave an old model.json around while the new files are written
+    try:
+        os.remove(os.path.join(path, 'model.json'))
+    except FileNotFoundError:
+        pass
+
+    arrays = {}
+    components = []
+    for i, ((name, component), default_properties) in enumerate(zip(system._named_components(),
+                                                                     system._default_properties)):
+        dispersion = {key: {'law': _reference(law), 'kwargs': law_kwargs}
+                      for key, (law, law_kwargs) in component.dispersion.items()}
+        components.append({
+            'name': name,
+            'class': _reference(type(component)),
+            'function': _reference(component.function),
+            'property_list': component.property_list,
+            'default_property_dict': _encode_properties(component.default_property_dict, arrays, "{}.default".format(i)),
+            'properties': _encode_properties(system.master_property_dict[name], arrays, "{}.properties".format(i)),
+            'default_properties': _encode_properties(default_properties, arrays, "{}.system_default".format(i)),
+            'dispersion': dispersion,
+        })
+
+    grids = []
+    for j, grid in enumerate(_sorted_grids()):
+        arrays["grid_{}".format(j)] = grid.values
+        _save_array(os.path.join(path, "grid_{}.npy".format(j)), np.asarray(grid.matrices))
+        grids.append({'function': _reference(grid.function), 'key': grid.key,
+                      'fixed_kwargs': _encode_properties(grid.fixed_kwargs, arrays, "grid_{}.fixed".format(j))})
+
+    np.savez(os.path.join(path, 'arrays.npz'), **arrays)
+
+    # The matrices. The current component matrices are only kept when they're all single 4x4 matrices.
+    _save_array(os.path.join(path, 'default_mm.npy'), np.asarray(system.default_mm))
+    mueller_matrices = [component for _, component in system._named_components()]
+    _save_array(os.path.join(path, 'component_default_mms.npy'),
+                np.array([component.default_mm for component in mueller_matrices]))
+    component_mms = [component._evaluate_properties() for component in mueller_matrices]
+    has_component_mms = all(np.shape(mm) == (4, 4) for mm in component_mms)
+    if has_component_mms:
+        _save_array(os.path.join(path, 'component_mms.npy'), np.array(component_mms))
+
+    for name, table in tables.items():
+        _save_array(os.path.join(path, "table_{}.npy".format(name)), np.asarray(table))
+
+    model_hash_value = model_hash(system)
+    manifest = {'format': FORMAT_VERSION, 'hash': model_hash_value, 'components': components, 'grids': grids,
+                'component_mms': has_component_mms, 'tables': sorted(tables),
+                'table_hashes': {} if table_hashes is None else dict(table_hashes)}
+    temporary_path = os.path.join(path, 'model.json.tmp')
+    with open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary_path, os.path.join(path, 'model.json'))
+
+    return model_hash_value
+
+
+def _load_matrices(system, path, manifest):
+    '''
+    Give a system its saved default matrices and component matrices, so it doesn't need to evaluate them.
+    These are small, so they're read into memory rather than memory-mapped.
+    '''
+    default_mm = np.load(os.path.join(path, 'default_mm.npy'))
+    default_mm.flags.writeable = False
+    system.default_mm = default_mm
+    mueller_matrices = [component for _, component in system._named_components()]
+
+    component_default_mms = np.load(os.path.join(path, 'component_default_mms.npy'))
+    component_default_mms.flags.writeable = False
+    for component, default_mm in zip(mueller_matrices, component_default_mms):
+        component.default_mm = default_mm
+
+    if manifest['component_mms']:
+        component_mms = np.load(os.path.join(path, 'component_mms.npy'))
+        system.invalidate()
+        for i, (name, component) in enumerate(system._named_components()):
+            properties = system.master_property_dict[name]
+            component.mm = component_mms[i]
+            system._component_mms[i] = component_mms[i]
+            system._property_dicts[i] = properties
+            system._property_versions[i] = getattr(properties, 'version', None)
+
+        # None of the products have been worked out yet
+        system._last_changed = len(mueller_matrices) - 1
+
+
+def _load_arrays(path):
+    '''
+    The contents of arrays.npz, as a dictionary
+    '''
+    with np.load(os.path.join(path, 'arrays.npz')) as npz:
+        return dict(npz)
+
+
+def _register_grids(path, manifest, arrays, mmap_mode):
+    '''
+    Register the saved angle grids, without computing their matrices
+    '''
+    for j, grid in enumerate(manifest['grids']):
+        function = _resolve(grid['function'])
+        matrices = np.load(os.path.join(path, "grid_{}.npy".format(j)), mmap_mode=mmap_mode)
+        common_mm_functions.angle_grids[function] = common_mm_functions.AngleGrid.from_matrices(
+            function, grid['key'], arrays["grid_{}".format(j)], matrices, _decode_properties(grid['fixed_kwargs'], arrays))
+
+
+def _load_tables(path, manifest, mmap_mode):
+    '''
+    The saved tables, as {name: array}
+    '''
+    return {name: np.load(os.path.join(path, "table_{}.npy".format(name)), mmap_mode=mmap_mode)
+            for name in manifest['tables']}
+
+
+def load_system(path, mmap=True, register_grids=True, expected_hash=None):
+    '''
+    Load a system saved by save_system, without evaluating any mueller matrices.
+
+    Inputs:
+    path            -   The directory it was saved in
+    mmap            -   If True memory-map the matrices (read-only), otherwise read them into memory
+    register_grids  -   If True register the saved angle grids (see common_mm_functions.register_angle_grid),
+                        replacing any grids already registered for the same functions
+    expected_hash   -   If given, raise a ValueError if the saved model doesn't have this hash
+
+    Returns:
+    system  -   A SystemMuellerMatrix that is ready to evaluate. Its components are made with MuellerMatrix.__init__,
+                so any extra attributes that a MuellerMatrix child class sets in its own __init__ aren't there.
+    tables  -   A dictionary of the saved tables
+    '''
+    manifest = _read_manifest(path)
+    if manifest is None:
+        raise ValueError("There's no saved model (with format {}) in {}".format(FORMAT_VERSION, path))
+    if expected_hash is not None and manifest['hash'] != expected_hash:
+        raise ValueError("The model saved in {} has changed (its hash is {}, not {})".format(
+            path, manifest['hash'], expected_hash))
+
+    mmap_mode = 'r' if mmap else None
+    arrays = _load_arrays(path)
+    if register_grids:
+        _register_grids(path, manifest, arrays, mmap_mode)
+
+    mueller_matrices = []
+    for definition in manifest['components']:
+        component = object.__new__(_resolve(definition['class']))
+        MuellerMat.MuellerMatrix.__init__(component, _resolve(definition['function']), name=definition['name'])
+        component.property_list = list(definition['property_list'])
+        component.default_property_dict = _decode_properties(definition['default_property_dict'], arrays)
+        component.property_defaults = [component.default_property_dict[key] for key in component.property_list]
+        component.properties = MuellerMat.PropertyDict(_decode_properties(definition['properties'], arrays))
+        component.dispersion = {key: (_resolve(law['law']), dict(law['kwargs']))
+                                for key, law in definition['dispersion'].items()}
+        mueller_matrices.append(component)
+
+    system = MuellerMat.SystemMuellerMatrix(mueller_matrices)
+    system._default_properties = [_decode_properties(definition['default_properties'], arrays)
+                                  for definition in manifest['components']]
+    _load_matrices(system, path, manifest)
+
+    return system, _load_tables(path, manifest, mmap_mode)
+
+
+def cached_system(path, build, tables=None, grids=None, mmap=True):
+    '''
+    Build a system, and load its precomputed matrices from a directory if they were saved for the same model,
+    or compute and save them if they weren't (or the model has changed).
+
+    Inputs:
+    path    -   The cache directory
+    build   -   A function with no arguments that returns the SystemMuellerMatrix (e.g. naco.make_mm_mmb).
+                Building a system is quick, since nothing is evaluated until it's needed.
+    tables  -   An optional dictionary of {name: function(system)} or {name: (function(system), key)} of the tables
+                to precompute. They're recomputed when their hash changes (see table_hash).
+    grids   -   An optional list of angle grids to register, as (function, key, values) or
+                (function, key, values, fixed_kwargs). Pass them here rather than registering them in build,
+                so that their matrices are loaded rather than computed.
+    mmap    -   If True memory-map the saved angle grids and tables (read-only)
+
+    Returns:
+    system  -   The system from build, with its default and component matrices loaded (if they were saved)
+    tables  -   A dictionary of the tables
+    '''
+    tables = {} if tables is None else tables
+    grids = [] if grids is None else grids
+    system = build()
+    model_hash_value = model_hash(system, grids=grids)
+    table_hashes = {name: table_hash(name, table) for name, table in tables.items()}
+    mmap_mode = 'r' if mmap else None
+
+    manifest = _read_manifest(path)
+    if (manifest is not None and manifest['hash'] == model_hash_value
+            and all(manifest.get('table_hashes', {}).get(name) == table_hashes[name] for name in tables)):
+        _register_grids(path, manifest, _load_arrays(path), mmap_mode)
+        _load_matrices(system, path, manifest)
+        saved_tables = _load_tables(path, manifest, mmap_mode)
+        return system, {name: saved_tables[name] for name in tables}
+
+    for grid in grids:
+        fixed_kwargs = grid[3] if len(grid) > 3 else {}
+        common_mm_functions.register_angle_grid(grid[0], grid[1], grid[2], **fixed_kwargs)
+
+    # Compute the tables with a clone, so that whatever they do to the properties doesn't change the system
+    computed_tables = {}
+    for name, table in tables.items():
+        function = table[0] if isinstance(table, tuple) else table
+        computed_tables[name] = np.asarray(function(system.clone()))
+    save_system(system, path, computed_tables, table_hashes)
+    return system, computed_tables
@@ -0,0 +1,100 @@
+'''
+Per-pixel demodulation of image cubes that are too big to fit in memory.
+
+A sequence of frames (e.g. the VAMPIRES data in Notebooks/ Vampires_HD29835.ipynb) is demodulated into a
+Stokes cube by solving, for every pixel, the least squares problem
+
+    frames[:, y, x] = measurement_matrix[:, y, x, :] @ stokes[:, y, x]
+
+where each row of the measurement matrix is the first row of the system mueller matrix for that frame.
+When some of the properties vary across the detector (e.g. a retardance map), the measurement matrix is
+different for every pixel, and the full (n_frames, ny, nx, 4) array can be far bigger than RAM.
+
+demodulate_frames streams through the frames in tiles of rows, so only one tile of the frames and the
+measurement matrix is ever in memory. The frames and the property maps can be memory-mapped (np.memmap
+or .npy files) and the Stokes cube can be written straight to a memory-mapped .npy file.
+'''
+
+import numpy as np
+
+from pyMuellerMat.demodulation import demodulate, demodulation_matrix
+from pyMuellerMat.forward_model import evaluate_with_params
+
+
+def _open_array(array):
+    '''
+    Memory-map an array if we were given the path to a .npy file
+    '''
+    if isinstance(array, str):
+        return np.load(array, mmap_mode='r')
+    return array
+
+
+def demodulate_frames(system, frames, frame_properties, pixel_properties=None, output=None, tile_size=65536):
+    '''
+    Demodulate a sequence of frames into a Stokes cube, one tile of rows at a time.
+
+    Inputs:
+    system              -   The SystemMuellerMatrix of the instrument
+    frames              -   An array (or np.memmap, or the path to a .npy file) of shape (n_frames, ny, nx)
+    frame_properties    -   A dictionary of {'name.property': values} for the properties that change from frame
+                            to frame (e.g. {'hwp.theta': hwp_angles, 'WollastonPrism.beam': beams}). Each value
+                            has shape (n_frames,).
+    pixel_properties    -   An optional dictionary of {'name.property': map} for the properties that change across
+                            the detector. Each map is an array (or np.memmap, or the path to a .npy file) of shape (ny, nx).
+    output              -   Where to put the Stokes cube. Either an array of shape (4, ny, nx), the path to a .npy
+                            file to write (as a memory-mapped file), or None to make a new array.
+    tile_size           -   The (approximate) number of pixels in each tile. The peak memory use is about
+                            tile_size * n_frames * 8 numbers.
+
+    Returns:
+    output  -   The Stokes cube, with shape (4, ny, nx)
+    '''
+    frames = _open_array(frames)
+    n_frames, ny, nx = frames.shape
+
+    if isinstance(output, str):
+        output = np.lib.format.open_memmap(output, mode='w+', dtype=float, shape=(4, ny, nx))
+    elif output is None:
+        output = np.empty((4, ny, nx))
+
+    pixel_properties = {param: _open_array(value) for param, value in (pixel_properties or {}).items()}
+    rows_per_tile = max(1, tile_size // nx)
+
+    # Without any per-pixel properties the measurement matrix is the same everywhere, so we only need one pseudo-inverse
+    if len(pixel_properties) == 0:
+        measurement_matrix = evaluate_with_params(system, {param: np.asarray(value)
+                                                           for param, value in frame_properties.items()}, row=True)
+        measurement_matrix = np.broadcast_to(measurement_matrix, (n_frames, 4))
+        demod = demodulation_matrix(measurement_matrix)
+
+    # The frame properties go along the first axis, the pixel properties along the last two
+    frame_values = {param: np.reshape(value, (n_frames, 1, 1)) for param, value in frame_properties.items()}
+
+    for row_start in range(0, ny, rows_per_tile):
+        row_end = min(ny, row_start + rows_per_tile)
+        n_rows = row_end - row_start
+        data = np.asarray(frames[:, row_start:row_end, :], dtype=float)
+
+        if len(pixel_properties) == 0:
+            stokes = demod @ data.reshape(n_frames, -1)
+            output[:, row_start:row_end, :] = stokes.reshape(4, n_rows, nx)
+            continue
+
+        values = dict(frame_values)
+        for param, value in pixel_properties.items():
+            values[param] = np.asarray(value[row_start:row_end, :])[None]
+
+        # The measurement matrix of every pixel in the tile, with shape (n_rows, nx, n_frames, 4)
+        measurement_matrix = evaluate_with_params(system, values, row=True)
+        measurement_matrix = np.broadcast_to(measurement_matrix, (n_frames, n_rows, nx, 4))
+        measurement_matrix = np.moveaxis(measurement_matrix, 0, -2)
+
+        # One batched solve for all the pixels in the tile
+        stokes = demodulate(measurement_matrix, np.moveaxis(data, 0, -1))
+        output[:, row_start:row_end, :] = np.moveaxis(stokes, -1, 0)
+
+    if hasattr(output, 'flush'):
+        output.flush()
+
+    return output
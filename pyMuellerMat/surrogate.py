@@ -0,0 +1,209 @@
+'''
+A precomputed surrogate of a SystemMuellerMatrix over a bounded grid of free parameters.
+
+An MCMC fit that explores the same ranges of a few parameters (e.g. the FLC retardance, the derotator retardance
+and the periscope diattenuation) over and over can tabulate the system mueller matrix on a grid once, and then
+interpolate in the table instead of evaluating the system:
+
+    surrogate = GridSurrogate(sys_mm, {'flc.phi': np.linspace(2.8, 3.4, 33),
+                                       'image_rotator.phi': np.linspace(1.6, 2.3, 33),
+                                       'Periscope.epsilon': np.linspace(0, 0.05, 9)})
+    print(surrogate.error)      # how far the interpolation is from the exact model
+    mm = surrogate(x)           # x has shape (n_params,) or (n_walkers, n_params)
+
+The table is built with one batched evaluation of the compiled system (see SystemMuellerMatrix.compile), or split
+across several workers with parallel_evaluate. Only the mueller matrix elements that change over the grid are
+stored, optionally as float32.
+
+Multilinear interpolation is built in. Cubic spline interpolation uses scipy, which is optional.
+'''
+
+import itertools
+
+import numpy as np
+
+from pyMuellerMat.parallel import parallel_evaluate
+
+
+class GridSurrogate(object):
+    '''
+    Interpolates a system mueller matrix (or its first row) tabulated on a regular grid of free parameters.
+    '''
+
+    def __init__(self, system, grid, method='linear', row=False, dtype=float, n_workers=1, backend='process',
+                 n_check=1000, seed=0):
+        '''
+        Inputs:
+        system      -   The SystemMuellerMatrix to tabulate. The properties that aren't in the grid are frozen at
+                        their current values.
+        grid        -   A dictionary of {'name.property': grid values} (an increasing 1D array for each free
+                        parameter). The order of the dictionary is the order of the parameters in x.
+        method      -   'linear' for multilinear interpolation, or 'cubic' for cubic splines (needs scipy)
+        row         -   If True only tabulate the first row of the system mueller matrix (all you need for intensities)
+        dtype       -   The type to store the table as, e.g. np.float32 to halve its size
+        n_workers   -   The number of workers to build the table with (see parallel.parallel_evaluate).
+                        With 1 the compiled system evaluates the whole grid in one batch.
+        backend     -   The parallel_evaluate backend, 'process' or 'thread'
+        n_check     -   The number of random points in the grid to compare the interpolation with the exact model
+                        at (see check_error). Set to 0 to skip the check.
+        seed        -   The random seed for those points
+
+        Class properties:
+        free_params -   The list of free parameter names, in the order they're expected in x
+        grid        -   The list of grid values of each free parameter
+        error       -   A dictionary with the 'max' and 'rms' absolute error of the interpolation over the check
+                        points, and 'n_points', the number of check points
+        '''
+        if method not in ('linear', 'cubic'):
+            raise ValueError("method must be 'linear' or 'cubic', not '{}'".format(method))
+
+        self.system = system
+        self.free_params = list(grid.keys())
+        self.grid = [np.asarray(values, dtype=float) for values in grid.values()]
+        self.method = method
+        self.row = row
+        for param, values in zip(self.free_params, self.grid):
+            system._split_param_name(param)
+            if values.ndim != 1 or len(values) < 2 or np.any(np.diff(values) <= 0):
+                raise ValueError("The grid of '{}' must be an increasing 1D array with at least 2 values".format(param))
+
+        self.lower = np.array([values[0] for values in self.grid])
+        self.upper = np.array([values[-1] for values in self.grid])
+        self.shape = tuple(len(values) for values in self.grid)
+        self.output_shape = (4,) if row else (4, 4)
+
+        # Evaluate the system at every point of the grid
+        points = np.stack([axis.ravel() for axis in np.meshgrid(*self.grid, indexing='ij')], axis=-1)
+        table = self.evaluate_exact(points, n_workers=n_workers, backend=backend).reshape(self.shape + (-1,))
+
+        # Only keep the elements that actually change over the grid
+        self._constant = np.array(table.reshape(-1, table.shape[-1])[0], dtype=float)
+        self._varying = np.flatnonzero(np.any(table != self._constant, axis=tuple(range(len(self.shape)))))
+        self.table = np.ascontiguousarray(table[..., self._varying], dtype=dtype)
+
+        # For the multilinear interpolation: the flattened table, and the flat offset of each corner of a cell
+        # from its first corner
+        n_params = len(self.free_params)
+        self._flat_table = self.table.reshape(int(np.prod(self.shape)), len(self._varying))
+        self._strides = np.array([int(np.prod(self.shape[j + 1:])) for j in range(n_params)], dtype=np.intp)
+        corner_steps = np.array(list(itertools.product([0, 1], repeat=n_params)), dtype=np.intp).reshape(-1, n_params)
+        self._corner_offsets = corner_steps @ self._strides
+        self._spacing = np.array([values[1] - values[0] for values in self.grid])
+        self._uniform = all(np.allclose(np.diff(values), spacing) for values, spacing in zip(self.grid, self._spacing))
+        self._max_index = np.array(self.shape) - 2
+
+        self._spline = None
+        if method == 'cubic' and len(self._varying) > 0:
+            try:
+                from scipy.interpolate import RegularGridInterpolator
+            except ImportError:
+                raise ImportError("method='cubic' needs scipy. Use method='linear' or install scipy.")
+            self._spline = RegularGridInterpolator(self.grid, self.table, method='cubic')
+
+        self.error = None
+        if n_check > 0:
+            self.check_error(n_check, seed=seed)
+
+    def evaluate_exact(self, x, n_workers=1, backend='process'):
+        '''
+        Evaluate the exact model at some points.
+
+        Inputs:
+        x           -   An array of shape (N, n_params)
+        n_workers   -   See __init__
+        backend     -   See __init__
+
+        Returns:
+        An array of shape (N,) + output_shape
+        '''
+        x = np.asarray(x, dtype=float)
+        if n_workers == 1:
+            mm = self.system.compile(self.free_params).batch(x)
+            return mm[:, 0, :] if self.row else mm
+
+        values = {param: x[:, j] for j, param in enumerate(self.free_params)}
+        return parallel_evaluate(self.system, values, n_workers=n_workers, backend=backend, row=self.row)
+
+    def __call__(self, x):
+        '''
+        Interpolate the system mueller matrix.
+
+        Inputs:
+        x   -   An array of shape (n_params,) or (..., n_params). Points outside the grid give NaN.
+
+        Returns:
+        mm  -   An array of shape x.shape[:-1] + (4, 4), or x.shape[:-1] + (4,) if row is True
+        '''
+        x = np.asarray(x, dtype=float)
+        batch_shape = x.shape[:-1]
+        x = x.reshape(-1, len(self.free_params))
+
+        mm = np.empty((len(x), len(self._constant)))
+        mm[:] = self._constant
+        # There may be nothing to interpolate (e.g. a row that doesn't depend on the free parameters)
+        if self._spline is not None:
+            mm[:, self._varying] = self._spline(np.clip(x, self.lower, self.upper))
+        elif len(self._varying) > 0:
+            mm[:, self._varying] = self._interpolate_linear(x)
+        mm[np.any((x < self.lower) | (x > self.upper), axis=1)] = np.nan
+
+        return mm.reshape(batch_shape + self.output_shape)
+
+    def _interpolate_linear(self, x):
+        '''
+        Multilinear interpolation of the stored elements at points x with shape (N, n_params).
+        Points outside the grid are extrapolated from the nearest cell.
+        '''
+        # The cell each point is in and how far along it is on each axis. On an evenly spaced axis that's just
+        # arithmetic, otherwise search for it.
+        if self._uniform:
+            position = (x - self.lower) / self._spacing
+            indices = np.clip(np.floor(position).astype(np.intp), 0, self._max_index)
+            fractions = position - indices
+        else:
+            indices = np.empty(x.shape, dtype=np.intp)
+            fractions = np.empty(x.shape)
+            for j, values in enumerate(self.grid):
+                index = np.clip(np.searchsorted(values, x[:, j], side='right') - 1, 0, len(values) - 2)
+                indices[:, j] = index
+                fractions[:, j] = (x[:, j] - values[index]) / (values[index + 1] - values[index])
+
+        # The weight of each of the 2^n_params corners of the cell is a product of fraction or 1 - fraction on each
+        # axis. Build them up one axis at a time, in the same order as the corners (the last axis changes fastest).
+        weights = np.ones((len(x), 1))
+        for j in range(fractions.shape[1]):
+            weights = (weights[:, :, None] * np.stack([1 - fractions[:, j], fractions[:, j]], axis=-1)[:, None, :])
+            weights = weights.reshape(len(x), -1)
+
+        # Gather the corners of each cell from the flattened table, and add them up with their weights
+        corners = np.take(self._flat_table, (indices @ self._strides)[:, None] + self._corner_offsets, axis=0)
+
+        return np.matmul(weights[:, None, :], corners)[:, 0, :]
+
+    def check_error(self, n_points=1000, seed=0):
+        '''
+        Compare the interpolation with the exact model at random points inside the grid.
+        This is an empirical error bound: the true maximum error can be a little larger than the one found.
+
+        Inputs:
+        n_points    -   The number of random points
+        seed        -   The random seed
+
+        Returns:
+        error   -   A dictionary with the 'max' and 'rms' absolute error over all the mueller matrix elements,
+                    and 'n_points'. It's also stored in self.error.
+        '''
+        rng = np.random.default_rng(seed)
+        x = rng.uniform(self.lower, self.upper, (n_points, len(self.free_params)))
+        difference = self(x) - self.evaluate_exact(x)
+        self.error = {'max': float(np.max(np.abs(difference))),
+                      'rms': float(np.sqrt(np.mean(difference ** 2))),
+                      'n_points': n_points}
+        return self.error
+
+    @property
+    def nbytes(self):
+        '''
+        The size of the stored table in bytes
+        '''
+        return self.table.nbytes
@@ -1,33 +1,1150 @@
 import common_mms as mms
 
 
-verbose=True
-
-
-p1 = mms.Polarizer()
-p2 = mms.HorizontalPolarizer()
-p3 = mms.VerticalPolarizer()
-p4 = mms.WollastonPrism()
-p5 = mms.Retarder()
-p6 = mms.HWP()
-p7 = mms.QWP()
-p8 = mms.Rotator()
-
-if verbose:
-	print(p1.evaluate())
-	print(p2.evaluate())
-	print(p3.evaluate())
-	print(p4.evaluate())
-	print(p5.evaluate())
-	print(p6.evaluate())
-	print(p7.evaluate())
-	print(p8.evaluate())
-else:
-	t = p1.evaluate()
-	t = p2.evaluate()
-	t = p3.evaluate()
-	t = p4.evaluate()
-	t = p5.evaluate()
-	t = p6.evaluate()
-	t = p7.evaluate()
-	t = p8.evaluate()
+#############################################
+############# Batched evaluation ############
+#############################################
+
+import numpy as np
+from pyMuellerMat import MuellerMat
+
+
+def test_batched_system_evaluate():
+	'''
+	Check that evaluating a system with arrays of properties gives the same result
+	as evaluating it one set of scalar properties at a time.
+	'''
+
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	optics.properties['epsilon'] = 0.02
+	flc = mms.Retarder(name='flc')
+	flc.properties['phi'] = 2*np.pi*0.5
+
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, optics, image_rotator, hwp])
+
+	hwp_angles = np.linspace(0, 90, 8)
+	imrot_angs = np.linspace(45, 135, 6)
+	flc_phis = 2*np.pi*np.array([0.45, 0.5, 0.55])
+
+	# The scalar path
+	scalar_mms = np.zeros([len(hwp_angles), len(imrot_angs), len(flc_phis), 4, 4])
+	for i in range(len(hwp_angles)):
+		for j in range(len(imrot_angs)):
+			for k in range(len(flc_phis)):
+				sys_mm.master_property_dict['hwp']['theta'] = hwp_angles[i]
+				sys_mm.master_property_dict['image_rotator']['theta'] = imrot_angs[j]
+				sys_mm.master_property_dict['flc']['phi'] = flc_phis[k]
+				scalar_mms[i, j, k] = sys_mm.evaluate()
+
+	# The batched path
+	batched_mms = sys_mm.evaluate({'hwp': {'theta': hwp_angles[:, None, None]},
+								   'image_rotator': {'theta': imrot_angs[None, :, None]},
+								   'flc': {'phi': flc_phis[None, None, :]}})
+
+	assert batched_mms.shape == scalar_mms.shape
+	np.testing.assert_allclose(batched_mms, scalar_mms, rtol=0, atol=1e-14)
+
+	# The wollaston beam can be batched too. Put the scalar properties back first so that the
+	# arrays above aren't broadcast against the beams.
+	sys_mm.evaluate({'hwp': {'theta': 0.}, 'image_rotator': {'theta': 0.}, 'flc': {'phi': flc_phis[0]}})
+	beams = np.array(['o', 'e'])
+	batched_mms = sys_mm.evaluate({'WollastonPrism': {'beam': beams}})
+	for i, beam in enumerate(beams):
+		sys_mm.master_property_dict['WollastonPrism']['beam'] = beam
+		np.testing.assert_allclose(batched_mms[i], sys_mm.evaluate(), rtol=0, atol=1e-14)
+
+
+def test_vectorized_functions():
+	'''
+	Check that every vectorized function in common_mm_functions matches its scalar counterpart.
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+
+	test_kwargs = {cmf.general_polarizer_function: {'px': [1., 0.9, 0.5], 'py': [0., 0.2, 0.5]},
+				   cmf.wollaston_prism_function: {'beam': ['o', 'e', 'e'], 'eta': [1., 0.95, 0.9]},
+				   cmf.general_retarder_function: {'phi': [0., 1., np.pi]},
+				   cmf.rotator_function: {'pa': [0., 22.5, 112.]},
+				   cmf.diattenuator_retarder_function: {'epsilon': [0., 0.1, 0.5], 'phi': [0., 1., 2.]},
+				   cmf.diattenuator_retarder_function2: {'r1': [1., 0.9, 0.8], 'r2': [0., 0.8, 0.9], 'delta': [0., 1., 2.]},
+				   cmf.instrumental_polarization_function: {'IPQ': [0., 0.01, 0.02], 'IPU': [0., 0.02, 0.], 'IPV': [0., 0., 0.01]}}
+
+	for function, vectorized_function in cmf.vectorized_functions.items():
+		kwargs = test_kwargs.get(function, {})
+		n = len(next(iter(kwargs.values()))) if len(kwargs) > 0 else 1
+
+		out = np.full((n, 4, 4), np.nan)
+		vectorized_mms = vectorized_function(out=out, **{key: np.array(value) for key, value in kwargs.items()})
+		assert vectorized_mms is out
+		for i in range(n):
+			scalar_mm = function(**{key: value[i] for key, value in kwargs.items()})
+			np.testing.assert_allclose(vectorized_mms[i], scalar_mm, rtol=0, atol=1e-15)
+
+
+def test_evaluation_cache():
+	'''
+	Check that the evaluation cache returns the same matrices, counts hits and misses, and evicts old entries.
+	'''
+	hwp = mms.HWP(name='hwp')
+	wollaston = mms.WollastonPrism()
+	sys_mm = MuellerMat.SystemMuellerMatrix([wollaston, hwp])
+
+	expected = {}
+	for theta in [0., 22.5, 45., 67.5]:
+		expected[theta] = sys_mm.evaluate({'hwp': {'theta': theta}})
+
+	sys_mm.enable_cache(cache_size=3)
+	for i in range(3):
+		for theta in [0., 22.5, 45.]:
+			np.testing.assert_array_equal(sys_mm.evaluate({'hwp': {'theta': theta}}), expected[theta])
+
+	info = sys_mm.cache_info()
+	assert info['hwp']['misses'] == 3 and info['hwp']['hits'] == 6
+	# The wollaston prism never changes, so the system doesn't even re-evaluate it
+	assert info['WollastonPrism']['misses'] == 0 and info['WollastonPrism']['hits'] == 0
+
+	# Changing a property means a miss, and pushes the least recently used entry out of the cache
+	np.testing.assert_array_equal(sys_mm.evaluate({'hwp': {'theta': 67.5}}), expected[67.5])
+	assert sys_mm.cache_info()['hwp']['misses'] == 4
+	assert sys_mm.cache_info()['hwp']['size'] == 3
+	assert (0., 0., 0.) not in hwp._cache
+
+	# Batched evaluations skip the cache
+	sys_mm.evaluate({'hwp': {'theta': np.array([0., 45.])}})
+	assert sys_mm.cache_info()['hwp']['misses'] == 4
+
+	sys_mm.disable_cache()
+	assert sys_mm.cache_info()['hwp']['size'] == 0
+
+
+def test_incremental_system_evaluate():
+	'''
+	Check that the cached prefix/suffix products give the same answer as multiplying out the whole chain,
+	for changes made through new_property_dict, direct edits to master_property_dict, and replaced dictionaries.
+	'''
+	names = ['wollaston', 'flc', 'periscope', 'image_rotator', 'hwp', 'altitude']
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(name='wollaston'), mms.Retarder(name='flc'),
+											 mms.DiattenuatorRetarder(name='periscope'), mms.Retarder(name='image_rotator'),
+											 mms.Retarder(name='hwp'), mms.Rotator(name='altitude')])
+
+	def full_product():
+		mm = np.eye(4)
+		for component in sys_mm.mueller_matrix_list:
+			mm = mm @ component._evaluate_properties()
+		return mm
+
+	rng = np.random.default_rng(42)
+	for i in range(200):
+		name = names[rng.integers(len(names))]
+		how = rng.integers(3)
+		if how == 0:
+			mm = sys_mm.evaluate({name: {'theta': rng.uniform(0, 180)}})
+		elif how == 1:
+			sys_mm.master_property_dict[name]['delta_theta'] = rng.uniform(0, 180)
+			mm = sys_mm.evaluate()
+		else:
+			sys_mm.master_property_dict[name] = dict(sys_mm.master_property_dict[name], theta=rng.uniform(0, 180))
+			mm = sys_mm.evaluate()
+		np.testing.assert_allclose(mm, full_product(), rtol=0, atol=1e-14)
+
+	# The output belongs to the user, changing it shouldn't change the next evaluation
+	mm = sys_mm.evaluate()
+	mm[...] = 0
+	np.testing.assert_allclose(sys_mm.evaluate(), full_product(), rtol=0, atol=1e-14)
+
+
+def test_compiled_system():
+	'''
+	Check that a compiled system (and its batched version) matches SystemMuellerMatrix.evaluate.
+	'''
+	flc = mms.Retarder(name='flc')
+	flc.properties['phi'] = 2*np.pi*0.5
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	optics.properties['theta'] = 10.
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	image_rotator.properties['theta'] = 50.
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	hwp.properties['theta'] = 22.5
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, optics, image_rotator, hwp, mms.Rotator(name='altitude')])
+
+	free_params = ['flc.phi', 'hwp.delta_theta', 'Periscope.epsilon', 'Periscope.theta']
+	model = sys_mm.compile(free_params)
+
+	rng = np.random.default_rng(1)
+	xs = np.column_stack([rng.uniform(2, 4, 20), rng.uniform(-5, 5, 20), rng.uniform(0, 0.1, 20), rng.uniform(0, 90, 20)])
+	batched_mms = model.batch(xs)
+
+	for x, batched_mm in zip(xs, batched_mms):
+		expected = sys_mm.evaluate({'flc': {'phi': x[0]}, 'hwp': {'delta_theta': x[1]},
+									'Periscope': {'epsilon': x[2], 'theta': x[3]}})
+		np.testing.assert_allclose(model(x), expected, rtol=0, atol=1e-14)
+		np.testing.assert_allclose(batched_mm, expected, rtol=0, atol=1e-14)
+
+
+def test_jacobian():
+	'''
+	Check the analytic jacobian of a system against finite differences of evaluate.
+	'''
+	from pyMuellerMat import naco
+
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	optics.properties['epsilon'] = 0.05
+	optics.properties['phi'] = 0.3
+	optics.properties['theta'] = 12.
+	witzel = mms.DiattenuatorRetarder2(name='witzel')
+	witzel.properties['r2'] = 0.9
+	polarizer = mms.Polarizer()
+	polarizer.properties['py'] = 0.8
+	ip = mms.InstrumentalPolarization(name='ip')
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), mms.Retarder(name='hwp'), optics, witzel, polarizer, ip,
+											 naco.NACO_mmb(), mms.Rotator(name='sky')])
+	sys_mm.evaluate({'hwp': {'phi': 3.0, 'theta': 22.}, 'sky': {'pa': 31.}, 'WollastonPrism': {'eta': 0.95}})
+
+	free_params = ['hwp.phi', 'hwp.theta', 'hwp.delta_theta', 'Periscope.epsilon', 'Periscope.phi', 'Periscope.theta',
+				   'witzel.r1', 'witzel.r2', 'witzel.delta', 'Polarizer.px', 'Polarizer.py', 'ip.IPQ', 'ip.IPU', 'ip.IPV',
+				   'NACO.u_eff', 'NACO.uq_crosstalk', 'sky.pa', 'sky.theta', 'WollastonPrism.eta']
+	jac = sys_mm.jacobian(free_params)
+
+	step = 1e-6
+	for j, param in enumerate(free_params):
+		name, key = param.split('.')
+		value = sys_mm.master_property_dict[name][key]
+		mm_plus = sys_mm.evaluate({name: {key: value + step}})
+		mm_minus = sys_mm.evaluate({name: {key: value - step}})
+		sys_mm.evaluate({name: {key: value}})
+		np.testing.assert_allclose(jac[j], (mm_plus - mm_minus) / (2 * step), rtol=0, atol=1e-8, err_msg=param)
+
+	# Batched properties give a batched jacobian
+	hwp_angles = np.array([0., 22.5, 45.])
+	jac = sys_mm.jacobian(['hwp.phi', 'Periscope.epsilon'], {'hwp': {'theta': hwp_angles}})
+	assert jac.shape == (2, 3, 4, 4)
+	for i, angle in enumerate(hwp_angles):
+		np.testing.assert_allclose(jac[:, i], sys_mm.jacobian(['hwp.phi', 'Periscope.epsilon'], {'hwp': {'theta': angle}}),
+								   rtol=0, atol=1e-14)
+
+	# At the default properties the derivatives with respect to epsilon and r2 are infinite, the others are fine
+	default_sys_mm = MuellerMat.SystemMuellerMatrix([mms.DiattenuatorRetarder(name='Periscope'), mms.DiattenuatorRetarder2(name='witzel')])
+	jac = default_sys_mm.jacobian(['Periscope.phi', 'witzel.r1', 'witzel.delta'])
+	assert np.all(np.isfinite(jac))
+	for param in ['Periscope.epsilon', 'witzel.r2']:
+		try:
+			default_sys_mm.jacobian([param])
+			raise AssertionError("The derivative with respect to {} should be undefined".format(param))
+		except ValueError:
+			pass
+
+
+def test_double_difference_model():
+	'''
+	Check the batched forward model against the loop in Notebooks/vampires_calibration_model.ipynb
+	'''
+	from pyMuellerMat import forward_model
+
+	wollaston = mms.WollastonPrism()
+	flc = mms.Retarder(name='flc')
+	flc.properties['phi'] = 2*np.pi*0.5
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	optics.properties['epsilon'] = 0.02
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	sky = mms.Rotator(name='sky_pa')
+	sys_mm = MuellerMat.SystemMuellerMatrix([wollaston, flc, optics, image_rotator, hwp, sky])
+
+	hwp_angles = np.linspace(0, 90, 8)
+	imrot_angs = np.linspace(45, 135, 5)
+	parang = 30.
+	input_stokes = np.array([1, 0.1, -0.05, 0])
+	em_gain_ratio = 0.5
+
+	intensities = np.zeros([2, 2, len(hwp_angles), len(imrot_angs)])
+	sys_mm.master_property_dict['sky_pa']['pa'] = parang
+	for i in range(len(hwp_angles)):
+		for j in range(len(imrot_angs)):
+			sys_mm.master_property_dict['hwp']['theta'] = hwp_angles[i]
+			sys_mm.master_property_dict['image_rotator']['theta'] = imrot_angs[j]
+			for k, beam in enumerate(['o', 'e']):
+				for l, flc_theta in enumerate([0, 45]):
+					sys_mm.master_property_dict['WollastonPrism']['beam'] = beam
+					sys_mm.master_property_dict['flc']['theta'] = flc_theta
+					gain = em_gain_ratio if beam == 'o' else 1.
+					intensities[k, l, i, j] = gain*np.matmul(sys_mm.evaluate(), input_stokes)[0]
+
+	single_diffs = intensities[0] - intensities[1]
+	single_sums = intensities[0] + intensities[1]
+	double_diff = (single_diffs[0] - single_diffs[1])/(single_sums[0] + single_sums[1])
+	double_sum = (single_diffs[0] + single_diffs[1])/(single_sums[0] + single_sums[1])
+
+	sys_mm.master_property_dict['sky_pa']['pa'] = 0.
+	model = forward_model.DoubleDifferenceModel(sys_mm, parang_param='sky_pa.pa')
+	result = model.evaluate(input_stokes, hwp_angles[:, None], imrot_angs[None, :], parallactic_angles=parang,
+							em_gain_ratio=em_gain_ratio)
+
+	np.testing.assert_allclose(result['intensities'], intensities, rtol=0, atol=1e-14)
+	np.testing.assert_allclose(result['double_diff'], double_diff, rtol=0, atol=1e-13)
+	np.testing.assert_allclose(result['double_sum'], double_sum, rtol=0, atol=1e-13)
+
+	# The system is left the way it was
+	assert sys_mm.master_property_dict['sky_pa']['pa'] == 0.
+	assert sys_mm.evaluate().shape == (4, 4)
+
+
+def test_evaluate_row():
+	'''
+	Check that evaluate_row matches the rows of evaluate, and that mixing the two doesn't confuse the cached products.
+	'''
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	optics.properties['epsilon'] = 0.02
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), optics, image_rotator, hwp])
+
+	rng = np.random.default_rng(3)
+	for i in range(20):
+		new_property_dict = {'hwp': {'theta': rng.uniform(0, 90)}, 'Periscope': {'phi': rng.uniform(0, 1)}}
+		if i % 2:
+			row = sys_mm.evaluate_row(new_property_dict)
+			np.testing.assert_allclose(row, sys_mm.evaluate()[0], rtol=0, atol=1e-14)
+		else:
+			mm = sys_mm.evaluate(new_property_dict)
+			np.testing.assert_allclose(sys_mm.evaluate_row(), mm[0], rtol=0, atol=1e-14)
+			np.testing.assert_allclose(sys_mm.evaluate_row(row=[0, 0, 1, 0]), mm[2], rtol=0, atol=1e-14)
+
+	# Batched properties and batched rows
+	hwp_angles = np.linspace(0, 90, 7)[:, None]
+	imrot_angs = np.linspace(45, 135, 5)[None, :]
+	rows = sys_mm.evaluate_row({'hwp': {'theta': hwp_angles}, 'image_rotator': {'theta': imrot_angs}},
+							   row=np.eye(4)[:, None, None, :])
+	mms_ = sys_mm.evaluate()
+	assert rows.shape == (4, 7, 5, 4)
+	for i in range(4):
+		np.testing.assert_allclose(rows[i], mms_[..., i, :], rtol=0, atol=1e-14)
+
+	# The returned row is a copy, even when every product is already cached
+	row = sys_mm.evaluate_row()
+	row[...] = 99
+	np.testing.assert_allclose(sys_mm.evaluate()[..., 0, :], mms_[..., 0, :], rtol=0, atol=1e-14)
+
+
+def test_propagate():
+	'''
+	Check that propagate matches applying the evaluated system mueller matrix, for both contraction orders.
+	'''
+	ip = mms.InstrumentalPolarization(name='ip')
+	ip.properties['IPQ'] = 0.02
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.4
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), image_rotator, hwp, mms.Rotator(name='altitude'), ip])
+
+	rng = np.random.default_rng(5)
+	stokes_cube = rng.normal(size=(3, 50, 4))
+	altitudes = np.linspace(0, 90, 3)[:, None]
+
+	# Lots of Stokes vectors for each system matrix (matrix chain)
+	expected = np.einsum('...ij,...j->...i', sys_mm.evaluate({'altitude': {'pa': altitudes}}), stokes_cube)
+	np.testing.assert_allclose(sys_mm.propagate(stokes_cube, altitude={'pa': altitudes}), expected, rtol=0, atol=1e-14)
+	np.testing.assert_allclose(sys_mm._propagate_vector(stokes_cube), expected, rtol=0, atol=1e-14)
+
+	# One Stokes vector per system matrix (vector chain)
+	hwp_angles = rng.uniform(0, 90, 3)[:, None]
+	imrot_angs = rng.uniform(0, 90, 4)[None, :]
+	stokes = rng.normal(size=(3, 4, 4))
+	stokes_out = sys_mm.propagate(stokes, hwp={'theta': hwp_angles}, image_rotator={'theta': imrot_angs})
+	expected = np.einsum('...ij,...j->...i', sys_mm.evaluate(), stokes)
+	np.testing.assert_allclose(stokes_out, expected, rtol=0, atol=1e-14)
+	np.testing.assert_allclose(sys_mm._propagate_matrix(stokes), expected, rtol=0, atol=1e-14)
+
+
+def test_demodulate_frames():
+	'''
+	Simulate frames with a spatially varying image rotator retardance, then check that the streaming
+	demodulation (from and to memory-mapped .npy files) recovers the input Stokes cube.
+	'''
+	import os
+	import tempfile
+	from pyMuellerMat import streaming
+
+	image_rotator = mms.Retarder(name='image_rotator')
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), image_rotator, hwp])
+
+	ny, nx = 6, 5
+	rng = np.random.default_rng(7)
+	stokes_cube = np.concatenate([np.ones((1, ny, nx)), rng.uniform(-0.2, 0.2, (3, ny, nx))])
+	retardance_map = rng.uniform(2, 3, (ny, nx))
+
+	hwp_angles = np.tile(np.repeat([0., 22.5, 45., 67.5], 2), 2)
+	imrot_angs = np.repeat([45., 60.], 8)
+	beams = np.tile(['o', 'e'], 8)
+
+	frames = np.zeros((len(hwp_angles), ny, nx))
+	for f in range(len(hwp_angles)):
+		for y in range(ny):
+			for x in range(nx):
+				mm = sys_mm.evaluate({'hwp': {'theta': hwp_angles[f]}, 'WollastonPrism': {'beam': beams[f]},
+									  'image_rotator': {'theta': imrot_angs[f], 'phi': retardance_map[y, x]}})
+				frames[f, y, x] = mm[0] @ stokes_cube[:, y, x]
+
+	with tempfile.TemporaryDirectory() as directory:
+		np.save(os.path.join(directory, 'frames.npy'), frames)
+		np.save(os.path.join(directory, 'retardance.npy'), retardance_map)
+		output = streaming.demodulate_frames(sys_mm, os.path.join(directory, 'frames.npy'),
+											 {'hwp.theta': hwp_angles, 'image_rotator.theta': imrot_angs, 'WollastonPrism.beam': beams},
+											 pixel_properties={'image_rotator.phi': os.path.join(directory, 'retardance.npy')},
+											 output=os.path.join(directory, 'stokes.npy'), tile_size=7)
+		del output
+		np.testing.assert_allclose(np.load(os.path.join(directory, 'stokes.npy')), stokes_cube, rtol=0, atol=1e-10)
+
+	# Without per-pixel properties there's a single measurement matrix
+	sys_mm.master_property_dict['image_rotator']['phi'] = 2.5
+	frames = np.einsum('fi,iyx->fyx', np.array([sys_mm.evaluate({'hwp': {'theta': hwp_angles[f]}, 'WollastonPrism': {'beam': beams[f]},
+																 'image_rotator': {'theta': imrot_angs[f]}})[0]
+												 for f in range(len(hwp_angles))]), stokes_cube)
+	output = streaming.demodulate_frames(sys_mm, frames, {'hwp.theta': hwp_angles, 'image_rotator.theta': imrot_angs,
+														  'WollastonPrism.beam': beams}, tile_size=7)
+	np.testing.assert_allclose(output, stokes_cube, rtol=0, atol=1e-10)
+
+
+def test_parallel_evaluate():
+	'''
+	Check that the parallel executors give the same answer, in the same order, as a single batched evaluation.
+	'''
+	from pyMuellerMat import parallel
+
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), mms.Retarder(name='flc'), image_rotator, hwp])
+
+	n = 1001
+	rng = np.random.default_rng(11)
+	values = {'hwp.theta': rng.uniform(0, 90, n), 'image_rotator.theta': rng.uniform(45, 135, n),
+			  'flc.theta': rng.choice([0., 45.], n), 'WollastonPrism.beam': rng.choice(['o', 'e'], n), 'flc.phi': np.pi}
+	expected = sys_mm.evaluate({'hwp': {'theta': values['hwp.theta']}, 'image_rotator': {'theta': values['image_rotator.theta']},
+								'flc': {'theta': values['flc.theta'], 'phi': np.pi}, 'WollastonPrism': {'beam': values['WollastonPrism.beam']}})
+
+	for backend in ['thread', 'process']:
+		output = parallel.parallel_evaluate(sys_mm, values, n_workers=3, backend=backend, chunk_size=100)
+		np.testing.assert_allclose(output, expected, rtol=0, atol=1e-14)
+		rows = parallel.parallel_evaluate(sys_mm, values, n_workers=2, backend=backend, row=True)
+		np.testing.assert_allclose(rows, expected[:, 0], rtol=0, atol=1e-14)
+
+
+def test_invert():
+	'''
+	Check the closed-form and numerical inverses of single components and systems, including stacks
+	'''
+	retarder = mms.Retarder(name='ret')
+	retarder.properties.update(phi=0.7, theta=12.)
+	diattenuator = mms.DiattenuatorRetarder(name='diat')
+	diattenuator.properties.update(epsilon=0.2, phi=0.3, theta=-40.)
+	ip = mms.InstrumentalPolarization(name='ip')
+	ip.properties.update(IPQ=0.05, IPU=-0.02, IPV=0.01)
+	polarizer = mms.Polarizer()
+	polarizer.properties.update(px=0.9, py=0.6, theta=30.)
+
+	for mm in [retarder, diattenuator, ip, mms.Rotator(), polarizer, mms.UV_Sign_Flip()]:
+		np.testing.assert_allclose(mm.invert() @ mm.evaluate(), np.eye(4), rtol=0, atol=1e-12)
+
+	# A stack of rotations
+	retarder.properties['theta'] = np.linspace(0, 180, 7)
+	np.testing.assert_allclose(retarder.invert() @ retarder.evaluate(), np.broadcast_to(np.eye(4), (7, 4, 4)), rtol=0, atol=1e-12)
+	retarder.properties['theta'] = 12.
+
+	# A system with closed-form inverses, and the same system inverted numerically
+	sys_mm = MuellerMat.SystemMuellerMatrix([ip, diattenuator, retarder])
+	mm = sys_mm.evaluate()
+	np.testing.assert_allclose(sys_mm.invert() @ mm, np.eye(4), rtol=0, atol=1e-12)
+	np.testing.assert_allclose(sys_mm.invert(), np.linalg.inv(mm), rtol=0, atol=1e-12)
+	mm_inv = sys_mm.invert({'ret': {'theta': np.array([0., 10., 20.])}})
+	np.testing.assert_allclose(mm_inv @ sys_mm.evaluate(), np.broadcast_to(np.eye(4), (3, 4, 4)), rtol=0, atol=1e-12)
+	sys_mm.master_property_dict['ret']['theta'] = 12.
+
+	# Wollaston prisms are singular, so they only have a pseudo-inverse
+	wollaston = mms.WollastonPrism()
+	try:
+		wollaston.invert()
+		raise AssertionError("Inverting a wollaston prism should fail")
+	except np.linalg.LinAlgError:
+		pass
+	mm = wollaston.evaluate()
+	np.testing.assert_allclose(mm @ wollaston.invert(pseudo=True) @ mm, mm, rtol=0, atol=1e-12)
+
+
+def test_demodulate():
+	'''
+	Recover Stokes vectors from simulated intensities, with a shared and a per-pixel measurement matrix
+	'''
+	from pyMuellerMat import demodulation
+
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	image_rotator = mms.Retarder(name='image_rotator')
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), image_rotator, hwp])
+
+	hwp_angles = np.tile(np.repeat([0., 22.5, 45., 67.5], 2), 2)
+	imrot_angs = np.repeat([45., 60.], 8)
+	beams = np.tile(['o', 'e'], 8)
+	rng = np.random.default_rng(3)
+	stokes = np.concatenate([np.ones((50, 1)), rng.uniform(-0.2, 0.2, (50, 3))], axis=1)
+
+	values = {'hwp.theta': hwp_angles, 'image_rotator.theta': imrot_angs, 'WollastonPrism.beam': beams, 'image_rotator.phi': 2.5}
+	measurement_matrix = demodulation.build_measurement_matrix(sys_mm, values)
+	assert measurement_matrix.shape == (16, 4)
+	intensities = stokes @ measurement_matrix.T
+	np.testing.assert_allclose(demodulation.demodulate(measurement_matrix, intensities), stokes, rtol=0, atol=1e-12)
+	np.testing.assert_allclose(demodulation.demodulation_matrix(measurement_matrix) @ measurement_matrix, np.eye(4), rtol=0, atol=1e-12)
+
+	# A different retardance for every pixel
+	values['image_rotator.phi'] = rng.uniform(2, 3, (50, 1))
+	measurement_matrix = demodulation.build_measurement_matrix(sys_mm, values)
+	assert measurement_matrix.shape == (50, 16, 4)
+	intensities = np.einsum('pmi,pi->pm', measurement_matrix, stokes)
+	np.testing.assert_allclose(demodulation.demodulate(measurement_matrix, intensities), stokes, rtol=0, atol=1e-12)
+	weights = rng.uniform(0.5, 2, (50, 16))
+	np.testing.assert_allclose(demodulation.demodulate(measurement_matrix, intensities, weights=weights), stokes, rtol=0, atol=1e-12)
+
+
+def test_rotate_mueller_matrix():
+	'''
+	Check the closed-form rotation against R.T @ M @ R, for single matrices, stacks and reused trig
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+
+	rng = np.random.default_rng(5)
+	mm = rng.normal(size=(4, 4))
+	for pa in [0., 22.5, -37., 200.]:
+		rotator = cmf.rotator_function(pa)
+		np.testing.assert_allclose(cmf.rotate_mueller_matrix(mm, pa), rotator.T @ mm @ rotator, rtol=0, atol=1e-14)
+
+	# A stack of angles and a stack of matrices, broadcast against each other
+	angles = rng.uniform(0, 180, (3, 1))
+	stack = rng.normal(size=(5, 4, 4))
+	rotators = cmf.rotator_function_vectorized(angles).reshape(3, 1, 4, 4)
+	expected = np.swapaxes(rotators, -1, -2) @ stack @ rotators
+	np.testing.assert_allclose(cmf.rotate_mueller_matrix(stack, angles), expected, rtol=0, atol=1e-14)
+	trig = cmf.rotation_trig(angles)
+	np.testing.assert_allclose(cmf.rotate_mueller_matrix(stack, trig=trig), expected, rtol=0, atol=1e-14)
+
+	# Evaluating the same angles again reuses the trig, and changing them in place doesn't
+	retarder = mms.Retarder()
+	retarder.properties['phi'] = 1.
+	hwp_angles = np.array([0., 22.5, 45., 67.5])
+	retarder.properties['theta'] = hwp_angles
+	first = retarder.evaluate()
+	np.testing.assert_allclose(retarder.evaluate(), first, rtol=0, atol=0)
+	hwp_angles[1] = 10.
+	retarder.properties['theta'] = hwp_angles
+	np.testing.assert_allclose(retarder.evaluate()[1], cmf.rotate_mueller_matrix(cmf.general_retarder_function(1.), 10.), rtol=0, atol=1e-14)
+
+
+def test_angle_grid():
+	'''
+	Check that evaluating with registered angle grids gives the same answers, on and off the grid
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+
+	retarder = mms.Retarder()
+	hwp_angles = np.array([0., 22.5, 45., 67.5, 10.])
+	phis = np.array([np.pi, np.pi / 2, 1.])
+	expected_single = []
+	for theta in hwp_angles:
+		retarder.properties.update(theta=theta, phi=np.pi)
+		expected_single.append(retarder.evaluate().copy())
+	retarder.properties.update(theta=hwp_angles[:, None], phi=phis[None, :])
+	expected_batch = retarder.evaluate().copy()
+
+	cmf.register_angle_grid(cmf.rotator_function, 'pa', hwp_angles[:4])
+	grid = cmf.register_angle_grid(cmf.general_retarder_function, 'phi', [np.pi / 2, np.pi])
+	try:
+		np.testing.assert_allclose(grid.find([np.pi, 1., np.pi / 2])[1], [True, False, True])
+
+		# A new object, so that nothing is cached
+		retarder = mms.Retarder()
+		for theta, expected in zip(hwp_angles, expected_single):
+			retarder.properties.update(theta=theta, phi=np.pi)
+			np.testing.assert_allclose(retarder.evaluate(), expected, rtol=0, atol=1e-15)
+		retarder.properties.update(theta=hwp_angles[:, None], phi=phis[None, :])
+		np.testing.assert_allclose(retarder.evaluate(), expected_batch, rtol=0, atol=1e-15)
+
+		# 0-d arrays work like numbers, on and off the grid
+		for theta, expected in zip(hwp_angles, expected_single):
+			retarder.properties.update(theta=np.asarray(theta), phi=np.asarray(np.pi))
+			np.testing.assert_allclose(retarder.evaluate(), expected, rtol=0, atol=1e-15)
+
+		# The grid isn't used if the other keyword arguments don't match
+		polarizer_grid = cmf.AngleGrid(cmf.general_polarizer_function, 'px', [0.5, 1.], py=0.5)
+		assert polarizer_grid.evaluate({'px': 0.5, 'py': 1.}) is None
+		np.testing.assert_allclose(polarizer_grid.evaluate({'px': 0.5, 'py': 0.5}), cmf.general_polarizer_function(0.5, 0.5))
+	finally:
+		cmf.unregister_angle_grid(cmf.rotator_function)
+		cmf.unregister_angle_grid(cmf.general_retarder_function)
+
+
+def test_chromatic():
+	'''
+	Check wavelength dependent components, the bandpass integration, and their derivatives and compiled versions
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+
+	# The FLC in Notebooks/vampires_flc_retardance.ipynb
+	wavelength0, wavelength = 700., 675.
+	flc = mms.Retarder(name='flc', wavelength0=wavelength0)
+	flc.properties.update(phi=np.pi, wavelength=wavelength)
+	np.testing.assert_allclose(flc.evaluate(), cmf.general_retarder_function(np.pi * wavelength0 / wavelength), rtol=0, atol=1e-15)
+
+	# A chromatic HWP is half-wave at its design wavelength
+	hwp = mms.HWP(name='hwp', wavelength0=wavelength0)
+	np.testing.assert_allclose(hwp.default_mm, cmf.halfwave_retarder_function(), rtol=0, atol=1e-15)
+	hwp.properties['wavelength'] = np.array([650., 700., 750.])
+	assert hwp.evaluate().shape == (3, 4, 4)
+	hwp.properties['wavelength'] = wavelength0
+
+	# Bandpass integration in one pass, against a loop over the wavelengths
+	diattenuator = mms.DiattenuatorRetarder(name='optics', wavelength0=wavelength0, diattenuation_dispersion='linear')
+	diattenuator.dispersion['epsilon'][1]['slope'] = 1e-4
+	diattenuator.properties.update(epsilon=0.02, phi=0.3)
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), diattenuator, hwp])
+	wavelengths = np.linspace(625, 725, 11)
+	weights = np.exp(-0.5 * ((wavelengths - 675) / 30) ** 2)
+	hwp_angles = np.array([0., 22.5, 45., 67.5])
+
+	expected = 0
+	for wavelength, weight in zip(wavelengths, weights):
+		sys_mm.set_wavelength(wavelength)
+		expected = expected + weight * sys_mm.evaluate({'hwp': {'theta': hwp_angles}})
+	expected = expected / np.sum(weights)
+	sys_mm.set_wavelength(wavelength0)
+
+	broadband = sys_mm.evaluate_bandpass(wavelengths, weights)
+	np.testing.assert_allclose(broadband, expected, rtol=0, atol=1e-14)
+	assert hwp.properties['wavelength'] == wavelength0
+	sys_mm.master_property_dict['hwp']['theta'] = 10.
+
+	# Derivatives with respect to a wavelength dependent property and the wavelength itself
+	sys_mm.set_wavelength(680.)
+	step = 1e-6
+	for param in ['hwp.phi', 'optics.epsilon', 'optics.wavelength']:
+		name, key = param.split('.')
+		value = sys_mm.master_property_dict[name][key]
+		mm_plus = sys_mm.evaluate({name: {key: value + step}})
+		mm_minus = sys_mm.evaluate({name: {key: value - step}})
+		sys_mm.master_property_dict[name][key] = value
+		np.testing.assert_allclose(sys_mm.jacobian([param])[0], (mm_plus - mm_minus) / (2 * step), rtol=0, atol=1e-7)
+
+	# A compiled system applies the dispersion laws to the free parameters
+	model = sys_mm.compile(['hwp.phi', 'optics.epsilon'])
+	x = np.array([3., 0.03])
+	np.testing.assert_allclose(model(x), sys_mm.evaluate({'hwp': {'phi': 3.}, 'optics': {'epsilon': 0.03}}), rtol=0, atol=1e-14)
+	np.testing.assert_allclose(model.batch(x[None])[0], model(x), rtol=0, atol=1e-14)
+
+
+def test_clone():
+	'''
+	Check the lazy default mueller matrices, and that clones of components and systems are independent
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	assert hwp._default_mm is None
+	np.testing.assert_allclose(hwp.default_mm, np.eye(4))
+	np.testing.assert_allclose(hwp.mm, np.eye(4))
+
+	# The system default is for the properties when it was made
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties.update(phi=1., theta=30.)
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), image_rotator, hwp])
+	expected = sys_mm.evaluate().copy()
+	sys_mm.master_property_dict['hwp']['theta'] = 10.
+	np.testing.assert_allclose(sys_mm.default_mm, expected, rtol=0, atol=1e-15)
+
+	# A cloned system starts with the same cached products, and then changes independently
+	new_sys_mm = sys_mm.clone()
+	np.testing.assert_allclose(new_sys_mm.evaluate(), sys_mm.evaluate(), rtol=0, atol=0)
+	new_sys_mm.master_property_dict['hwp']['theta'] = 20.
+	new_sys_mm.mueller_matrix_list[1].properties['phi'] = 2.
+	np.testing.assert_allclose(sys_mm.evaluate(), sys_mm.evaluate({'hwp': {'theta': 10.}}), rtol=0, atol=0)
+	assert sys_mm.master_property_dict['image_rotator']['phi'] == 1.
+	expected = cmf.rotate_mueller_matrix(cmf.general_retarder_function(2.), 30.) @ cmf.rotate_mueller_matrix(cmf.general_retarder_function(np.pi), 20.)
+	np.testing.assert_allclose(new_sys_mm.evaluate(), cmf.wollaston_prism_function() @ expected, rtol=0, atol=1e-14)
+
+	# Chromatic components keep their own dispersion laws
+	flc = mms.Retarder(name='flc', wavelength0=700.)
+	new_flc = flc.clone()
+	new_flc.set_dispersion('phi', None)
+	assert 'phi' in flc.dispersion and 'phi' not in new_flc.dispersion
+
+
+def test_parameter_vector():
+	'''
+	Check that get_vector and set_vector agree with the property dictionaries
+	'''
+	import pickle
+
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), mms.Retarder(name='image_rotator'), hwp])
+
+	# The wollaston prism's beam isn't a number, so it isn't in the vector
+	names = sys_mm.parameter_names
+	assert 'hwp.theta' in names and 'WollastonPrism.beam' not in names
+	vector = sys_mm.get_vector()
+	assert vector[names.index('hwp.phi')] == np.pi
+
+	# Changes to the dictionaries show up in the vector
+	sys_mm.master_property_dict['hwp']['theta'] = 10.
+	assert vector[names.index('hwp.theta')] == 10.
+
+	# Setting the vector only re-evaluates the components that changed
+	expected = sys_mm.evaluate({'image_rotator': {'phi': 1., 'theta': 30.}}).copy()
+	sys_mm.evaluate({'image_rotator': {'phi': 0., 'theta': 0.}})
+	hwp_mm = sys_mm._component_mms[2]
+	sys_mm.set_vector([1., 30.], ['image_rotator.phi', 'image_rotator.theta'])
+	np.testing.assert_allclose(sys_mm.evaluate(), expected, rtol=0, atol=1e-15)
+	assert sys_mm._component_mms[2] is hwp_mm
+
+	new_vector = sys_mm.get_vector().copy()
+	new_vector[names.index('hwp.theta')] = 20.
+	sys_mm.set_vector(new_vector)
+	assert sys_mm.master_property_dict['hwp']['theta'] == 20.
+	np.testing.assert_allclose(sys_mm.evaluate(), sys_mm.evaluate({'hwp': {'theta': 20.}}), rtol=0, atol=0)
+
+	# Array properties are NaN, and are left alone by a NaN
+	angles = np.array([0., 45.])
+	sys_mm.master_property_dict['hwp']['theta'] = angles
+	new_vector = sys_mm.get_vector().copy()
+	assert np.isnan(new_vector[names.index('hwp.theta')])
+	sys_mm.set_vector(new_vector)
+	assert sys_mm.master_property_dict['hwp']['theta'] is angles
+
+	try:
+		sys_mm.get_vector(['hwp.beam'])
+		raise AssertionError("Expected a ValueError")
+	except ValueError:
+		pass
+
+	# Copies keep working, and are independent
+	sys_mm.master_property_dict['hwp']['theta'] = 20.
+	new_sys_mm = pickle.loads(pickle.dumps(sys_mm))
+	new_sys_mm.set_vector([5.], ['hwp.theta'])
+	assert sys_mm.get_vector(['hwp.theta'])[0] == 20.
+	assert new_sys_mm.master_property_dict['hwp']['theta'] == 5.
+	assert sys_mm.clone().get_vector(['hwp.theta'])[0] == 20.
+
+
+def test_profile():
+	'''
+	Check the evaluation statistics
+	'''
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = np.pi
+	hwp.enable_cache()
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), mms.Retarder(name='image_rotator'), hwp])
+	assert sys_mm.stats is None
+
+	with sys_mm.profile() as stats:
+		for theta in [0., 22.5, 0., 22.5]:
+			expected = sys_mm.evaluate({'hwp': {'theta': theta}}).copy()
+		sys_mm.evaluate_row()
+	assert sys_mm.stats is None
+
+	np.testing.assert_allclose(sys_mm.evaluate({'hwp': {'theta': 22.5}}), expected, rtol=0, atol=0)
+	assert stats.calls == {'evaluate': 4, 'evaluate_row': 1}
+
+	# The first evaluate evaluates everything, after that only the HWP changes (and comes from its cache twice)
+	hwp_stats = stats.components['hwp']
+	assert (hwp_stats.evaluations, hwp_stats.skipped, hwp_stats.cache_hits, hwp_stats.arrays) == (4, 1, 2, 2)
+	assert hwp_stats.hit_rate == 3 / 5.
+	assert stats.components['image_rotator'].evaluations == 1 and stats.components['image_rotator'].skipped == 4
+	assert 'image_rotator' in str(stats)
+
+	stats = sys_mm.enable_stats(trace_memory=True)
+	sys_mm.evaluate({'image_rotator': {'theta': np.linspace(0, 90, 100)}})
+	assert stats.components['image_rotator'].bytes == 100 * 16 * 8
+	if stats.trace_memory:
+		assert stats.components['image_rotator'].peak_memory >= 100 * 16 * 8
+	assert sys_mm.disable_stats() is stats and sys_mm.stats is None
+
+	# Arrays reused from a workspace aren't new allocations
+	sys_mm.enable_workspace()
+	with sys_mm.profile() as stats:
+		for i in range(3):
+			sys_mm.evaluate({'image_rotator': {'theta': np.linspace(0, 90, 100) + i}})
+	assert stats.components['image_rotator'].evaluations == 3
+	assert stats.components['image_rotator'].arrays == 1 and stats.components['image_rotator'].bytes == 100 * 16 * 8
+
+
+def test_log_likelihood():
+	'''
+	Check the vectorized log-likelihood against one model evaluation per walker
+	'''
+	from pyMuellerMat import forward_model
+	from pyMuellerMat.likelihood import DoubleDifferenceLogLikelihood
+
+	flc = mms.Retarder(name='flc')
+	flc.properties['phi'] = 2*np.pi*0.5
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties['phi'] = 2*np.pi*0.43
+	image_rotator = mms.Retarder(name='image_rotator')
+	image_rotator.properties['phi'] = 2*np.pi*0.31
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, image_rotator, hwp])
+	model = forward_model.DoubleDifferenceModel(sys_mm)
+
+	hwp_angles = np.linspace(0, 90, 8)[:, None]
+	imrot_angs = np.linspace(45, 135, 5)[None, :]
+	stokes = np.array([1, 0.1, -0.05, 0])
+	free_params = ['flc.phi', 'hwp.delta_theta']
+	truth = np.array([1.02*np.pi, 3.])
+
+	# The model with a batch of parameters matches setting each of them
+	data = model.evaluate(stokes, hwp_angles, imrot_angs, params=dict(zip(free_params, truth)))
+	flc.properties['phi'] = truth[0]
+	hwp.properties['delta_theta'] = truth[1]
+	np.testing.assert_allclose(data['double_diff'], model.evaluate(stokes, hwp_angles, imrot_angs)['double_diff'], rtol=0, atol=1e-14)
+	flc.properties['phi'] = 2*np.pi*0.5
+	hwp.properties['delta_theta'] = 0.
+
+	log_likelihood = DoubleDifferenceLogLikelihood(model, free_params, data, 0.01, stokes, hwp_angles, imrot_angs,
+		bounds={'flc.phi': (0, 2*np.pi)})
+	x = truth + np.random.default_rng(0).normal(0, 0.05, (16, 2))
+	x[3, 0] = -1.
+
+	logl = log_likelihood(x)
+	assert logl.shape == (16,) and logl[3] == -np.inf
+	np.testing.assert_allclose(logl, log_likelihood.evaluate_loop(x), rtol=1e-12)
+	assert log_likelihood(truth) == 0.
+	assert log_likelihood(x[0]) == logl[0]
+
+	# The observables with beam and modulator state axes, with an uncertainty for each element
+	observables = ['intensities', 'single_diffs', 'single_sums', 'double_diff']
+	sigma = {observable: np.random.default_rng(1).uniform(0.01, 0.02, np.shape(data[observable])) for observable in observables}
+	log_likelihood = DoubleDifferenceLogLikelihood(model, free_params, data, sigma, stokes, hwp_angles, imrot_angs,
+		observables=observables)
+	np.testing.assert_allclose(log_likelihood(x), log_likelihood.evaluate_loop(x), rtol=1e-12)
+	assert log_likelihood(truth) == 0.
+	try:
+		DoubleDifferenceLogLikelihood(model, free_params, data['double_diff'], 0.01, stokes, hwp_angles, observables='ratio')
+		raise AssertionError("An unknown observable should fail")
+	except ValueError:
+		pass
+
+	# The properties are put back afterwards
+	assert flc.properties['phi'] == 2*np.pi*0.5 and hwp.properties['delta_theta'] == 0.
+
+
+def test_optimize():
+	'''
+	Check that fusing rotators, UV sign flips and retarders doesn't change the system mueller matrix
+	'''
+	def make_system():
+		altitude = mms.Rotator(name='altitude')
+		altitude.properties['pa'] = 40.
+		altitude.properties['theta'] = 5.
+		flip1 = mms.UV_Sign_Flip(name='flip1')
+		flip1.properties['theta'] = 10.
+		flip2 = mms.UV_Sign_Flip(name='flip2')
+		flip2.properties['theta'] = 30.
+		sky = mms.Rotator(name='sky_pa')
+		hwp = mms.HWP(name='hwp')
+		qwp = mms.QWP(name='qwp')
+		retarder = mms.Retarder(name='retarder', wavelength0=700.)
+		retarder.properties['phi'] = 0.3
+		optics = mms.DiattenuatorRetarder(name='optics')
+		optics.properties['epsilon'] = 0.1
+		return MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), hwp, qwp, retarder, optics, altitude, flip1, flip2, sky])
+
+	sys_mm = make_system()
+	fused_sys_mm = make_system().optimize()
+	assert fused_sys_mm.fusions == [('retarder', ['hwp', 'qwp', 'retarder']), ('rotation', ['altitude', 'flip1', 'flip2', 'sky_pa'])]
+	assert fused_sys_mm.matmuls_saved == 5 and len(fused_sys_mm.mueller_matrix_list) == 4
+	assert fused_sys_mm.names == sys_mm.names
+
+	# Retarders at the same and different angles, batches, and wavelengths
+	for new_property_dict in [None, {'hwp': {'theta': 22.5}, 'qwp': {'theta': 22.5}, 'retarder': {'theta': 22.5}},
+							  {'qwp': {'theta': 10.}}, {'sky_pa': {'pa': np.linspace(-60, 60, 7)}, 'flip2': {'theta': 10.}},
+							  {'retarder': {'wavelength': np.linspace(600, 800, 3)[:, None]}, 'altitude': {'pa': np.linspace(30, 80, 7)}}]:
+		np.testing.assert_allclose(fused_sys_mm.evaluate(new_property_dict), sys_mm.evaluate(new_property_dict), rtol=0, atol=1e-14)
+		np.testing.assert_allclose(fused_sys_mm.evaluate_row(), sys_mm.evaluate_row(), rtol=0, atol=1e-14)
+
+	# The fused system shares its properties with the original components
+	fused_sys_mm.master_property_dict['sky_pa']['pa'] = 15.
+	assert fused_sys_mm.system.master_property_dict['sky_pa']['pa'] == 15.
+	np.testing.assert_allclose(fused_sys_mm.evaluate(), fused_sys_mm.system.evaluate(), rtol=0, atol=1e-14)
+	np.testing.assert_allclose(fused_sys_mm.jacobian(['hwp.theta']), fused_sys_mm.system.jacobian(['hwp.theta']))
+
+	# Only rotations
+	assert make_system().optimize(rules=['rotation']).matmuls_saved == 3
+
+	# The fused elements can be profiled
+	fused_sys_mm = make_system().optimize()
+	with fused_sys_mm.profile() as stats:
+		mm = fused_sys_mm.evaluate({'hwp': {'theta': np.linspace(0, 90, 5)}})
+	np.testing.assert_allclose(mm, make_system().evaluate({'hwp': {'theta': np.linspace(0, 90, 5)}}), rtol=0, atol=1e-14)
+	assert stats.calls['evaluate'] == 1 and sum(component.evaluations for component in stats.components.values()) == 4
+
+
+def test_surrogate():
+	'''
+	Check the grid surrogate against the exact system
+	'''
+	from pyMuellerMat.surrogate import GridSurrogate
+
+	flc = mms.Retarder(name='flc')
+	flc.properties['theta'] = 45.
+	optics = mms.DiattenuatorRetarder(name='Periscope')
+	hwp = mms.Retarder(name='hwp')
+	hwp.properties.update(phi=2*np.pi*0.43, theta=22.5)
+	sys_mm = MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, optics, hwp])
+	grid = {'flc.phi': np.linspace(2.8, 3.4, 33), 'Periscope.epsilon': np.linspace(0, 0.05, 5)}
+
+	surrogate = GridSurrogate(sys_mm, grid)
+	assert surrogate.error['max'] < 1e-4
+	assert surrogate.table.shape[:-1] == (33, 5) and surrogate.table.shape[-1] < 16
+
+	# Exact at the grid points, and within the error bound in between
+	x = np.array([[grid['flc.phi'][3], grid['Periscope.epsilon'][2]], [3.1, 0.013], [3.4, 0.05]])
+	exact = surrogate.evaluate_exact(x)
+	mm = surrogate(x)
+	np.testing.assert_allclose(mm[0], exact[0], rtol=0, atol=1e-15)
+	np.testing.assert_allclose(mm, exact, rtol=0, atol=surrogate.error['max'] * 1.5)
+	np.testing.assert_allclose(surrogate(x[1]), mm[1], rtol=0, atol=0)
+	assert np.all(np.isnan(surrogate(np.array([3.5, 0.01]))))
+
+	# Uneven grids, rows and float32 tables
+	grid['flc.phi'] = np.geomspace(2.8, 3.4, 33)
+	row_surrogate = GridSurrogate(sys_mm, grid, row=True, dtype=np.float32)
+	np.testing.assert_allclose(row_surrogate(x), exact[:, 0], rtol=0, atol=row_surrogate.error['max'] * 1.5)
+	assert row_surrogate.table.dtype == np.float32
+
+	# A first row that doesn't depend on the free parameter has nothing to interpolate
+	constant_system = MuellerMat.SystemMuellerMatrix([mms.HWP(), mms.Retarder(name='ret'), mms.DiattenuatorRetarder()])
+	constant_surrogate = GridSurrogate(constant_system, {'ret.phi': np.linspace(0, np.pi, 5)}, row=True)
+	assert constant_surrogate.table.size == 0 and constant_surrogate.error['max'] == 0
+	np.testing.assert_array_equal(constant_surrogate([[0.3], [1.2]]), np.tile(constant_system.evaluate_row(), (2, 1)))
+	assert np.all(np.isnan(constant_surrogate([4.])))
+
+
+def test_storage():
+	'''
+	Save a system with its angle grids and tables, and check that the loaded system gives the same answers
+	and that cached_system only recomputes the tables when the model changes
+	'''
+	import tempfile
+	from pyMuellerMat import common_mm_functions as cmf
+	from pyMuellerMat import storage
+
+	def build():
+		hwp = mms.Retarder(name='hwp')
+		hwp.properties['phi'] = np.pi
+		hwp.set_dispersion('phi', 'inverse', wavelength0=700.)
+		flc = mms.Retarder(name='flc')
+		flc.properties.update(phi=3., theta=45.)
+		return MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, mms.DiattenuatorRetarder(name='Periscope'), hwp])
+
+	hwp_angles = np.linspace(0, 90, 7)
+	sys_mm = build()
+	sys_mm.master_property_dict['hwp']['wavelength'] = 675.
+	sys_mm.master_property_dict['Periscope']['epsilon'] = np.array([0.01, 0.02])
+
+	with tempfile.TemporaryDirectory() as directory:
+		cmf.register_angle_grid(cmf.rotator_function, 'pa', [0., 22.5, 45., 67.5])
+		try:
+			model_hash = storage.save_system(sys_mm, directory, tables={'hwp': np.arange(32.).reshape(2, 4, 4)})
+			cmf.unregister_angle_grid(cmf.rotator_function)
+			loaded, tables = storage.load_system(directory, expected_hash=model_hash)
+			assert cmf.rotator_function in cmf.angle_grids
+			assert storage.model_hash(loaded) == model_hash
+		finally:
+			cmf.unregister_angle_grid(cmf.rotator_function)
+
+		assert isinstance(tables['hwp'], np.memmap)
+		np.testing.assert_allclose(tables['hwp'], np.arange(32.).reshape(2, 4, 4))
+		assert loaded.names == sys_mm.names and type(loaded.mueller_matrix_list[1]) is mms.Retarder
+		np.testing.assert_allclose(loaded.default_mm, sys_mm.default_mm, rtol=0, atol=1e-15)
+		np.testing.assert_allclose(loaded.evaluate(), sys_mm.evaluate(), rtol=0, atol=1e-15)
+		np.testing.assert_allclose(loaded.evaluate({'hwp': {'theta': hwp_angles[:, None]}}),
+								   sys_mm.evaluate({'hwp': {'theta': hwp_angles[:, None]}}), rtol=0, atol=1e-15)
+
+		# Any change to the model changes its hash
+		sys_mm.master_property_dict['flc']['phi'] = 3.1
+		assert storage.model_hash(sys_mm) != model_hash
+		try:
+			storage.load_system(directory, expected_hash=storage.model_hash(sys_mm))
+			raise AssertionError("Loading a changed model should fail")
+		except ValueError:
+			pass
+
+		# Only compute the tables the first time
+		n_calls = []
+		def hwp_table(system):
+			n_calls.append(1)
+			return system.evaluate({'hwp': {'theta': hwp_angles}})
+		grids = [(cmf.rotator_function, 'pa', hwp_angles)]
+		try:
+			cached_path = directory + '/cached'
+			_, first_tables = storage.cached_system(cached_path, build, tables={'hwp': (hwp_table, hwp_angles)}, grids=grids)
+			cmf.unregister_angle_grid(cmf.rotator_function)
+			cached, cached_tables = storage.cached_system(cached_path, build, tables={'hwp': (hwp_table, hwp_angles)}, grids=grids)
+			assert len(n_calls) == 1 and cmf.rotator_function in cmf.angle_grids
+			np.testing.assert_allclose(cached_tables['hwp'], first_tables['hwp'], rtol=0, atol=0)
+			np.testing.assert_allclose(cached.evaluate(), build().evaluate(), rtol=0, atol=1e-15)
+
+			# A different grid is a different model
+			storage.cached_system(cached_path, build, tables={'hwp': (hwp_table, hwp_angles)}, grids=[(cmf.rotator_function, 'pa', [0., 45.])])
+			assert len(n_calls) == 2
+
+			# Tables are recomputed when the values they use change, whether they're given as a key or used by the function
+			storage.cached_system(cached_path, build, tables={'hwp': (hwp_table, hwp_angles[:3])}, grids=grids)
+			assert len(n_calls) == 3
+			for n_angles, loaded in [(10, False), (10, True), (20, False)]:
+				angles = np.linspace(0, 90, n_angles)
+				_, closure_tables = storage.cached_system(cached_path, build, grids=grids,
+														  tables={'pa': lambda system: system.evaluate({'hwp': {'theta': angles}})})
+				assert closure_tables['pa'].shape == (n_angles, 4, 4)
+				assert isinstance(closure_tables['pa'], np.memmap) == loaded
+		finally:
+			cmf.unregister_angle_grid(cmf.rotator_function)
+
+		# Functions that can't be imported by name can't be saved
+		anonymous = MuellerMat.SystemMuellerMatrix([MuellerMat.MuellerMatrix(lambda: np.eye(4), name='anonymous')])
+		try:
+			storage.save_system(anonymous, directory + '/anonymous')
+			raise AssertionError("Saving a lambda should fail")
+		except ValueError:
+			pass
+
+
+def test_precision():
+	'''
+	Check float32 evaluations against float64, and that a workspace gives the same answers as allocating new arrays
+	'''
+	from pyMuellerMat import common_mm_functions as cmf
+	from pyMuellerMat import precision
+
+	assert cmf.general_retarder_function_vectorized(np.linspace(0, 1, 5), dtype=np.float32).dtype == np.float32
+	errors = precision.compare_precision(n_samples=1000)
+	assert max(errors.values()) < 1e-6
+
+	def build(dtype=float):
+		flc = mms.Retarder(name='flc')
+		flc.properties.update(phi=3., theta=45.)
+		hwp = mms.Retarder(name='hwp')
+		hwp.properties['phi'] = 2 * np.pi * 0.43
+		return MuellerMat.SystemMuellerMatrix([mms.WollastonPrism(), flc, mms.DiattenuatorRetarder(name='Periscope'),
+											   mms.Rotator(name='altitude'), hwp], dtype=dtype)
+
+	exact = build()
+	single = build(np.float32)
+	reused = build()
+	workspace = reused.enable_workspace()
+	single.enable_workspace(workspace)
+
+	rng = np.random.default_rng(3)
+	results = []
+	for i in range(4):
+		new_properties = {'hwp': {'theta': rng.uniform(0, 90, 50)}, 'altitude': {'pa': rng.uniform(0, 90, (1, 1)) if i % 2 else 10.}}
+		expected = exact.evaluate(new_properties)
+		results.append((expected, reused.evaluate(new_properties)))
+		np.testing.assert_allclose(results[-1][1], expected, rtol=0, atol=1e-15)
+		mm = single.evaluate(new_properties)
+		assert mm.dtype == np.float32
+		np.testing.assert_allclose(mm, expected, rtol=0, atol=1e-6)
+		np.testing.assert_allclose(reused.evaluate_row(), exact.evaluate_row(), rtol=0, atol=1e-15)
+		assert single.evaluate_row().dtype == np.float32
+
+	# The returned matrices and rows are copies, so the earlier ones haven't been overwritten
+	for expected, mm in results:
+		np.testing.assert_allclose(mm, expected, rtol=0, atol=1e-15)
+	row = reused.evaluate_row()
+	expected_row = row.copy()
+	reused.evaluate({'hwp': {'theta': rng.uniform(0, 90, 50)}})
+	np.testing.assert_allclose(row, expected_row, rtol=0, atol=0)
+
+	# So are the inverses of the components
+	component = reused.mueller_matrix_list[-1]
+	inverse = component.invert()
+	expected_inverse = inverse.copy()
+	component.properties['theta'] = rng.uniform(0, 90, 50)
+	component.invert()
+	np.testing.assert_allclose(inverse, expected_inverse, rtol=0, atol=0)
+
+	# Only the first evaluations of each shape allocate arrays
+	allocations = workspace.allocations
+	reused.evaluate({'hwp': {'theta': rng.uniform(0, 90, 50)}})
+	assert workspace.allocations == allocations
+
+	# Clones have their own arrays
+	expected = reused.evaluate()
+	clone = reused.clone()
+	reused.evaluate({'hwp': {'theta': np.zeros(50)}})
+	np.testing.assert_allclose(clone.evaluate(), expected, rtol=0, atol=0)
+
+
+if __name__ == '__main__':
+	verbose=True
+
+	p1 = mms.Polarizer()
+	p2 = mms.HorizontalPolarizer()
+	p3 = mms.VerticalPolarizer()
+	p4 = mms.WollastonPrism()
+	p5 = mms.Retarder()
+	p6 = mms.HWP()
+	p7 = mms.QWP()
+	p8 = mms.Rotator()
+
+	if verbose:
+		print(p1.evaluate())
+		print(p2.evaluate())
+		print(p3.evaluate())
+		print(p4.evaluate())
+		print(p5.evaluate())
+		print(p6.evaluate())
+		print(p7.evaluate())
+		print(p8.evaluate())
+	else:
+		t = p1.evaluate()
+		t = p2.evaluate()
+		t = p3.evaluate()
+		t = p4.evaluate()
+		t = p5.evaluate()
+		t = p6.evaluate()
+		t = p7.evaluate()
+		t = p8.evaluate()
+
+	test_batched_system_evaluate()
+	test_vectorized_functions()
+	test_evaluation_cache()
+	test_incremental_system_evaluate()
+	test_compiled_system()
+	test_jacobian()
+	test_double_difference_model()
+	test_evaluate_row()
+	test_propagate()
+	test_demodulate_frames()
+	test_parallel_evaluate()
+	test_invert()
+	test_demodulate()
+	test_rotate_mueller_matrix()
+	test_angle_grid()
+	test_chromatic()
+	test_clone()
+	test_parameter_vector()
+	test_profile()
+	test_log_likelihood()
+	test_optimize()
+	test_surrogate()
+	test_storage()
+	test_precision()